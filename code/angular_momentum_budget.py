@@ -2,18 +2,27 @@
 """Calculations of zonal momentum budget."""
 from datetime import timedelta
 from cached_property import cached_property
+import cf_units
 import iris
-from iris.analysis.maths import apply_ufunc
 import numpy as np
 
 from aeolus.calc import deriv, spatial_mean, time_mean, zonal_mean
-from aeolus.coord import coord_to_cube, isel
+from aeolus.coord import isel
 from aeolus.core import AtmoSim
 from aeolus.meta import update_metadata
 from aeolus.plot import tex2cf_units
 
 from pouch.clim_diag import d_dphi
 
+from budget_utils import (
+    as_lazy,
+    collapsed_template,
+    compute_cubes,
+    load_time_chunk,
+    uncached_copy,
+)
+from geometry import get_grid_geometry
+
 __all__ = ("AngularMomentumBudget",)
 
 
@@ -36,6 +45,56 @@ class AngularMomentumBudget(AtmoSim):
     term_group_adv_labels = ["mean_adv", "stat", "trans"]
     tex_units = r"$J$ $m^{-3}$"
     _units = tex2cf_units(tex_units)
+    # Time and zonal mean quantities that each term is calculated from
+    _term_reductions = {
+        "mean_horiz": ["cov_mean_horiz"],
+        "mean_vert": ["cov_mean_vert"],
+        "stat_horiz": ["cov_stat_horiz"],
+        "stat_vert": ["cov_stat_vert"],
+        "trans_horiz": ["cov_trans_horiz"],
+        "trans_vert": ["cov_trans_vert"],
+        "mean": ["cov_mean_horiz", "cov_mean_vert"],
+        "stat": ["cov_stat_horiz", "cov_stat_vert"],
+        "trans": ["cov_trans_horiz", "cov_trans_vert"],
+        "mean_adv_horiz": ["rho_v_tzm", "ang_mom_tzm"],
+        "mean_adv_vert": ["rho_w_tzm", "ang_mom_tzm"],
+        "mean_adv": ["rho_v_tzm", "rho_w_tzm", "ang_mom_tzm"],
+        "sum_all": [
+            "cov_mean_horiz",
+            "cov_mean_vert",
+            "cov_stat_horiz",
+            "cov_stat_vert",
+            "cov_trans_horiz",
+            "cov_trans_vert",
+        ],
+        "rho_ang_mom_time_change": ["rho_ang_mom_zm_delta"],
+        "ang_mom_time_change": ["rho_ang_mom_zm_delta", "rho_zm_delta", "ang_mom_tzm"],
+    }
+
+    @cached_property
+    def geometry(self):
+        """Geometric factors of the grid, shared between runs on the same grid."""
+        return get_grid_geometry(self._cubes, self.const, model=self.model)
+
+    @cached_property
+    def radius(self):
+        return self.geometry.radius
+
+    @cached_property
+    def lat_cos(self):
+        return self.geometry.lat_cos
+
+    @cached_property
+    def lat_sin(self):
+        return self.geometry.lat_sin
+
+    @cached_property
+    def coriolis(self):
+        return self.geometry.coriolis
+
+    @cached_property
+    def lat_cos_sq(self):
+        return self.geometry.lat_cos_sq
 
     @cached_property
     def sigma_p_tsm(self):  # TODO: move to AtmoSim
@@ -63,50 +122,6 @@ class AngularMomentumBudget(AtmoSim):
         inner_sum = self.u + omega * r_coslat
         return inner_sum * r_coslat
 
-    @cached_property
-    @update_metadata(name="planet_radius", units="m")
-    def radius(self):
-        return (
-            coord_to_cube(
-                self._cubes.extract(self.dim_constr.relax.z)[0],
-                self.model.z,
-                broadcast=False,
-            )
-            + self.const.radius
-        )
-
-    @cached_property
-    @update_metadata(name="cos(lat)", units="1")
-    def lat_cos(self):
-        lat_cube = coord_to_cube(
-            self._cubes.extract(self.dim_constr.relax.y)[0],
-            self.model.y,
-            broadcast=False,
-        )
-        lat_cos_cube = apply_ufunc(np.cos, apply_ufunc(np.deg2rad, lat_cube))
-        return lat_cos_cube
-
-    @cached_property
-    @update_metadata(name="sin(lat)", units="1")
-    def lat_sin(self):
-        lat_cube = coord_to_cube(
-            self._cubes.extract(self.dim_constr.relax.y)[0],
-            self.model.y,
-            broadcast=False,
-        )
-        lat_sin_cube = apply_ufunc(np.sin, apply_ufunc(np.deg2rad, lat_cube))
-        return lat_sin_cube
-
-    @cached_property
-    @update_metadata(name="coriolis_parameter", units="s-1")
-    def coriolis(self):
-        return 2 * self.const.planet_rotation_rate * self.lat_sin
-
-    @cached_property
-    @update_metadata(name="cos(lat)**2", units="1")
-    def lat_cos_sq(self):
-        return self.lat_cos ** 2
-
     @cached_property
     def rho_u(self):
         return self.dens * self.u
@@ -157,6 +172,10 @@ class AngularMomentumBudget(AtmoSim):
     def rho_zm(self):
         return zonal_mean(self.dens)
 
+    @cached_property
+    def rho_tzm(self):
+        return time_mean(self.rho_zm)
+
     @cached_property
     def rho_v_zm(self):
         return zonal_mean(self.rho_v)
@@ -253,8 +272,9 @@ class AngularMomentumBudget(AtmoSim):
         },
     )
     def stat_vert(self):
-        numerator = -1 * deriv(self.cov_stat_vert * self.radius ** 2, self.model.z)
-        denominator = self.radius ** 2
+        r_pow = self.geometry.radius_pow(2)
+        numerator = -1 * deriv(self.cov_stat_vert * r_pow, self.model.z)
+        denominator = r_pow
         return numerator / denominator
 
     @cached_property
@@ -289,8 +309,9 @@ class AngularMomentumBudget(AtmoSim):
         },
     )
     def trans_vert(self):
-        numerator = -1 * deriv(self.cov_trans_vert * self.radius ** 2, self.model.z)
-        denominator = self.radius ** 2
+        r_pow = self.geometry.radius_pow(2)
+        numerator = -1 * deriv(self.cov_trans_vert * r_pow, self.model.z)
+        denominator = r_pow
         return numerator / denominator
 
     @cached_property
@@ -324,8 +345,9 @@ class AngularMomentumBudget(AtmoSim):
         },
     )
     def mean_vert(self):
-        numerator = -1 * deriv(self.cov_mean_vert * self.radius ** 2, self.model.z)
-        denominator = self.radius ** 2
+        r_pow = self.geometry.radius_pow(2)
+        numerator = -1 * deriv(self.cov_mean_vert * r_pow, self.model.z)
+        denominator = r_pow
         return numerator / denominator
 
     @cached_property
@@ -414,6 +436,24 @@ class AngularMomentumBudget(AtmoSim):
     def sum_all(self):
         return self.mean + self.stat + self.trans
 
+    @cached_property
+    def delta_t(self):
+        """Length of the time axis as a scalar cube."""
+        delta_t = (self.datetimes[-1] - self.datetimes[0]) / timedelta(seconds=1)
+        return iris.cube.Cube(data=delta_t, units="s")
+
+    @cached_property
+    def rho_ang_mom_zm_delta(self):
+        rho_ang_mom_start = isel(self.rho_ang_mom_zm, self.model.t, 0)
+        rho_ang_mom_end = isel(self.rho_ang_mom_zm, self.model.t, -1)
+        return rho_ang_mom_end - rho_ang_mom_start
+
+    @cached_property
+    def rho_zm_delta(self):
+        rho_start = isel(self.rho_zm, self.model.t, 0)
+        rho_end = isel(self.rho_zm, self.model.t, -1)
+        return rho_end - rho_start
+
     @cached_property
     @update_metadata(
         units=_units,
@@ -425,12 +465,7 @@ class AngularMomentumBudget(AtmoSim):
         },
     )
     def rho_ang_mom_time_change(self):
-        rho_ang_mom_start = isel(self.rho_ang_mom_zm, self.model.t, 0)
-        rho_ang_mom_end = isel(self.rho_ang_mom_zm, self.model.t, -1)
-
-        delta_t = (self.datetimes[-1] - self.datetimes[0]) / timedelta(seconds=1)
-        delta_t_cube = iris.cube.Cube(data=delta_t, units="s")
-        return (rho_ang_mom_end - rho_ang_mom_start) / delta_t_cube
+        return self.rho_ang_mom_zm_delta / self.delta_t
 
     @cached_property
     @update_metadata(
@@ -444,10 +479,311 @@ class AngularMomentumBudget(AtmoSim):
     )
     def ang_mom_time_change(self):
         term_a = self.rho_ang_mom_time_change
-        rho_start = isel(self.rho_zm, self.model.t, 0)
-        rho_end = isel(self.rho_zm, self.model.t, -1)
-
-        delta_t = (self.datetimes[-1] - self.datetimes[0]) / timedelta(seconds=1)
-        delta_t_cube = iris.cube.Cube(data=delta_t, units="s")
-        term_b = self.ang_mom_tzm * (rho_end - rho_start) / delta_t_cube
+        term_b = self.ang_mom_tzm * self.rho_zm_delta / self.delta_t
         return term_a - term_b
+
+    def compute_lazy(self, terms=None, chunks=None):
+        """
+        Calculate the requested budget terms from a single dask graph.
+
+        The input fields are kept as dask arrays, so all the time and zonal mean
+        quantities needed for the requested terms are built lazily, with shared
+        intermediates (e.g. `rho_v` or `ang_mom`) appearing in the graph only once.
+        The graph is then evaluated by a single call to `dask.compute()`.
+
+        Parameters
+        ----------
+        terms: list of str, optional
+            Names of the terms to calculate. By default, `term_labels` are used.
+        chunks: int or tuple or str, optional
+            Chunks of the input dask arrays. See `budget_utils.as_lazy()`.
+
+        Returns
+        -------
+        dict
+            Dictionary of cubes of the budget terms.
+        """
+        if terms is None:
+            terms = self.term_labels
+        # Work on a copy, so that the lazy fields and the quantities built from them
+        # do not replace the fields and cached properties of this object
+        budget = uncached_copy(self)
+        for key in ["u", "v", "w", "dens"]:
+            budget.__dict__[key] = as_lazy(self[key], chunks=chunks)
+        reductions = []
+        for term in terms:
+            for key in self._term_reductions[term]:
+                if key not in reductions:
+                    reductions.append(key)
+        results = {term: budget[term] for term in terms}
+        compute_cubes([budget[key] for key in reductions] + [*results.values()])
+        return results
+
+    def _accumulate(self, bounds, chunk_size=10):
+        """
+        Accumulate running sums of the budget quantities over the time axis.
+
+        The time axis is traversed once, between the smallest and the largest of
+        `bounds`, in segments of at most `chunk_size` time slices.
+        Running (prefix) sums are saved at each index in `bounds`, so that a sum over
+        any time window between two bounds is a difference of two saved records.
+        Products are accumulated relative to a reference state (the first time slice
+        of the traversal), which avoids a loss of precision in the covariances.
+
+        Parameters
+        ----------
+        bounds: iterable of int
+            Time indices (from 0 to the length of the time axis inclusive)
+            at which the running sums are saved.
+        chunk_size: int, optional
+            Number of time slices held in memory at once.
+
+        Returns
+        -------
+        dict
+            Running sums at each of `bounds`, instantaneous zonal means of `rho` and
+            `rho * ang_mom` at each time slice adjacent to the bounds,
+            and the reference state.
+        """
+        t_dim = self.u.coord_dims(self.model.t)[0]
+        x_dim = self.u.coord_dims(self.model.x)[0]
+        y_dim = self.u.coord_dims(self.model.y)[0]
+        bounds = sorted(set(bounds))
+        # Time slices of the instantaneous values needed for the time tendencies
+        inst_idx = {idx for idx in bounds[:-1]} | {idx - 1 for idx in bounds[1:]}
+
+        # Factors needed to calculate the angular momentum
+        r = float(self.const.radius.data)
+        omega = float(self.const.planet_rotation_rate.data)
+        lat_shape = [1] * self.u.ndim
+        lat_shape[y_dim] = -1
+        r_coslat = r * self.lat_cos.data.reshape(lat_shape)
+
+        def _zm(arr):
+            return arr.mean(axis=x_dim)
+
+        # Segments of at most chunk_size time slices, split at the bounds
+        breaks = sorted(set(range(bounds[0], bounds[-1], chunk_size)) | set(bounds))
+        running = {}
+        prefix_sums = {}
+        inst = {}
+        ref = None
+        for start, stop in zip(breaks[:-1], breaks[1:]):
+            if start in bounds:
+                prefix_sums[start] = {key: arr.copy() for key, arr in running.items()}
+            u = load_time_chunk(self.u, t_dim, start, stop)
+            rho = load_time_chunk(self.dens, t_dim, start, stop)
+            rho_v = rho * load_time_chunk(self.v, t_dim, start, stop)
+            rho_w = rho * load_time_chunk(self.w, t_dim, start, stop)
+            ang_mom = (u + omega * r_coslat) * r_coslat
+            del u
+            if ref is None:
+                ref = {
+                    "rho_v": np.take(rho_v, [0], axis=t_dim),
+                    "rho_w": np.take(rho_w, [0], axis=t_dim),
+                    "ang_mom": np.take(ang_mom, [0], axis=t_dim),
+                }
+            for idx in inst_idx:
+                if start <= idx < stop:
+                    inst[idx] = {
+                        "rho_ang_mom_zm": np.take(
+                            _zm(rho * ang_mom), idx - start, axis=t_dim
+                        ),
+                        "rho_zm": np.take(_zm(rho), idx - start, axis=t_dim),
+                    }
+            shifted = {
+                "rho_v": rho_v - ref["rho_v"],
+                "rho_w": rho_w - ref["rho_w"],
+                "ang_mom": ang_mom - ref["ang_mom"],
+            }
+            sums = {
+                "rho": rho,
+                **shifted,
+                "rho_v_ang_mom": _zm(shifted["rho_v"] * shifted["ang_mom"]),
+                "rho_w_ang_mom": _zm(shifted["rho_w"] * shifted["ang_mom"]),
+            }
+            for key, arr in sums.items():
+                if key in running:
+                    running[key] += arr.sum(axis=t_dim)
+                else:
+                    running[key] = arr.sum(axis=t_dim)
+            del rho, rho_v, rho_w, ang_mom, shifted, sums
+        prefix_sums[breaks[-1]] = running
+        return {"prefix_sums": prefix_sums, "inst": inst, "ref": ref}
+
+    def _window_cache(self, acc, start, stop):
+        """
+        Calculate the time mean quantities for a window of time indices.
+
+        Parameters
+        ----------
+        acc: dict
+            Output of `_accumulate()` with `start` and `stop` among its bounds.
+        start, stop: int
+            Time indices of the window, the `stop` index is not included.
+
+        Returns
+        -------
+        dict
+            Cubes to be stored in the cache of the corresponding properties.
+        """
+        t_dim = self.u.coord_dims(self.model.t)[0]
+        x_dim = self.u.coord_dims(self.model.x)[0]
+        # Zonal dimension in the arrays with the time dimension removed
+        x_dim_tm = x_dim - int(t_dim < x_dim)
+        nt = stop - start
+        ref = {key: np.take(arr, 0, axis=t_dim) for key, arr in acc["ref"].items()}
+        sums = {
+            key: acc["prefix_sums"][stop][key] - acc["prefix_sums"][start].get(key, 0.0)
+            for key in acc["prefix_sums"][stop]
+        }
+
+        # Time means
+        tm = {key: sums[key] / nt for key in ["rho", "rho_v", "rho_w", "ang_mom"]}
+        tm_shift = {key: tm[key] for key in ["rho_v", "rho_w", "ang_mom"]}
+        for key in ["rho_v", "rho_w", "ang_mom"]:
+            tm[key] = tm[key] + ref[key]
+        tzm = {key: arr.mean(axis=x_dim_tm) for key, arr in tm.items()}
+        tm_zdev = {
+            key: tm[key] - np.expand_dims(tzm[key], x_dim_tm)
+            for key in ["rho_v", "rho_w", "ang_mom"]
+        }
+        # Transient eddy covariances: [(X - ref)(Y - ref)] - [X - ref][Y - ref]
+        cov_trans = {
+            cmpnt: sums[f"rho_{cmpnt}_ang_mom"] / nt
+            - (tm_shift[f"rho_{cmpnt}"] * tm_shift["ang_mom"]).mean(axis=x_dim_tm)
+            for cmpnt in ["v", "w"]
+        }
+
+        # Wrap the results into cubes
+        tmpl = zonal_mean(collapsed_template(self.u, self.model.t, start, stop))
+        units_rho = self.dens.units
+        units_rho_v = self.dens.units * self.v.units
+        units_rho_w = self.dens.units * self.w.units
+        units_ang_mom = cf_units.Unit("m2 s-1")
+
+        def _wrap(arr, name, units):
+            cube = tmpl.copy(data=arr)
+            cube.rename(name)
+            cube.units = units
+            return cube
+
+        cache = dict(
+            rho_tzm=_wrap(tzm["rho"], "rho_tzm", units_rho),
+            rho_v_tzm=_wrap(tzm["rho_v"], "rho_v_tzm", units_rho_v),
+            rho_w_tzm=_wrap(tzm["rho_w"], "rho_w_tzm", units_rho_w),
+            ang_mom_tzm=_wrap(tzm["ang_mom"], "ang_mom_tzm", units_ang_mom),
+            cov_stat_horiz=_wrap(
+                (tm_zdev["rho_v"] * tm_zdev["ang_mom"]).mean(axis=x_dim_tm),
+                "cov_stat_horiz",
+                units_rho_v * units_ang_mom,
+            ),
+            cov_stat_vert=_wrap(
+                (tm_zdev["rho_w"] * tm_zdev["ang_mom"]).mean(axis=x_dim_tm),
+                "cov_stat_vert",
+                units_rho_w * units_ang_mom,
+            ),
+            cov_trans_horiz=_wrap(
+                cov_trans["v"], "cov_trans_horiz", units_rho_v * units_ang_mom
+            ),
+            cov_trans_vert=_wrap(
+                cov_trans["w"], "cov_trans_vert", units_rho_w * units_ang_mom
+            ),
+            rho_ang_mom_zm_delta=_wrap(
+                acc["inst"][stop - 1]["rho_ang_mom_zm"]
+                - acc["inst"][start]["rho_ang_mom_zm"],
+                "rho_ang_mom_zm_delta",
+                units_rho * units_ang_mom,
+            ),
+            rho_zm_delta=_wrap(
+                acc["inst"][stop - 1]["rho_zm"] - acc["inst"][start]["rho_zm"],
+                "rho_zm_delta",
+                units_rho,
+            ),
+            delta_t=iris.cube.Cube(
+                data=(self.datetimes[stop - 1] - self.datetimes[start])
+                / timedelta(seconds=1),
+                units="s",
+            ),
+        )
+        cache["cov_mean_horiz"] = cache["rho_v_tzm"] * cache["ang_mom_tzm"]
+        cache["cov_mean_vert"] = cache["rho_w_tzm"] * cache["ang_mom_tzm"]
+        return cache
+
+    def stream(self, chunk_size=10):
+        """
+        Calculate the budget covariances in a single pass over the time axis.
+
+        Instead of building full 4D intermediates, the input fields are read in
+        chunks of `chunk_size` time slices and only running sums are kept.
+        The results are stored in the cache of the corresponding properties,
+        so that all the budget terms are then calculated from this pass.
+
+        Parameters
+        ----------
+        chunk_size: int, optional
+            Number of time slices held in memory at once.
+
+        Returns
+        -------
+        AngularMomentumBudget
+            The same object with the time-mean quantities precomputed.
+        """
+        nt = self.u.coord(self.model.t).shape[0]
+        acc = self._accumulate([0, nt], chunk_size=chunk_size)
+        self.__dict__.update(self._window_cache(acc, 0, nt))
+        return self
+
+    def stream_periods(self, periods, terms=None, chunk_size=10):
+        """
+        Calculate the budget terms for several time periods in a single pass.
+
+        Running sums of the budget quantities are saved at the period boundaries
+        during one traversal of the time axis, so that the time means and covariances
+        for each period are obtained from differences of these prefix sums.
+        The cost of an additional period is therefore small.
+
+        Parameters
+        ----------
+        periods: iterable of tuple
+            Pairs of the first and the last day of each period, e.g. [(0, 20), (20, 80)].
+            Both days are included, following the forecast period of the time slices.
+        terms: list of str, optional
+            Names of the terms to calculate. By default, `term_labels` are used.
+            Other quantities precomputed by the pass, e.g. `rho_tzm`, can be requested too.
+        chunk_size: int, optional
+            Number of time slices held in memory at once.
+
+        Returns
+        -------
+        dict
+            Dictionary of terms (dictionaries of cubes) for each of the periods.
+        """
+        if terms is None:
+            terms = self.term_labels
+        fcst_prd = self.u.coord(self.model.fcst_prd)
+        days = fcst_prd.units.convert(fcst_prd.points, "days")
+        windows = {}
+        for day_start, day_end in periods:
+            (idx,) = np.nonzero((days >= day_start) & (days <= day_end))
+            if len(idx) == 0:
+                raise ValueError(
+                    f"No time slices between days {day_start} and {day_end}."
+                )
+            windows[(day_start, day_end)] = (idx[0], idx[-1] + 1)
+        acc = self._accumulate(
+            [i for window in windows.values() for i in window], chunk_size=chunk_size
+        )
+
+        out = {}
+        for period, (start, stop) in windows.items():
+            cache = self._window_cache(acc, start, stop)
+            for term in terms:
+                missing = set(self._term_reductions.get(term, [term])) - set(cache)
+                if missing:
+                    raise ValueError(f"{term} cannot be calculated for a period.")
+            # Cached properties are not shared with the copies
+            budget = uncached_copy(self)
+            budget.__dict__.update(cache)
+            out[period] = {term: budget[term] for term in terms}
+        return out
@@ -2,6 +2,10 @@
 # -*- coding: utf-8 -*-
 """Make animations."""
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import multiprocessing
+import subprocess
 import warnings
 from pathlib import Path
 from time import time
@@ -10,6 +14,8 @@ import iris
 import matplotlib as mpl
 import matplotlib.animation
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 import numpy as np
 from cmcrameri import cm
 from matplotlib.offsetbox import AnchoredText
@@ -17,9 +23,10 @@ from tqdm.notebook import tqdm
 
 # My packages and local scripts
 import mypaths
+import aeolus
 from aeolus.calc import integrate, precip_sum, water_path, vertical_mean
 from aeolus.const import add_planet_conf_to_cubes, init_const
-from aeolus.coord import get_cube_rel_days, isel
+from aeolus.coord import get_cube_rel_days
 from aeolus.core import AtmoSim
 from aeolus.io import load_data
 from aeolus.model import um, um_stash
@@ -31,7 +38,7 @@ from commons import (
     troposphere,
     upper_troposphere,
 )  # free_troposphere,; troposphere,
-from pouch.clim_diag import calc_derived_cubes
+from derived import LazyCubeList
 from pouch.log import create_logger
 from pouch.plot import (
     KW_AUX_TTL,  # KW_ZERO_LINE,
@@ -48,8 +55,13 @@ from math import prod
 
 SCRIPT = Path(__file__).name
 
+# Increment to invalidate the cached time series, e.g. after changing the recipes,
+# the constraints they use or `calc_series()`
+SERIES_CACHE_VERSION = 1
+
 XY_VRBL = {
     "u_up_trop": {
+        "inputs": [um.u],
         "recipe": lambda cl: vertical_mean(
             cl.extract_cube(um.u).extract(upper_troposphere),
         ),
@@ -63,6 +75,7 @@ XY_VRBL = {
         "fmt": "3.1f",
     },
     "v_up_trop": {
+        "inputs": [um.v],
         "recipe": lambda cl: vertical_mean(
             cl.extract_cube(um.v).extract(upper_troposphere),
         ),
@@ -76,6 +89,7 @@ XY_VRBL = {
         "fmt": "3.1f",
     },
     "w_up_trop": {
+        "inputs": [um.w],
         "recipe": lambda cl: vertical_mean(
             cl.extract_cube(um.w).extract(upper_troposphere),
         ),
@@ -89,6 +103,7 @@ XY_VRBL = {
         "fmt": "3.2f",
     },
     "dt_diab": {
+        "inputs": [um.dt_sw, um.dt_lw, um.dt_bl, um.dt_lsppn, um.dt_cv, um.dens],
         "recipe": lambda cl: vertical_mean(
             sum(
                 cl.extract_cubes([um.dt_sw, um.dt_lw, um.dt_bl, um.dt_lsppn, um.dt_cv])
@@ -105,6 +120,7 @@ XY_VRBL = {
         "fmt": "3.1f",
     },
     "dt_lh": {
+        "inputs": [um.dt_bl, um.dt_lsppn, um.dt_cv, um.dens],
         "recipe": lambda cl: vertical_mean(
             sum(cl.extract_cubes([um.dt_bl, um.dt_lsppn, um.dt_cv])).extract(
                 troposphere
@@ -121,6 +137,7 @@ XY_VRBL = {
         "fmt": "3.1f",
     },
     "dt_rad": {
+        "inputs": [um.dt_sw, um.dt_lw, um.dens],
         "recipe": lambda cl: vertical_mean(
             sum(cl.extract_cubes([um.dt_sw, um.dt_lw])).extract(troposphere),
             weight_by=cl.extract_cube(um.dens).extract(troposphere),
@@ -135,6 +152,7 @@ XY_VRBL = {
         "fmt": "3.1f",
     },
     "dt_rad_cs": {
+        "inputs": [um.dt_sw_cs, um.dt_lw_cs, um.dens],
         "recipe": lambda cl: vertical_mean(
             sum(cl.extract_cubes([um.dt_sw_cs, um.dt_lw_cs])).extract(troposphere),
             weight_by=cl.extract_cube(um.dens).extract(troposphere),
@@ -149,6 +167,7 @@ XY_VRBL = {
         "fmt": "3.1f",
     },
     "dt_sw": {
+        "inputs": [um.dt_sw, um.dens],
         "recipe": lambda cl: vertical_mean(
             cl.extract_cube(um.dt_sw).extract(troposphere),
             weight_by=cl.extract_cube(um.dens).extract(troposphere),
@@ -163,6 +182,7 @@ XY_VRBL = {
         "fmt": "3.1f",
     },
     "dt_sw_cs": {
+        "inputs": [um.dt_sw_cs, um.dens],
         "recipe": lambda cl: vertical_mean(
             cl.extract_cube(um.dt_sw_cs).extract(troposphere),
             weight_by=cl.extract_cube(um.dens).extract(troposphere),
@@ -177,6 +197,7 @@ XY_VRBL = {
         "fmt": "3.1f",
     },
     "dt_lw": {
+        "inputs": [um.dt_lw, um.dens],
         "recipe": lambda cl: vertical_mean(
             cl.extract_cube(um.dt_lw).extract(troposphere),
             weight_by=cl.extract_cube(um.dens).extract(troposphere),
@@ -191,6 +212,7 @@ XY_VRBL = {
         "fmt": "3.1f",
     },
     "dt_lw_cs": {
+        "inputs": [um.dt_lw_cs, um.dens],
         "recipe": lambda cl: vertical_mean(
             cl.extract_cube(um.dt_lw_cs).extract(troposphere),
             weight_by=cl.extract_cube(um.dens).extract(troposphere),
@@ -205,6 +227,7 @@ XY_VRBL = {
         "fmt": "3.1f",
     },
     "t_sfc": {
+        "inputs": [um.t_sfc],
         "recipe": lambda cl: cl.extract_cube(um.t_sfc),
         "method": "contourf",
         "kw_plt": {
@@ -216,6 +239,7 @@ XY_VRBL = {
         "fmt": "3.1f",
     },
     "temp_500m": {
+        "inputs": [um.temp],
         "recipe": lambda cl: cl.extract_cube(um.temp).extract(
             iris.Constraint(**{um.z: 500})
         ),
@@ -229,6 +253,7 @@ XY_VRBL = {
         "fmt": "3.1f",
     },
     "toa_alb": {
+        "inputs": [um.toa_osr, um.toa_isr],
         "recipe": lambda cl: cl.extract_cube(um.toa_osr) / cl.extract_cube(um.toa_isr),
         "method": "contourf",
         "kw_plt": {
@@ -241,6 +266,7 @@ XY_VRBL = {
         "fmt": "3.0f",
     },
     "caf": {
+        "inputs": [um.caf],
         "recipe": lambda cl: cl.extract_cube(um.caf),
         "method": "contourf",
         "kw_plt": {"cmap": cm.davos, "levels": np.arange(0, 1.01, 0.05) * 1e2},
@@ -249,6 +275,7 @@ XY_VRBL = {
         "fmt": "3.0f",
     },
     "caf_vl": {
+        "inputs": [um.caf_vl],
         "recipe": lambda cl: cl.extract_cube(um.caf_vl),
         "method": "contourf",
         "kw_plt": {"cmap": cm.davos, "levels": np.arange(0, 1.01, 0.05) * 1e2},
@@ -257,6 +284,7 @@ XY_VRBL = {
         "fmt": "3.0f",
     },
     "caf_l": {
+        "inputs": [um.caf_l],
         "recipe": lambda cl: cl.extract_cube(um.caf_l),
         "method": "contourf",
         "kw_plt": {"cmap": cm.davos, "levels": np.arange(0, 1.01, 0.05) * 1e2},
@@ -265,6 +293,7 @@ XY_VRBL = {
         "fmt": "3.0f",
     },
     "caf_m": {
+        "inputs": [um.caf_m],
         "recipe": lambda cl: cl.extract_cube(um.caf_m),
         "method": "contourf",
         "kw_plt": {"cmap": cm.davos, "levels": np.arange(0, 1.01, 0.05) * 1e2},
@@ -273,6 +302,7 @@ XY_VRBL = {
         "fmt": "3.0f",
     },
     "caf_h": {
+        "inputs": [um.caf_h],
         "recipe": lambda cl: cl.extract_cube(um.caf_h),
         "method": "contourf",
         "kw_plt": {"cmap": cm.davos, "levels": np.arange(0, 1.01, 0.05) * 1e2},
@@ -281,6 +311,7 @@ XY_VRBL = {
         "fmt": "3.0f",
     },
     "wvp": {
+        "inputs": [um.sh, um.dens],
         "recipe": lambda cl: water_path(cl, kind="water_vapour"),
         "method": "contourf",
         "kw_plt": {"cmap": cm.lapaz_r, "levels": np.arange(0, 201, 10)},
@@ -289,6 +320,7 @@ XY_VRBL = {
         "fmt": "3.1e",
     },
     "iwp": {
+        "inputs": [um.cld_ice_mf, um.dens],
         "recipe": lambda cl: water_path(cl, kind="ice_water"),
         "method": "contourf",
         "kw_plt": {
@@ -301,6 +333,7 @@ XY_VRBL = {
         "fmt": "3.1e",
     },
     "lwp": {
+        "inputs": [um.cld_liq_mf, um.dens],
         "recipe": lambda cl: water_path(cl, kind="liquid_water"),
         "method": "contourf",
         "kw_plt": {
@@ -313,6 +346,7 @@ XY_VRBL = {
         "fmt": "3.1e",
     },
     "cwp": {
+        "inputs": [um.cld_liq_mf, um.cld_ice_mf, um.dens],
         "recipe": lambda cl: water_path(cl, kind="cloud_water"),
         "method": "contourf",
         "kw_plt": {
@@ -325,6 +359,7 @@ XY_VRBL = {
         "fmt": "3.1e",
     },
     "rwp": {
+        "inputs": [um.rain_mf, um.dens],
         "recipe": lambda cl: integrate(
             prod(cl.extract_cubes([um.rain_mf, um.dens])), um.z
         ),
@@ -339,6 +374,7 @@ XY_VRBL = {
         "fmt": "3.1e",
     },
     "ccp": {
+        "inputs": [um_stash.ccw_rad, um_stash.cca_anvil, um.dens],
         "recipe": lambda cl: integrate(
             prod(cl.extract_cubes([um_stash.ccw_rad, um_stash.cca_anvil, um.dens])),
             um.z,
@@ -354,6 +390,7 @@ XY_VRBL = {
         "fmt": "3.1e",
     },
     "sfc_shf": {
+        "inputs": [um.sfc_shf],
         "recipe": lambda cl: cl.extract_cube(um.sfc_shf),
         "method": "contourf",
         "kw_plt": {
@@ -365,6 +402,7 @@ XY_VRBL = {
         "fmt": "3.0f",
     },
     "sfc_lhf": {
+        "inputs": [um.sfc_lhf],
         "recipe": lambda cl: cl.extract_cube(um.sfc_lhf),
         "method": "contourf",
         "kw_plt": {
@@ -376,6 +414,7 @@ XY_VRBL = {
         "fmt": "3.0f",
     },
     "precip_sum": {
+        "inputs": [um.ls_rain, um.ls_snow, um.cv_rain, um.cv_snow],
         "recipe": lambda cl: precip_sum(cl),
         "method": "contourf",
         "kw_plt": {
@@ -390,6 +429,13 @@ XY_VRBL = {
 }
 
 
+def required_inputs(vrbl_keys):
+    """Names of the input variables needed by the given `XY_VRBL` recipes."""
+    return sorted(
+        {name for vrbl_key in vrbl_keys for name in XY_VRBL[vrbl_key]["inputs"]}
+    )
+
+
 def parse_args(args=None):
     """Argument parser."""
     ap = argparse.ArgumentParser(
@@ -426,86 +472,657 @@ def parse_args(args=None):
         default=False,
         help="Add min/max values to the plot",
     )
-    return ap.parse_args(args)
+    ap.add_argument(
+        "--backend",
+        default="mpl",
+        choices=["mpl", "reuse", "raster"],
+        help="Rendering backend: full matplotlib plots redrawn in every frame,"
+        " matplotlib plots with reused artists or fast raster quick-looks",
+    )
+    ap.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes rendering frames in parallel (mpl backend only)."
+        " If 1, use matplotlib.animation.FuncAnimation",
+    )
+    parsed = ap.parse_args(args)
+    if parsed.workers > 1 and parsed.backend != "mpl":
+        ap.error(f"--workers cannot be used with --backend {parsed.backend}")
+    return parsed
 
 
-def main(args=None):
-    """Main entry point."""
+def make_mosaic(vrbls_to_show):
+    """Layout of the figure: one row per variable, a map and a colorbar per simulation."""
+    return [
+        [
+            i
+            for j in [
+                [f"{vrbl_key}-{sim_label}", f"{vrbl_key}-{sim_label}-cax"]
+                for sim_label in SIM_LABELS
+            ]
+            for i in j
+        ]
+        for vrbl_key in vrbls_to_show
+    ]
 
-    def _make_frame(it):
-        fig.clear()
-        axd = fig.subplot_mosaic(
-            mosaic,
-            gridspec_kw={
-                # set the width ratios between the columns
-                "width_ratios": [30, 1]
-                * ncols
-            },
-        )
-        iletters = subplot_label_generator()
-        for key, ax in axd.items():
-            # ax.clear()
-            if not key.endswith("-cax"):
-                ax.set_title(f"{next(iletters)}", **KW_SBPLT_LABEL)
-                ax.set_ylim(-90, 90)
-                ax.set_yticks(YLOCS)
-                ax.set_yticklabels(YLOCS, fontsize="xx-small")
-                ax.set_xlim(-180, 180)
-                ax.set_xticks(XLOCS)
-                ax.set_xticklabels(XLOCS, fontsize="xx-small")
-                ax.grid()
-        for (sim_label, sim_prop) in SIM_LABELS.items():
-            the_run = runs[sim_label]
-            days = get_cube_rel_days(the_run._cubes.extract(DimConstr().relax.t)[0])
-            cubes = isel(the_run._cubes, um.t, it)
+
+def make_figure(vrbls_to_show):
+    """Create an empty figure for the animation."""
+    ncols = len(SIM_LABELS)
+    nrows = len(vrbls_to_show)
+    return plt.figure(constrained_layout=True, figsize=(ncols * 8, nrows * 3))
+
+
+def _series_cache_path(sim_label, vrbl_key, inp_file):
+    """Path to the cached time series of a variable, keyed by its recipe and source."""
+    vrbl_prop = XY_VRBL[vrbl_key]
+    stat = inp_file.stat()
+    sha = hashlib.sha1()
+    sha.update(f"{inp_file.name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    sha.update(f"{SERIES_CACHE_VERSION}:{aeolus.__version__}".encode())
+    sha.update(f"{vrbl_key}:{vrbl_prop['tex_units']}".encode())
+    return (
+        mypaths.cachedir
+        / "animate_spinup"
+        / f"{sim_label}__{vrbl_key}__{sha.hexdigest()[:16]}.npz"
+    )
+
+
+def calc_series(the_run, vrbl_key, logger=None):
+    """
+    Apply a recipe to the whole time series of a simulation.
+
+    Parameters
+    ----------
+    the_run: aeolus.core.AtmoSim
+        Simulation.
+    vrbl_key: str
+        Key of `XY_VRBL`.
+    logger: logging.Logger-like, optional
+        Logger.
+
+    Returns
+    -------
+    dict
+        Arrays of the field values (time, latitude, longitude), the coordinates
+        and the days since the start of the simulation.
+    """
+    vrbl_prop = XY_VRBL[vrbl_key]
+    cube = vrbl_prop["recipe"](the_run._cubes)
+    try:
+        cube.convert_units(tex2cf_units(vrbl_prop["tex_units"]))
+    except iris.exceptions.UnitConversionError:
+        if logger is not None:
+            logger.info(f"Units not converted for {vrbl_key=}")
+    data = np.ma.filled(np.ma.asarray(cube.data, dtype="float64"), np.nan)
+    if data.ndim == 2:
+        data = data[np.newaxis]
+    return {
+        "data": data,
+        "x": cube.coord(um.x).points,
+        "y": cube.coord(um.y).points,
+        "days": get_cube_rel_days(the_run._cubes.extract(DimConstr().relax.t)[0]),
+    }
+
+
+def load_series(inp_files, vrbls_to_show, load_run, logger=None):
+    """
+    Load the time series of all variables from the cache or calculate them.
+
+    Parameters
+    ----------
+    inp_files: dict
+        Input file for each simulation label.
+    vrbls_to_show: list of str
+        Keys of `XY_VRBL`.
+    load_run: callable
+        Function returning an `aeolus.core.AtmoSim` object for a simulation label
+        and a list of `XY_VRBL` keys. Only called if some of the variables
+        are not in the cache.
+    logger: logging.Logger-like, optional
+        Logger.
+
+    Returns
+    -------
+    dict
+        Time series of variables for each simulation.
+    """
+    series = {}
+    for sim_label, inp_file in inp_files.items():
+        series[sim_label] = {}
+        to_calc = []
+        for vrbl_key in vrbls_to_show:
+            cache_path = _series_cache_path(sim_label, vrbl_key, inp_file)
+            if cache_path.exists():
+                with np.load(cache_path) as npz:
+                    series[sim_label][vrbl_key] = dict(npz)
+            else:
+                to_calc.append(vrbl_key)
+        if not to_calc:
+            continue
+        the_run = load_run(sim_label, to_calc)
+        for vrbl_key in to_calc:
+            cache_path = _series_cache_path(sim_label, vrbl_key, inp_file)
+            series[sim_label][vrbl_key] = calc_series(the_run, vrbl_key, logger=logger)
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            np.savez(cache_path, **series[sim_label][vrbl_key])
+            if logger is not None:
+                logger.info(f"Saved {sim_label} {vrbl_key} to {cache_path}")
+    return series
+
+
+def _draw_layout(fig, vrbls_to_show):
+    """Draw the parts of the figure that are the same in all frames."""
+    fig.clear()
+    axd = fig.subplot_mosaic(
+        make_mosaic(vrbls_to_show),
+        gridspec_kw={
+            # set the width ratios between the columns
+            "width_ratios": [30, 1]
+            * len(SIM_LABELS)
+        },
+    )
+    iletters = subplot_label_generator()
+    for key, ax in axd.items():
+        # ax.clear()
+        if not key.endswith("-cax"):
+            ax.set_title(f"{next(iletters)}", **KW_SBPLT_LABEL)
+            ax.set_ylim(-90, 90)
+            ax.set_yticks(YLOCS)
+            ax.set_yticklabels(YLOCS, fontsize="xx-small")
+            ax.set_xlim(-180, 180)
+            ax.set_xticks(XLOCS)
+            ax.set_xticklabels(XLOCS, fontsize="xx-small")
+            ax.grid()
+    for (sim_label, sim_prop) in SIM_LABELS.items():
+        for vrbl_key in vrbls_to_show:
+            vrbl_prop = XY_VRBL[vrbl_key]
+            ax = axd[f"{vrbl_key}-{sim_label}"]
+            # ax.set_ylabel("Latitude [$\degree$]", fontsize="xx-small")
+            # ax.set_xlabel("Longitude [$\degree$]", fontsize="xx-small")
+            if ax.get_subplotspec().is_first_row():
+                ax.set_title(sim_prop["title"], **KW_MAIN_TTL)
+            ax.set_title(
+                f'{vrbl_prop["title"]} [{vrbl_prop["tex_units"]}]', **KW_AUX_TTL
+            )
+    return axd
+
+
+def _day_title_ax(axd):
+    """Axes whose title shows the day of the frame."""
+    for ax in axd.values():
+        if ax.get_subplotspec().is_last_col() and ax.get_subplotspec().is_first_row():
+            return ax
+
+
+def draw_frame(fig, it, series, vrbls_to_show, add_min_max=False):
+    """Draw the given frame of the animation on the figure."""
+    bg_color = mpl.colors.to_rgb(plt.rcParams["figure.facecolor"])
+    axd = _draw_layout(fig, vrbls_to_show)
+    for sim_label in SIM_LABELS:
+        for vrbl_key in vrbls_to_show:
+            vrbl_prop = XY_VRBL[vrbl_key]
+            the_series = series[sim_label][vrbl_key]
+            days = the_series["days"]
+            ax = axd[f"{vrbl_key}-{sim_label}"]
+            cax = axd[f"{vrbl_key}-{sim_label}-cax"]
+            data = the_series["data"][it]
+            _p0 = getattr(ax, vrbl_prop["method"])(
+                the_series["x"], the_series["y"], data, **vrbl_prop["kw_plt"]
+            )
+            fig.colorbar(_p0, cax=cax, pad=0.02)
+            if add_min_max:
+                fmt = vrbl_prop.get("fmt", "3.1e")
+                cube_min = np.nanmin(data)
+                cube_max = np.nanmax(data)
+                at = AnchoredText(
+                    f"Min: {cube_min:>{fmt}}\nMax: {cube_max:>{fmt}}",
+                    prop=dict(color="k", size="x-small"),
+                    frameon=False,
+                    loc="lower right",
+                )
+                at.patch.set_facecolor(mpl.colors.to_rgba(bg_color, alpha=0.75))
+                ax.add_artist(at)
+    _day_title_ax(axd).set_title(f"Day:{int(days[it])+1:>4d}\n", loc="right")
+
+
+def _nearest_index(points, centres):
+    """Indices of the nearest grid points to pixel centres, -1 outside of the grid."""
+    order = np.argsort(points)
+    pts = points[order]
+    half_step = 0.5 * (pts[-1] - pts[0]) / max(pts.size - 1, 1)
+    idx = np.clip(np.searchsorted(pts, centres), 1, pts.size - 1)
+    idx -= (centres - pts[idx - 1] < pts[idx] - centres).astype(int)
+    out = order[idx]
+    out[(centres < pts[0] - half_step) | (centres > pts[-1] + half_step)] = -1
+    return out
+
+
+def _contourf_template(the_series, vrbl_key):
+    """
+    Filled contour plot of the first frame made in a throwaway figure.
+
+    It has the levels, colours and norm of the given variable
+    and is used to make colorbars and colour tables for the fast renderers.
+    """
+    ax = Figure().subplots()
+    return ax.contourf(
+        the_series["x"],
+        the_series["y"],
+        the_series["data"][0],
+        **XY_VRBL[vrbl_key]["kw_plt"],
+    )
+
+
+class ArtistReuseRenderer:
+    """
+    Renderer of animation frames reusing matplotlib artists.
+
+    The axes, titles and colorbars are created once. Each field is shown by
+    a `pcolormesh` with the discrete colours of its `contourf` levels.
+    In each frame, only the data of the meshes and the labels are updated
+    and drawn, together with the grid lines, over a saved background
+    of the figure (blitting).
+    """
+
+    def __init__(self, series, vrbls_to_show, add_min_max=False):
+        """
+        Instantiate an `ArtistReuseRenderer` object.
+
+        Parameters
+        ----------
+        series: dict
+            Time series of variables for each simulation, see `load_series()`.
+        vrbls_to_show: list of str
+            Keys of `XY_VRBL` to show.
+        add_min_max: bool, optional
+            Add min/max values to the plot.
+        """
+        bg_color = mpl.colors.to_rgb(plt.rcParams["figure.facecolor"])
+        self.fig = make_figure(vrbls_to_show)
+        self.canvas = FigureCanvasAgg(self.fig)
+        axd = _draw_layout(self.fig, vrbls_to_show)
+        self._panels = []
+        for sim_label in SIM_LABELS:
             for vrbl_key in vrbls_to_show:
                 vrbl_prop = XY_VRBL[vrbl_key]
+                the_series = series[sim_label][vrbl_key]
                 ax = axd[f"{vrbl_key}-{sim_label}"]
-                cax = axd[f"{vrbl_key}-{sim_label}-cax"]
-                # ax.set_ylabel("Latitude [$\degree$]", fontsize="xx-small")
-                # ax.set_xlabel("Longitude [$\degree$]", fontsize="xx-small")
-                if ax.get_subplotspec().is_first_row():
-                    ax.set_title(sim_prop["title"], **KW_MAIN_TTL)
-                ax.set_title(
-                    f'{vrbl_prop["title"]} [{vrbl_prop["tex_units"]}]', **KW_AUX_TTL
+                cs = _contourf_template(the_series, vrbl_key)
+                self.fig.colorbar(cs, cax=axd[f"{vrbl_key}-{sim_label}-cax"], pad=0.02)
+                # Values outside of the levels are not shown, like in contourf
+                cmap = mpl.colors.ListedColormap(cs.to_rgba(cs.layers))
+                cmap.set_bad(alpha=0)
+                cmap.set_under(alpha=0)
+                cmap.set_over(alpha=0)
+                mesh = ax.pcolormesh(
+                    the_series["x"],
+                    the_series["y"],
+                    the_series["data"][0],
+                    cmap=cmap,
+                    norm=mpl.colors.BoundaryNorm(cs.levels, cmap.N),
+                    shading="nearest",
+                    animated=True,
                 )
-                cube = vrbl_prop["recipe"](cubes)
-                try:
-                    cube.convert_units(tex2cf_units(vrbl_prop["tex_units"]))
-                except iris.exceptions.UnitConversionError:
-                    L.info(f"Units not converted for {vrbl_key=}")
-                y, x = [i.points for i in cube.dim_coords]
-                _p0 = getattr(ax, vrbl_prop["method"])(
-                    x, y, cube.data, **vrbl_prop["kw_plt"]
-                )
-                fig.colorbar(_p0, cax=cax, pad=0.02)
+                panel = {
+                    "series": the_series,
+                    "mesh": mesh,
+                    # Grid lines are redrawn over the fields
+                    "grid": [*ax.get_xgridlines(), *ax.get_ygridlines()],
+                    "text": None,
+                }
                 if add_min_max:
-                    fmt = vrbl_prop.get("fmt", "3.1e")
-                    cube_min = cube.data.min()
-                    cube_max = cube.data.max()
-                    at = AnchoredText(
-                        f"Min: {cube_min:>{fmt}}\nMax: {cube_max:>{fmt}}",
-                        prop=dict(color="k", size="x-small"),
-                        frameon=False,
-                        loc="lower right",
+                    panel["fmt"] = vrbl_prop.get("fmt", "3.1e")
+                    panel["text"] = ax.text(
+                        0.98,
+                        0.02,
+                        "",
+                        ha="right",
+                        va="bottom",
+                        color="k",
+                        size="x-small",
+                        transform=ax.transAxes,
+                        bbox=dict(
+                            facecolor=mpl.colors.to_rgba(bg_color, alpha=0.75),
+                            edgecolor="none",
+                        ),
+                        animated=True,
                     )
-                    at.patch.set_facecolor(mpl.colors.to_rgba(bg_color, alpha=0.75))
-                    ax.add_artist(at)
-        for ax in axd.values():
-            if (
-                ax.get_subplotspec().is_last_col()
-                and ax.get_subplotspec().is_first_row()
-            ):
-                ax.set_title(f"Day:{int(days[it])+1:>4d}\n", loc="right")
+                self._panels.append(panel)
+        self._title = _day_title_ax(axd).set_title("Day:9999\n", loc="right")
+        self._title.set_animated(True)
+        self.canvas.draw()
+        # Freeze the layout and save everything that does not change
+        self.fig.set_constrained_layout(False)
+        self.canvas.draw()
+        self._background = self.canvas.copy_from_bbox(self.fig.bbox)
+
+    def __call__(self, it):
+        """
+        Render a frame.
+
+        Parameters
+        ----------
+        it: int
+            Frame index.
+
+        Returns
+        -------
+        numpy.ndarray
+            Array of RGBA pixels of shape (height, width, 4).
+        """
+        self.canvas.restore_region(self._background)
+        for panel in self._panels:
+            data = panel["series"]["data"][it]
+            panel["mesh"].set_array(np.ma.masked_invalid(data))
+            self.fig.draw_artist(panel["mesh"])
+            for line in panel["grid"]:
+                self.fig.draw_artist(line)
+            if panel["text"] is not None:
+                fmt = panel["fmt"]
+                panel["text"].set_text(
+                    f"Min: {np.nanmin(data):>{fmt}}\nMax: {np.nanmax(data):>{fmt}}"
+                )
+                self.fig.draw_artist(panel["text"])
+        days = self._panels[-1]["series"]["days"]
+        self._title.set_text(f"Day:{int(days[it])+1:>4d}\n")
+        self.fig.draw_artist(self._title)
+        return np.asarray(self.canvas.buffer_rgba())
 
+
+class RasterRenderer:
+    """
+    Fast renderer of animation frames as RGBA arrays.
+
+    The static parts of the figure (titles, ticks, grid lines, colorbars) are
+    drawn by matplotlib only once. In each frame, the fields are mapped
+    to colours of their `contourf` levels by a lookup table and written
+    directly into the pixels of the map panels. The day label is composed
+    of pre-rendered glyphs. Min/max labels are not shown.
+    """
+
+    def __init__(self, series, vrbls_to_show):
+        """
+        Instantiate a `RasterRenderer` object.
+
+        Parameters
+        ----------
+        series: dict
+            Time series of variables for each simulation, see `load_series()`.
+        vrbls_to_show: list of str
+            Keys of `XY_VRBL` to show.
+        """
+        self.series = series
+        self.fig = make_figure(vrbls_to_show)
+        self.canvas = FigureCanvasAgg(self.fig)
+        axd = _draw_layout(self.fig, vrbls_to_show)
+        self._panels = []
+        for sim_label in SIM_LABELS:
+            for vrbl_key in vrbls_to_show:
+                the_series = series[sim_label][vrbl_key]
+                cs = _contourf_template(the_series, vrbl_key)
+                self.fig.colorbar(cs, cax=axd[f"{vrbl_key}-{sim_label}-cax"], pad=0.02)
+                # Colours of the filled intervals and a transparent one for missing data
+                lut = np.zeros((len(cs.layers) + 1, 4), dtype="uint8")
+                lut[:-1] = cs.to_rgba(cs.layers, bytes=True)
+                self._panels.append(
+                    {
+                        "ax": axd[f"{vrbl_key}-{sim_label}"],
+                        "series": the_series,
+                        "levels": np.asarray(cs.levels, dtype="float64"),
+                        "lut": lut,
+                    }
+                )
+        # Find where the day label goes and render the background without it
+        title_ax = _day_title_ax(axd)
+        title_ax.set_title("Day:9999\n", loc="right")
+        self.canvas.draw()
+        renderer = self.canvas.get_renderer()
+        title = title_ax.title
+        self._title_bbox = title.get_window_extent(renderer=renderer)
+        self._title_color = np.array(mpl.colors.to_rgb(title.get_color())) * 255
+        self._glyph_props = title.get_fontproperties()
+        title_ax.set_title("", loc="right")
+        self.canvas.draw()
+        self.background = np.array(self.canvas.buffer_rgba())
+        self._glyphs = {}
+        for panel in self._panels:
+            self._setup_panel(panel)
+
+    def _setup_panel(self, panel):
+        """Pixel region of a panel and the indices of the grid points in it."""
+        height = self.background.shape[0]
+        ax = panel["ax"]
+        bbox = ax.get_window_extent(renderer=self.canvas.get_renderer())
+        col0, col1 = int(np.ceil(bbox.x0)), int(np.floor(bbox.x1))
+        row0, row1 = height - int(np.floor(bbox.y1)), height - int(np.ceil(bbox.y0))
+        panel["region"] = (slice(row0, row1), slice(col0, col1))
+        # Keep grid lines and other artists that differ from the axes background
+        face = np.round(np.array(mpl.colors.to_rgba(ax.get_facecolor())) * 255)
+        panel["keep"] = np.any(self.background[panel["region"]] != face, axis=-1)
+        # Longitudes and latitudes of the pixel centres
+        (x0, x1), (y0, y1) = ax.get_xlim(), ax.get_ylim()
+        lons = x0 + (np.arange(col0, col1) - bbox.x0 + 0.5) / bbox.width * (x1 - x0)
+        lats = y1 - (np.arange(row0, row1) - (height - bbox.y1) + 0.5) / bbox.height * (
+            y1 - y0
+        )
+        panel["ix"] = _nearest_index(panel["series"]["x"], lons)
+        panel["iy"] = _nearest_index(panel["series"]["y"], lats)
+        panel["keep"] |= (panel["iy"] < 0)[:, np.newaxis] | (panel["ix"] < 0)
+
+    def _glyph(self, char):
+        """Coverage mask of a character rendered with the font of the day label."""
+        if char not in self._glyphs:
+            dpi = self.fig.dpi
+            height = self._title_bbox.height
+            fig = Figure(figsize=(2 * height / dpi, height / dpi), dpi=dpi)
+            canvas = FigureCanvasAgg(fig)
+            fig.patch.set_alpha(0)
+            # Use the width of a digit for spaces
+            text = fig.text(
+                0,
+                1,
+                "0" if char == " " else char,
+                va="top",
+                fontproperties=self._glyph_props,
+            )
+            canvas.draw()
+            width = int(
+                np.ceil(text.get_window_extent(renderer=canvas.get_renderer()).width)
+            )
+            mask = np.asarray(canvas.buffer_rgba())[:, :width, 3] / 255
+            self._glyphs[char] = np.zeros_like(mask) if char == " " else mask
+        return self._glyphs[char]
+
+    def _draw_text(self, frame, text):
+        """Draw text right-aligned at the top of the day label box."""
+        mask = np.concatenate([self._glyph(char) for char in text], axis=1)
+        height = frame.shape[0]
+        row0 = max(height - int(np.ceil(self._title_bbox.y1)), 0)
+        row1 = min(row0 + mask.shape[0], height)
+        col1 = int(np.floor(self._title_bbox.x1))
+        col0 = col1 - mask.shape[1]
+        region = frame[row0:row1, col0:col1, :3]
+        mask = mask[: row1 - row0, :, np.newaxis]
+        region[:] = np.round(region * (1 - mask) + self._title_color * mask)
+
+    def __call__(self, it):
+        """
+        Render a frame.
+
+        Parameters
+        ----------
+        it: int
+            Frame index.
+
+        Returns
+        -------
+        numpy.ndarray
+            Array of RGBA pixels of shape (height, width, 4).
+        """
+        frame = self.background.copy()
+        for panel in self._panels:
+            the_series = panel["series"]
+            levels = panel["levels"]
+            values = the_series["data"][it][panel["iy"][:, np.newaxis], panel["ix"]]
+            idx = np.searchsorted(levels, values, side="right") - 1
+            # The highest level belongs to the last interval
+            idx[values == levels[-1]] = levels.size - 2
+            idx[(idx < 0) | (idx > levels.size - 2)] = panel["lut"].shape[0] - 1
+            keep = panel["keep"] | (idx == panel["lut"].shape[0] - 1)
+            region = frame[panel["region"]]
+            region[~keep] = panel["lut"][idx[~keep]]
+        days = self._panels[-1]["series"]["days"]
+        self._draw_text(frame, f"Day:{int(days[it])+1:>4d}")
+        return frame
+
+
+def _open_encoder(vidname, width, height, fps=10):
+    """Start ffmpeg reading raw RGBA frames from stdin."""
+    return subprocess.Popen(
+        [
+            mpl.rcParams["animation.ffmpeg_path"],
+            "-y",
+            "-loglevel",
+            "error",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "rgba",
+            "-s",
+            f"{width}x{height}",
+            "-r",
+            f"{fps}",
+            "-i",
+            "-",
+            "-vf",
+            "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+            "-vcodec",
+            "libx264",
+            "-pix_fmt",
+            "yuv420p",
+            str(vidname),
+        ],
+        stdin=subprocess.PIPE,
+    )
+
+
+def _close_encoder(encoder):
+    """Wait for ffmpeg to finish writing the video."""
+    encoder.stdin.close()
+    if encoder.wait() != 0:
+        raise RuntimeError(f"ffmpeg failed with exit code {encoder.returncode}")
+
+
+def save_animation_frames(vidname, renderer, frames, fps=10):
+    """
+    Render frames one by one and pipe them to ffmpeg.
+
+    Parameters
+    ----------
+    vidname: pathlib.Path
+        Path to the output video file.
+    renderer: callable
+        Function returning the RGBA pixels of a frame given its index,
+        e.g. `RasterRenderer` or `ArtistReuseRenderer`.
+    frames: int
+        Number of frames.
+    fps: int, optional
+        Frames per second.
+    """
+    encoder = None
+    for it in tqdm(range(frames)):
+        frame = renderer(it)
+        if encoder is None:
+            height, width = frame.shape[:2]
+            encoder = _open_encoder(vidname, width, height, fps=fps)
+        encoder.stdin.write(frame.tobytes())
+    if encoder is not None:
+        _close_encoder(encoder)
+
+
+# State of a worker process rendering frames in parallel
+_WORKER = {}
+
+
+def _init_worker(series, vrbls_to_show, add_min_max):
+    """Create a figure in a worker process, reused for all its frames."""
+    use_style()
+    _WORKER.update(
+        fig=make_figure(vrbls_to_show),
+        series=series,
+        vrbls_to_show=vrbls_to_show,
+        add_min_max=add_min_max,
+    )
+
+
+def _render_frame(it):
+    """Render a frame in a worker process and return it as raw RGBA bytes."""
+    fig = _WORKER["fig"]
+    draw_frame(
+        fig,
+        it,
+        _WORKER["series"],
+        _WORKER["vrbls_to_show"],
+        add_min_max=_WORKER["add_min_max"],
+    )
+    fig.canvas.draw()
+    return fig.canvas.get_width_height(), bytes(fig.canvas.buffer_rgba())
+
+
+def save_animation_parallel(
+    vidname, series, vrbls_to_show, frames, workers, add_min_max=False, fps=10
+):
+    """
+    Render frames in a pool of processes and pipe them to ffmpeg in order.
+
+    Parameters
+    ----------
+    vidname: pathlib.Path
+        Path to the output video file.
+    series: dict
+        Time series of variables for each simulation, see `load_series()`.
+    vrbls_to_show: list of str
+        Keys of `XY_VRBL` to show.
+    frames: int
+        Number of frames.
+    workers: int
+        Number of worker processes, each with its own figure.
+    add_min_max: bool, optional
+        Add min/max values to the plot.
+    fps: int, optional
+        Frames per second.
+    """
+    # Use fork so that the arrays are not pickled
+    ctx = multiprocessing.get_context("fork")
+    encoder = None
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=ctx,
+        initializer=_init_worker,
+        initargs=(series, vrbls_to_show, add_min_max),
+    ) as executor:
+        # Results are yielded in the order of frames
+        for (width, height), frame in tqdm(
+            executor.map(_render_frame, range(frames)), total=frames
+        ):
+            if encoder is None:
+                encoder = _open_encoder(vidname, width, height, fps=fps)
+            encoder.stdin.write(frame)
+    if encoder is not None:
+        _close_encoder(encoder)
+
+
+def main(args=None):
+    """Main entry point."""
     t0 = time()
     L = create_logger(Path(__file__))
     # Parse command-line arguments
     args = parse_args(args)
     # Use custom mplstyle
     use_style()
-    bg_color = mpl.colors.to_rgb(plt.rcParams["figure.facecolor"])
-    # fg_color = mpl.colors.to_rgb(plt.rcParams["text.color"])
 
     # Variables
     vrbls_to_show = args.names
@@ -521,21 +1138,24 @@ def main(args=None):
     vidname = plotdir / f"{vidname}_0-{frames:03d}d.mp4"
 
     # Load processed data
-    runs = {}
-    for sim_label, sim_prop in tqdm(SIM_LABELS.items()):
-        planet = sim_prop["planet"]
+    inp_files = {
+        sim_label: inp_dir / f"{GLM_SUITE_ID}_{sim_label}_{time_prof}.nc"
+        for sim_label in SIM_LABELS
+    }
+
+    def _load_run(sim_label, vrbl_keys):
+        planet = SIM_LABELS[sim_label]["planet"]
         const = init_const(planet, directory=mypaths.constdir)
-        L.info(
-            f"Loading data from {inp_dir / f'{GLM_SUITE_ID}_{sim_label}_{time_prof}.nc'}"
-        )
-        cl = load_data(
-            files=inp_dir / f"{GLM_SUITE_ID}_{sim_label}_{time_prof}.nc",
-        )
+        L.info(f"Loading data from {inp_files[sim_label]}")
+        cl = load_data(files=inp_files[sim_label])
         add_planet_conf_to_cubes(cl, const)
-        # Derive additional fields
-        calc_derived_cubes(cl, const=const, model=um)
+        # Keep only the variables needed by the recipes,
+        # deriving the missing ones (e.g. air density) from the registry
+        cl = iris.cube.CubeList(
+            LazyCubeList(cl, const=const, model=um).extract(required_inputs(vrbl_keys))
+        )
         # Use the cube list to initialise an AtmoSim object
-        runs[sim_label] = AtmoSim(
+        return AtmoSim(
             cl,
             name=sim_label,
             planet=planet,
@@ -545,28 +1165,41 @@ def main(args=None):
             vert_coord="z",
         )
 
-    # Make the figure
-    ncols = len(SIM_LABELS)
-    nrows = len(vrbls_to_show)
-    mosaic = [
-        [
-            i
-            for j in [
-                [f"{vrbl_key}-{sim_label}", f"{vrbl_key}-{sim_label}-cax"]
-                for sim_label in SIM_LABELS
-            ]
-            for i in j
-        ]
-        for vrbl_key in vrbls_to_show
-    ]
-    fig = plt.figure(constrained_layout=True, figsize=(ncols * 8, nrows * 3))
+    # Evaluate the recipes for the whole time series or read them from the cache
+    series = load_series(inp_files, vrbls_to_show, _load_run, logger=L)
 
     if args.one_frame is not None:
         L.info(f"Showing frame {args.one_frame}")
-        _make_frame(args.one_frame)
+        fig = make_figure(vrbls_to_show)
+        draw_frame(fig, args.one_frame, series, vrbls_to_show, add_min_max)
         plt.show()
+    elif args.backend == "reuse":
+        L.info(f"Making {vidname.stem} reusing artists")
+        renderer = ArtistReuseRenderer(series, vrbls_to_show, add_min_max=add_min_max)
+        save_animation_frames(vidname, renderer, frames)
+        L.success(f"Saved to {vidname}")
+    elif args.backend == "raster":
+        L.info(f"Making {vidname.stem} using the raster backend")
+        save_animation_frames(vidname, RasterRenderer(series, vrbls_to_show), frames)
+        L.success(f"Saved to {vidname}")
+    elif args.workers > 1:
+        L.info(f"Making {vidname.stem} using {args.workers} processes")
+        save_animation_parallel(
+            vidname,
+            series,
+            vrbls_to_show,
+            frames,
+            args.workers,
+            add_min_max=add_min_max,
+        )
+        L.success(f"Saved to {vidname}")
     else:
         L.info(f"Making {vidname.stem}")
+        fig = make_figure(vrbls_to_show)
+
+        def _make_frame(it):
+            draw_frame(fig, it, series, vrbls_to_show, add_min_max)
+
         _make_frame(0)
         anim = mpl.animation.FuncAnimation(
             fig, _make_frame, frames=frames, interval=100, blit=False
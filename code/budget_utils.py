@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""Common utilities for the budget calculations."""
+from copy import copy
+
+from cached_property import cached_property
+import dask.array as da
+import numpy as np
+
+from aeolus.coord import isel
+
+__all__ = (
+    "as_lazy",
+    "collapsed_template",
+    "compute_cubes",
+    "load_time_chunk",
+    "uncached_copy",
+)
+
+
+def as_lazy(cube, chunks=None):
+    """
+    Make sure that the cube data are a dask array.
+
+    Parameters
+    ----------
+    cube: iris.cube.Cube
+        Input cube.
+    chunks: int or tuple or str, optional
+        Chunks of the dask array. If not given, lazy data are left as they are
+        and real data are wrapped using "auto" chunks.
+
+    Returns
+    -------
+    iris.cube.Cube
+        Cube with lazy data. No data are copied.
+    """
+    if cube.has_lazy_data():
+        if chunks is None:
+            return cube
+        return cube.copy(data=cube.lazy_data().rechunk(chunks))
+    return cube.copy(data=da.from_array(cube.data, chunks=chunks or "auto"))
+
+
+def compute_cubes(cubes):
+    """
+    Realise the data of several lazy cubes in a single dask computation.
+
+    Shared parts of the task graphs are evaluated only once.
+    The cubes are modified in place.
+
+    Parameters
+    ----------
+    cubes: iterable of iris.cube.Cube
+        Cubes to compute.
+    """
+    lazy_cubes = [cube for cube in cubes if cube.has_lazy_data()]
+    results = da.compute(*[cube.lazy_data() for cube in lazy_cubes])
+    for cube, data in zip(lazy_cubes, results):
+        cube.data = data
+
+
+def load_time_chunk(cube, t_dim, start, stop):
+    """
+    Load a chunk of cube data along the time dimension as a float64 array.
+
+    Parameters
+    ----------
+    cube: iris.cube.Cube
+        Input cube.
+    t_dim: int or None
+        Index of the time dimension. If None, all the data are loaded.
+    start, stop: int
+        Indices of the chunk along the time dimension.
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of data.
+    """
+    keys = [slice(None)] * cube.ndim
+    if t_dim is not None:
+        keys[t_dim] = slice(start, stop)
+    data = cube.core_data()[tuple(keys)]
+    if isinstance(data, da.Array):
+        data = data.compute()
+    return np.asarray(data, dtype="float64")
+
+
+def collapsed_template(cube, coord, start=0, stop=None):
+    """
+    Make a template cube for the results of a reduction along a dimension.
+
+    Parameters
+    ----------
+    cube: iris.cube.Cube
+        Input cube.
+    coord: str or iris.coords.Coord
+        Coordinate of the dimension to remove.
+    start, stop: int, optional
+        Indices of the subset of the dimension that is reduced.
+
+    Returns
+    -------
+    iris.cube.Cube
+        Cube without the given dimension and with the coordinates along it collapsed.
+        The data are those of the first slice and are meant to be replaced.
+    """
+    dims = cube.coord_dims(coord)
+    tmpl = isel(cube, coord, start)
+    for _coord in cube.coords(dimensions=dims):
+        tmpl.replace_coord(_coord[start:stop].collapsed())
+    return tmpl
+
+
+def uncached_copy(obj):
+    """
+    Make a shallow copy of an object without the values of its cached properties.
+
+    The copy can be given different input fields without affecting the original
+    object, and its cached properties are recalculated from those fields.
+
+    Parameters
+    ----------
+    obj: object
+        Object with attributes in `__dict__`, e.g. an `aeolus.core.AtmoSim`.
+
+    Returns
+    -------
+    object
+        Copy of the object.
+    """
+    new = copy(obj)
+    for cls in type(obj).__mro__:
+        for key, val in vars(cls).items():
+            if isinstance(val, cached_property):
+                new.__dict__.pop(key, None)
+    return new
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Make time-mean products of UM output from partial reductions of raw files."""
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import os
+from pathlib import Path
+from time import time
+
+from tqdm import tqdm
+
+from aeolus.io import save_cubelist
+
+from commons import (
+    GLM_MODEL_TIMESTEP,
+    GLM_RUNID,
+    GLM_SUITE_ID,
+    OPT_LABELS,
+    VAR_PACK_MAIN,
+)
+from ingest_raw_output import find_raw_files, read_raw
+from loaders import input_file
+from pouch.log import create_logger
+from reductions import PartialStats, merge_all
+import mypaths
+
+
+SCRIPT = Path(__file__).name
+
+
+def parse_args(args=None):
+    """Argument parser."""
+    ap = argparse.ArgumentParser(
+        SCRIPT,
+        description=__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        epilog=f"""Usage:
+./{SCRIPT} --opt_labels base --windows 6000_9950 2000_2950 --variance -w 16
+""",
+    )
+    ap.add_argument(
+        "--opt_labels",
+        nargs="+",
+        default=[*OPT_LABELS.keys()],
+        help="Experiment labels",
+        choices=[*OPT_LABELS.keys()],
+    )
+    ap.add_argument(
+        "--windows",
+        nargs="+",
+        required=True,
+        help="Day windows in the form FIRST_LAST, e.g. 6000_9950",
+    )
+    ap.add_argument(
+        "--variance",
+        action="store_true",
+        default=False,
+        help="Also save temporal variances",
+    )
+    ap.add_argument(
+        "--suite_label",
+        type=str,
+        default="grcs",
+        help="Suite label",
+    )
+    ap.add_argument(
+        "--top_label",
+        type=str,
+        default=None,
+        help="Label of the raw output directory"
+        f" (default: {GLM_SUITE_ID}_startswap_<suite_label>)",
+    )
+    ap.add_argument(
+        "--inpdir",
+        type=Path,
+        default=None,
+        help="Directory with raw output of all experiments"
+        " (default: <top_label> in the standalone suites directory)",
+    )
+    ap.add_argument(
+        "--planet",
+        type=str,
+        default="hab1",
+        help="Planet configuration",
+    )
+    ap.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of worker processes",
+    )
+    return ap.parse_args(args)
+
+
+def _parse_window(window):
+    """Convert a string like "6000_9950" to a tuple of days."""
+    first, last = window.split("_")
+    return int(first), int(last)
+
+
+def _record_path(recdir, timestamp, days=None):
+    """Path to the partial reduction of one timestamp, optionally clipped to days."""
+    suffix = "" if days is None else f"_days{days[0]}_{days[1]}"
+    return recdir / f"{GLM_RUNID}_{timestamp:06d}{suffix}.nc"
+
+
+def _missing_days(records, timestamps):
+    """
+    Ranges of days that can be covered by the timestamps without a partial reduction.
+
+    Timestamps are ordered in time, so the days of a missing one are bounded
+    by the last day of the previous reduction and the first day of the next one.
+    """
+    known = [
+        (timestamp, days)
+        for timestamp, (_, days) in sorted(records.items())
+        if days is not None
+    ]
+    ranges = []
+    for timestamp in timestamps:
+        if timestamp in records:
+            continue
+        before = [days[1] for other, days in known if other < timestamp]
+        after = [days[0] for other, days in known if other > timestamp]
+        ranges.append(
+            (
+                before[-1] if before else float("-inf"),
+                after[0] if after else float("inf"),
+            )
+        )
+    return ranges
+
+
+def reduce_one(paths, rec_path, days=None):
+    """
+    Reduce raw files of one timestamp to a partial time reduction.
+
+    Parameters
+    ----------
+    paths: list of pathlib.Path
+        Raw output files of all streams sharing the same timestamp.
+    rec_path: pathlib.Path
+        Path to the partial reduction. If it is newer than all the raw files,
+        it is not recalculated.
+    days: tuple of int, optional
+        First and last day of the time steps to reduce. By default, all of them.
+
+    Returns
+    -------
+    rec_path: pathlib.Path
+        Path to the partial reduction.
+    days: tuple of int
+        First and last day covered by the partial reduction.
+    """
+    if rec_path.exists() and rec_path.stat().st_mtime_ns > max(
+        path.stat().st_mtime_ns for path in paths
+    ):
+        return rec_path, PartialStats.load(rec_path).days
+    names = set(VAR_PACK_MAIN["single_level"] + VAR_PACK_MAIN["multi_level"])
+    record = PartialStats.from_cubes(read_raw(paths, names), days=days)
+    record.save(rec_path)
+    return rec_path, record.days
+
+
+def main(args=None):
+    """Main entry point."""
+    t0 = time()
+    L = create_logger(Path(__file__))
+    # Parse command-line arguments
+    args = parse_args(args)
+    top_label = args.top_label or f"{GLM_SUITE_ID}_startswap_{args.suite_label}"
+    inpdir = args.inpdir or mypaths.sadir / top_label
+    windows = [_parse_window(window) for window in args.windows]
+
+    n_failed = 0
+    for opt_label in args.opt_labels:
+        raw_files = find_raw_files(inpdir / opt_label)
+        if not raw_files:
+            L.warning(f"No raw files for {opt_label=} in {inpdir / opt_label}")
+            continue
+        recdir = mypaths.cachedir / "partial_stats" / top_label / opt_label
+        recdir.mkdir(parents=True, exist_ok=True)
+        L.info(
+            f"Reducing {len(raw_files)} timestamp(s) of {opt_label}"
+            f" using {args.workers} worker(s)"
+        )
+        records = {}
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = {
+                executor.submit(
+                    reduce_one, paths, _record_path(recdir, timestamp)
+                ): timestamp
+                for timestamp, paths in raw_files.items()
+            }
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                timestamp = futures[future]
+                try:
+                    records[timestamp] = future.result()
+                except Exception as e:
+                    L.error(f"Failed for {opt_label=}, {timestamp=}: {e!r}")
+                    n_failed += 1
+
+        gl_attrs = {
+            "name": f"{args.suite_label}_{opt_label}",
+            "planet": args.planet,
+            "timestep": GLM_MODEL_TIMESTEP,
+            "processed": "True",
+        }
+        missing = _missing_days(records, raw_files)
+        # Files fully within a window are used as they are, and the ones crossing
+        # its edges are reduced again using only the time steps within the window
+        selected = {}
+        clipped = {}
+        for window in windows:
+            first, last = window
+            selected[window] = []
+            for timestamp, (rec_path, days) in sorted(records.items()):
+                if days is None or days[1] < first or days[0] > last:
+                    continue
+                if first <= days[0] and days[1] <= last:
+                    selected[window].append((timestamp, rec_path))
+                else:
+                    clipped[(timestamp, window)] = _record_path(
+                        recdir, timestamp, window
+                    )
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = {}
+            for (timestamp, window), rec_path in clipped.items():
+                paths = raw_files[timestamp]
+                future = executor.submit(reduce_one, paths, rec_path, window)
+                futures[future] = (timestamp, window)
+            for future in as_completed(futures):
+                timestamp, window = futures[future]
+                try:
+                    rec_path, _ = future.result()
+                    selected[window].append((timestamp, rec_path))
+                except Exception as e:
+                    L.error(f"Failed for {opt_label=}, {timestamp=}, {window=}: {e!r}")
+                    missing.append(window)
+                    n_failed += 1
+
+        for window in windows:
+            first, last = window
+            if any(lower <= last and upper >= first for lower, upper in missing):
+                L.error(
+                    f"Not saving {opt_label=} for days {first}-{last}:"
+                    " some of its partial reductions are missing"
+                )
+                continue
+            rec_paths = [rec_path for _, rec_path in sorted(selected[window])]
+            if not rec_paths:
+                L.warning(f"No data for {opt_label=} in days {first}-{last}")
+                continue
+            record = merge_all(PartialStats.load(rec_path) for rec_path in rec_paths)
+            cl = record.mean_cubes()
+            if args.variance:
+                cl += record.variance_cubes()
+            fname = input_file(opt_label, time_prof=f"mean_days{first}_{last}")
+            fname.parent.mkdir(parents=True, exist_ok=True)
+            # Replace the product only when it is complete
+            tmp_path = fname.with_suffix(".tmp.nc")
+            save_cubelist(cl, tmp_path, **gl_attrs)
+            tmp_path.replace(fname)
+            L.success(f"Saved to {fname} ({len(rec_paths)} file(s))")
+    if n_failed:
+        L.warning(f"{n_failed} timestamp(s) failed")
+    L.info(f"Execution time: {time() - t0:.1f}s")
+    return n_failed
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Calculate transmission spectra for every output time step."""
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+import os
+from pathlib import Path
+from time import time
+
+import iris
+from tqdm import tqdm
+
+from aeolus.const import init_const
+from aeolus.io import load_data, load_vert_lev, save_cubelist
+from aeolus.model import um
+from aeolus.region import Region
+
+from commons import GLM_SUITE_ID, SIM_LABELS
+from pouch.log import create_logger
+from transmission import TransmissionEngine
+import mypaths
+
+
+SCRIPT = Path(__file__).name
+
+# Transmitted flux diagnostics
+DIAGS = {
+    "cloudy": "m01s01i555",
+    "clear": "m01s01i556",
+    "dry": "m01s01i756",
+}
+
+# Limbs of the terminator ring
+LIMBS = {
+    "west_term": Region(180, 360, -90, 90),
+    "east_term": Region(0, 180, -90, 90),
+}
+
+
+def parse_args(args=None):
+    """Argument parser."""
+    ap = argparse.ArgumentParser(
+        SCRIPT,
+        description=__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        epilog=f"""Usage:
+./{SCRIPT} --sim_labels base sens-t280k -c 50 -w 8
+""",
+    )
+    ap.add_argument(
+        "--sim_labels",
+        nargs="+",
+        default=[*SIM_LABELS.keys()],
+        help="Simulation labels",
+        choices=[*SIM_LABELS.keys()],
+    )
+    ap.add_argument(
+        "--time_prof",
+        type=str,
+        default="synthobs",
+        help="Time profile of the input files",
+    )
+    ap.add_argument(
+        "--spectral_file",
+        type=Path,
+        default=mypaths.home
+        / "spectral"
+        / "trappist1"
+        / "dsa_hybrid"
+        / "sp_sw_280_dsa_trappist1",
+        help="SOCRATES SW spectral file used in the simulations",
+    )
+    ap.add_argument(
+        "--vert_lev_file",
+        type=Path,
+        default=mypaths.home / "vert" / "vertlevs_L38_29t_9s_80km",
+        help="UM vertical levels file",
+    )
+    ap.add_argument(
+        "-c",
+        "--time_chunk",
+        type=int,
+        default=100,
+        help="Number of time steps processed by one task",
+    )
+    ap.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of worker processes",
+    )
+    return ap.parse_args(args)
+
+
+@lru_cache(maxsize=4)
+def _engine(planet, spectral_file, vert_lev_file):
+    """Transmission engine for a planet configuration, shared within a process."""
+    const = init_const(planet, directory=mypaths.constdir)
+    theta_levels = iris.cube.Cube(
+        data=load_vert_lev(vert_lev_file), units="m", long_name="level_height"
+    )
+    stellar_constant_at_1_au = (
+        const.solar_constant
+        * (const.semi_major_axis / iris.cube.Cube(data=1, units="au")) ** 2
+    )
+    return TransmissionEngine(
+        spectral_file,
+        stellar_constant_at_1_au,
+        const.stellar_radius,
+        const.radius + theta_levels[-1],
+    )
+
+
+def calc_chunk(inp_fname, planet, spectral_file, vert_lev_file, start, stop):
+    """
+    Calculate transmission spectra for a range of time steps.
+
+    Parameters
+    ----------
+    inp_fname: pathlib.Path
+        File with the transmitted flux diagnostics.
+    planet: str
+        Planet configuration.
+    spectral_file: pathlib.Path
+        SOCRATES SW spectral file.
+    vert_lev_file: pathlib.Path
+        UM vertical levels file.
+    start, stop: int
+        Indices of the time steps.
+
+    Returns
+    -------
+    dict
+        Cubes of the ratio of the effective planetary radius to the stellar radius
+        of shape (time, band), keyed by the diagnostic and the limb ("full" for
+        the full ring).
+    """
+    engine = _engine(planet, spectral_file, vert_lev_file)
+    cl = load_data(files=inp_fname)
+    trans_fluxes = {}
+    for diag_key, stash in DIAGS.items():
+        cube = cl.extract_cube(stash)
+        (t_dim,) = cube.coord_dims(um.t)
+        keys = [slice(None)] * cube.ndim
+        keys[t_dim] = slice(start, stop)
+        cube = cube[tuple(keys)]
+        cube.units = "W m-2"
+        trans_fluxes[diag_key] = cube
+    spectra = engine.calc_limb_spectra(trans_fluxes, LIMBS)
+    return {
+        (diag_key, limb_key): cube
+        for diag_key, limb_spectra in spectra.items()
+        for limb_key, cube in limb_spectra.items()
+    }
+
+
+def main(args=None):
+    """Main entry point."""
+    t0 = time()
+    L = create_logger(Path(__file__))
+    # Parse command-line arguments
+    args = parse_args(args)
+    inp_dir = mypaths.sadir / f"{GLM_SUITE_ID}_synthobs"
+
+    n_failed = 0
+    for sim_label in args.sim_labels:
+        planet = SIM_LABELS[sim_label]["planet"]
+        inp_fname = inp_dir / f"{GLM_SUITE_ID}_{sim_label}_{args.time_prof}.nc"
+        nt = (
+            load_data(files=inp_fname)
+            .extract_cube(DIAGS["cloudy"])
+            .coord(um.t)
+            .shape[0]
+        )
+        chunks = [
+            (start, min(start + args.time_chunk, nt))
+            for start in range(0, nt, args.time_chunk)
+        ]
+        L.info(
+            f"Calculating spectra for {nt} time steps of {sim_label}"
+            f" in {len(chunks)} chunk(s) using {args.workers} worker(s)"
+        )
+        results = {}
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = {
+                executor.submit(
+                    calc_chunk,
+                    inp_fname,
+                    planet,
+                    args.spectral_file,
+                    args.vert_lev_file,
+                    start,
+                    stop,
+                ): start
+                for start, stop in chunks
+            }
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                start = futures[future]
+                try:
+                    results[start] = future.result()
+                except Exception as e:
+                    L.error(f"Failed for {sim_label=}, {start=}: {e!r}")
+                    n_failed += 1
+        if len(results) < len(chunks):
+            L.warning(f"Not saving {sim_label} because some chunks failed")
+            continue
+
+        # Join the chunks along time and save the spectra as (time, band) arrays
+        cl = iris.cube.CubeList()
+        for key in results[0]:
+            cube = iris.cube.CubeList(
+                [results[start][key] for start in sorted(results)]
+            ).concatenate_cube()
+            cube.rename(f"rp_over_rs_{'_'.join(key)}")
+            cube.attributes["diagnostic"], cube.attributes["limb"] = key
+            cl.append(cube)
+        fname = inp_dir / f"{GLM_SUITE_ID}_{sim_label}_{args.time_prof}_spectra.nc"
+        save_cubelist(
+            cl,
+            fname,
+            name=sim_label,
+            planet=planet,
+            spectral_file=str(args.spectral_file),
+        )
+        L.success(f"Saved to {fname}")
+    if n_failed:
+        L.warning(f"{n_failed} chunk(s) failed")
+    L.info(f"Execution time: {time() - t0:.1f}s")
+    return n_failed
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -8,6 +8,8 @@ from aeolus.subset import l_range_constr
 
 from pouch import RUNTIME
 
+from regions import CompiledConstraint
+
 RUNTIME.figsave_stamp = False
 
 
@@ -201,18 +203,35 @@ SS_PM15 = Region(-15, 15, -15, 15, "substellar_pm15")
 DAYSIDE = Region(-90, 90, -90, 90, "dayside")
 NIGHTSIDE = Region(90, -90, -90, 90, "nightside")
 
-# Various constraints
-eq_lat = iris.Constraint(**{um.y: lambda x: x.point == 1})
-mid_lat = iris.Constraint(latitude=lambda x: abs(x.point) == 51)
-ss_lon = iris.Constraint(**{um.x: lambda x: x.point == 1.25})
-as_lon = iris.Constraint(**{um.x: lambda x: x.point == 178.75})
-tropics = iris.Constraint(**{um.y: lambda x: abs(x.point) <= 20})
-midlatitudes = iris.Constraint(**{um.y: lambda x: 30 <= abs(x.point) <= 65})
-extratropics = iris.Constraint(**{um.y: lambda x: abs(x.point) >= 30})
-cold_traps = iris.Constraint(
-    **{um.x: lambda y: -160 < y.point < -140, um.y: lambda y: 45 < abs(y.point) < 55}
+# Same grid points as the `cold_traps` constraint, for `regions.regional_means()`
+COLD_TRAPS = [
+    Region(-160, -140, 46, 54, "cold_trap_north"),
+    Region(-160, -140, -54, -46, "cold_trap_south"),
+]
+
+# Various constraints, compiled to indices once per grid
+eq_lat = CompiledConstraint(iris.Constraint(**{um.y: lambda x: x.point == 1}))
+mid_lat = CompiledConstraint(iris.Constraint(latitude=lambda x: abs(x.point) == 51))
+ss_lon = CompiledConstraint(iris.Constraint(**{um.x: lambda x: x.point == 1.25}))
+as_lon = CompiledConstraint(iris.Constraint(**{um.x: lambda x: x.point == 178.75}))
+tropics = CompiledConstraint(iris.Constraint(**{um.y: lambda x: abs(x.point) <= 20}))
+midlatitudes = CompiledConstraint(
+    iris.Constraint(**{um.y: lambda x: 30 <= abs(x.point) <= 65})
+)
+extratropics = CompiledConstraint(
+    iris.Constraint(**{um.y: lambda x: abs(x.point) >= 30})
+)
+cold_traps = CompiledConstraint(
+    iris.Constraint(
+        **{
+            um.x: lambda y: -160 < y.point < -140,
+            um.y: lambda y: 45 < abs(y.point) < 55,
+        }
+    )
+)
+troposphere = CompiledConstraint(l_range_constr(0, 17))
+free_troposphere = CompiledConstraint(l_range_constr(3, 18))
+upper_troposphere = CompiledConstraint(l_range_constr(7, 13))
+spinup = CompiledConstraint(
+    iris.Constraint(**{um.fcst_prd: lambda x: x.point <= 500 * 24})
 )
-troposphere = l_range_constr(0, 17)
-free_troposphere = l_range_constr(3, 18)
-upper_troposphere = l_range_constr(7, 13)
-spinup = iris.Constraint(**{um.fcst_prd: lambda x: x.point <= 500 * 24})
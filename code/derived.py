@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""Derived variables calculated on demand when first extracted from a cube list."""
+import warnings
+
+import iris
+
+from aeolus.calc import (
+    air_density,
+    air_potential_temperature,
+    air_temperature,
+    geopotential_height,
+)
+from aeolus.const import add_planet_conf_to_cubes
+from aeolus.io import save_cubelist
+from aeolus.model import um
+
+from pouch.clim_diag import calc_derived_cubes
+
+__all__ = (
+    "DERIVED",
+    "LazyCubeList",
+    "LazyFieldsMixin",
+    "attach_derived",
+    "register_derived",
+)
+
+# Registry of derived variables: name -> (names of dependencies, function)
+DERIVED = {}
+
+
+def register_derived(name, deps):
+    """
+    Register a function calculating a derived variable from other variables.
+
+    The function is called with the dependency cubes as positional arguments
+    and the planetary constants as the `const` keyword argument.
+
+    Parameters
+    ----------
+    name: str
+        Name of the derived variable.
+    deps: list of str
+        Names of variables it is calculated from, themselves possibly derived.
+    """
+
+    def decorator(func):
+        DERIVED[name] = (deps, func)
+        return func
+
+    return decorator
+
+
+@register_derived(um.temp, [um.thta, um.pres])
+def _air_temperature(thta, pres, const=None):
+    return air_temperature(iris.cube.CubeList([thta, pres]), const=const, model=um)
+
+
+@register_derived(um.thta, [um.temp, um.pres])
+def _air_potential_temperature(temp, pres, const=None):
+    return air_potential_temperature(
+        iris.cube.CubeList([temp, pres]), const=const, model=um
+    )
+
+
+@register_derived(um.dens, [um.pres, um.temp])
+def _air_density(pres, temp, const=None):
+    return air_density(iris.cube.CubeList([pres, temp]), const=const, model=um)
+
+
+@register_derived(um.ghgt, [um.thta])
+def _geopotential_height(thta, const=None):
+    return geopotential_height(iris.cube.CubeList([thta]), const=const, model=um)
+
+
+class LazyCubeList(iris.cube.CubeList):
+    """
+    Cube list calculating derived variables the first time they are extracted.
+
+    Variables registered in `DERIVED` are calculated from their dependencies,
+    which are derived recursively if needed, and appended to the list.
+    Other names, e.g. those of coordinates, are passed to the usual extraction.
+    If a cache directory is given, derived variables are saved there and read
+    from there next time instead of being calculated again.
+    All variables known to `pouch.clim_diag.calc_derived_cubes()` can be added
+    at once by calling `derive_all()` explicitly.
+    """
+
+    def __new__(cls, list_of_cubes=None, **kwargs):
+        return super().__new__(cls, list_of_cubes)
+
+    def __init__(
+        self, list_of_cubes=None, const=None, model=um, registry=None, cache_dir=None
+    ):
+        super().__init__(list_of_cubes or [])
+        self.const = const
+        self.model = model
+        self.registry = DERIVED if registry is None else registry
+        self.cache_dir = cache_dir
+        self._pending = set()
+
+    def _has(self, name):
+        return any(cube.name() == name for cube in self)
+
+    def _ensure(self, name):
+        """Make sure that the variable is in the list if it can be derived."""
+        if name not in self.registry or name in self._pending or self._has(name):
+            return
+        cube = self._load_cached(name)
+        if cube is not None:
+            self.append(cube)
+            return
+        deps, func = self.registry[name]
+        # Guard against circular dependencies, e.g. temperature and potential temperature
+        self._pending.add(name)
+        try:
+            for dep in deps:
+                self._ensure(dep)
+            if not all(self._has(dep) for dep in deps):
+                return
+            cube = func(
+                *[super(LazyCubeList, self).extract_cube(dep) for dep in deps],
+                const=self.const,
+            )
+        finally:
+            self._pending.discard(name)
+        cube.rename(name)
+        self.append(cube)
+        self._save_cached(name, cube)
+
+    def _cache_path(self, name):
+        return self.cache_dir / f"{name}.nc"
+
+    def _load_cached(self, name):
+        """Read a derived variable from the cache directory if it is there."""
+        if self.cache_dir is None or not self._cache_path(name).exists():
+            return None
+        cube = iris.load_cube(str(self._cache_path(name)))
+        if self.const is not None:
+            # The planet_conf attribute cannot be saved and is re-attached on load
+            add_planet_conf_to_cubes([cube], self.const)
+        return cube
+
+    def _save_cached(self, name, cube):
+        """Save a derived variable to the cache directory."""
+        if self.cache_dir is None:
+            return
+        path = self._cache_path(name)
+        # Keep the .nc suffix for iris to recognise the format
+        tmp_path = path.with_suffix(".tmp.nc")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            save_cubelist(iris.cube.CubeList([cube]), tmp_path)
+            tmp_path.replace(path)
+        except Exception as e:
+            tmp_path.unlink(missing_ok=True)
+            warnings.warn(f"{name} is not cached in {self.cache_dir}: {e!r}")
+
+    def _ensure_constraints(self, constraints):
+        if isinstance(constraints, str):
+            self._ensure(constraints)
+        elif isinstance(constraints, (list, tuple)):
+            for constraint in constraints:
+                if isinstance(constraint, str):
+                    self._ensure(constraint)
+
+    def derive_all(self):
+        """Add all variables derived by `pouch.clim_diag.calc_derived_cubes()`."""
+        calc_derived_cubes(self, const=self.const, model=self.model)
+        return self
+
+    def extract(self, constraints, *args, **kwargs):
+        self._ensure_constraints(constraints)
+        result = super().extract(constraints, *args, **kwargs)
+        if isinstance(result, iris.cube.CubeList):
+            # Subsets, e.g. a region, can derive variables from their own cubes,
+            # which are not cached on disk
+            result = self.__class__(
+                result, const=self.const, model=self.model, registry=self.registry
+            )
+        return result
+
+    def extract_cube(self, constraint):
+        self._ensure_constraints(constraint)
+        return super().extract_cube(constraint)
+
+    def extract_cubes(self, constraints):
+        self._ensure_constraints(constraints)
+        return super().extract_cubes(constraints)
+
+
+class LazyFieldsMixin:
+    """
+    Mixin for `AtmoSim`-like classes deriving registered fields on attribute access.
+
+    `AtmoSim.__init__()` assigns only the fields present in the cube list,
+    so the missing ones are derived here the first time they are accessed,
+    e.g. `the_run.dens`, and then stored as usual attributes.
+    """
+
+    def __getattr__(self, key):
+        # Only called if the attribute is not found in the usual way
+        cubes = self.__dict__.get("_cubes")
+        model = self.__dict__.get("model")
+        if (
+            isinstance(cubes, LazyCubeList)
+            and key in getattr(model, "__dataclass_fields__", {})
+            and getattr(model, key) in cubes.registry
+        ):
+            cube = cubes.extract_cube(getattr(model, key))
+            self.__dict__[key] = cube
+            self.vars.append(key)
+            return cube
+        raise AttributeError(
+            f"'{self.__class__.__name__}' object has no attribute '{key}'"
+        )
+
+
+# Subclasses of `AtmoSim`-like classes with the mixin, created once per class
+_LAZY_CLASSES = {}
+
+
+def attach_derived(the_run):
+    """
+    Make an `AtmoSim`-like object derive registered variables on demand.
+
+    Call it after the object is created, so that `AtmoSim.__init__()` does not
+    derive all registered variables when looking up the fields.
+
+    Parameters
+    ----------
+    the_run: aeolus.core.AtmoSim
+        Simulation object. Modified in place.
+
+    Returns
+    -------
+    aeolus.core.AtmoSim
+        The same object.
+    """
+    if not isinstance(the_run._cubes, LazyCubeList):
+        the_run._cubes = LazyCubeList(
+            the_run._cubes, const=the_run.const, model=the_run.model
+        )
+    cls = the_run.__class__
+    if not issubclass(cls, LazyFieldsMixin):
+        if cls not in _LAZY_CLASSES:
+            _LAZY_CLASSES[cls] = type(cls.__name__, (LazyFieldsMixin, cls), {})
+        the_run.__class__ = _LAZY_CLASSES[cls]
+    return the_run
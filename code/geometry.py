@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""Geometric factors of model grids shared between calculations on the same grid."""
+import hashlib
+
+from cached_property import cached_property
+from iris.analysis.maths import apply_ufunc
+import numpy as np
+
+from aeolus.coord import area_weights_cube, coord_to_cube, volume_weights_cube
+from aeolus.model import um
+from aeolus.subset import DimConstr
+
+__all__ = ("GridGeometry", "get_grid_geometry")
+
+# Process-wide cache of grid geometries, keyed by the hash of the grid and constants
+_GEOMETRY_CACHE = {}
+
+
+def _grid_hash(cube_yx, cube_z, const, model=um):
+    """Calculate a hash of the horizontal and vertical coordinates and planet constants."""
+    sha = hashlib.sha1()
+    coords = [cube_yx.coord(model.y), cube_yx.coord(model.x)]
+    if cube_z is not None:
+        coords.append(cube_z.coord(model.z))
+    for coord in coords:
+        sha.update(f"{coord.name()} [{coord.units}]".encode())
+        sha.update(np.ascontiguousarray(coord.points, dtype="float64").tobytes())
+    for name in sorted(const.__dataclass_fields__):
+        cube = getattr(const, name)
+        sha.update(f"{name}={float(cube.data)!r} [{cube.units}]".encode())
+    return sha.hexdigest()
+
+
+class GridGeometry:
+    """
+    Geometric factors of a latitude-longitude(-height) grid.
+
+    Trigonometric functions of latitude, powers of the radius and cell area and volume
+    weights are calculated once when first accessed and then reused.
+    Use `get_grid_geometry()` to share the same object between all calculations
+    on the same grid.
+
+    The returned cubes are shared by all users of the object and must not be
+    modified in place, e.g. with `convert_units()` or augmented assignment;
+    make a copy first.
+    """
+
+    def __init__(self, cube_yx, cube_z=None, const=None, model=um):
+        """
+        Instantiate a `GridGeometry` object.
+
+        Parameters
+        ----------
+        cube_yx: iris.cube.Cube
+            Cube with latitude and longitude coordinates.
+        cube_z: iris.cube.Cube, optional
+            Cube with latitude, longitude and height coordinates.
+        const: aeolus.const.const.ConstContainer
+            Planetary constants.
+        model: aeolus.model.Model, optional
+            Model class with relevant coordinate names.
+        """
+        self.const = const
+        self.model = model
+        # Keep only single slices of the input cubes
+        self._cube_yx = next(cube_yx.slices([model.y, model.x]))
+        if cube_z is not None:
+            self._cube_zyx = next(cube_z.slices([model.z, model.y, model.x]))
+        else:
+            self._cube_zyx = None
+        self._radius_pow = {}
+
+    @cached_property
+    def _lat_rad(self):
+        lat_cube = coord_to_cube(self._cube_yx, self.model.y, broadcast=False)
+        return apply_ufunc(np.deg2rad, lat_cube)
+
+    @cached_property
+    def lat_cos(self):
+        out = apply_ufunc(np.cos, self._lat_rad)
+        out.rename("cos(lat)")
+        out.units = "1"
+        return out
+
+    @cached_property
+    def lat_sin(self):
+        out = apply_ufunc(np.sin, self._lat_rad)
+        out.rename("sin(lat)")
+        out.units = "1"
+        return out
+
+    @cached_property
+    def lat_cos_sq(self):
+        out = self.lat_cos**2
+        out.rename("cos(lat)**2")
+        return out
+
+    @cached_property
+    def lat_sin_sq(self):
+        out = self.lat_sin**2
+        out.rename("sin(lat)**2")
+        return out
+
+    @cached_property
+    def coriolis(self):
+        out = 2 * self.const.planet_rotation_rate * self.lat_sin
+        out.rename("coriolis_parameter")
+        out.convert_units("s-1")
+        return out
+
+    @cached_property
+    def radius(self):
+        """Distance from the planet's centre to the model levels."""
+        out = (
+            coord_to_cube(self._cube_zyx, self.model.z, broadcast=False)
+            + self.const.radius
+        )
+        out.rename("planet_radius")
+        out.convert_units("m")
+        return out
+
+    def radius_pow(self, power):
+        """Radius raised to the given power."""
+        if power not in self._radius_pow:
+            out = self.radius**power
+            out.rename(f"planet_radius**{power}")
+            self._radius_pow[power] = out
+        return self._radius_pow[power]
+
+    @cached_property
+    def area_weights(self):
+        """Grid cell areas."""
+        return area_weights_cube(
+            self._cube_yx, r_planet=float(self.const.radius.data), model=self.model
+        )
+
+    @cached_property
+    def volume_weights(self):
+        """Grid cell volumes."""
+        return volume_weights_cube(
+            self._cube_zyx, r_planet=float(self.const.radius.data), model=self.model
+        )
+
+
+def get_grid_geometry(cubes, const, model=um):
+    """
+    Get the geometry of the grid of a cube list from the process-wide cache.
+
+    Parameters
+    ----------
+    cubes: iris.cube.CubeList
+        List of cubes, at least one of which has latitude and longitude coordinates.
+    const: aeolus.const.const.ConstContainer
+        Planetary constants.
+    model: aeolus.model.Model, optional
+        Model class with relevant coordinate names.
+
+    Returns
+    -------
+    GridGeometry
+        Geometry shared by all cube lists on the same grid and with the same constants.
+        Its cubes must not be modified in place.
+    """
+    dim_constr = DimConstr(model=model)
+    cube_yx = cubes.extract(dim_constr.relax.yx)[0]
+    try:
+        cube_z = cubes.extract(dim_constr.relax.zyx)[0]
+    except IndexError:
+        cube_z = None
+    key = _grid_hash(cube_yx, cube_z, const, model=model)
+    if key not in _GEOMETRY_CACHE:
+        _GEOMETRY_CACHE[key] = GridGeometry(cube_yx, cube_z, const=const, model=model)
+    return _GEOMETRY_CACHE[key]
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+"""Helmholtz decomposition and flux divergence with cached spherical harmonic transforms."""
+import hashlib
+
+from cf_units import Unit
+import iris
+from iris.coords import AuxCoord
+import numpy as np
+
+from aeolus.calc import div_h, integrate, meridional_mean
+from aeolus.model import um
+
+__all__ = (
+    "HelmholtzTransform",
+    "flux_div_h_int_v_batch",
+    "get_helmholtz_transform",
+    "wind_rot_div_batch",
+)
+
+# Process-wide cache of transforms, keyed by the hash of the grid, radius and truncation
+_TRANSFORM_CACHE = {}
+
+
+def _transform_key(lats, lons, rsphere, truncation):
+    """Calculate a hash of the horizontal grid, planet radius and truncation."""
+    sha = hashlib.sha1()
+    for points in (lats, lons):
+        sha.update(np.ascontiguousarray(points, dtype="float64").tobytes())
+    sha.update(f"rsphere={rsphere!r},truncation={truncation!r}".encode())
+    return sha.hexdigest()
+
+
+class HelmholtzTransform:
+    """
+    Spherical harmonic transform for the Helmholtz decomposition on a fixed grid.
+
+    The Legendre functions are computed once when the transform is created.
+    Fields of any shape with latitude and longitude dimensions are stacked along
+    the remaining dimensions and decomposed with one forward and two inverse
+    transforms, the same as `windspharm.standard.VectorWind.helmholtz()`.
+    Use `get_helmholtz_transform()` to share the same object between
+    all calculations on the same grid.
+    """
+
+    def __init__(self, lats, lons, rsphere, truncation=None):
+        """
+        Instantiate a `HelmholtzTransform` object.
+
+        Parameters
+        ----------
+        lats: numpy.ndarray
+            Latitudes [degrees] in any order.
+        lons: numpy.ndarray
+            Longitudes [degrees].
+        rsphere: float
+            Planet radius [m].
+        truncation: int, optional
+            Truncation for the spherical harmonic computation.
+        """
+        from spharm import Spharmt
+        from windspharm.tools import inspect_gridtype
+
+        # The transform works with latitudes from north to south
+        self.flip_lat = lats[0] < lats[-1]
+        gridtype = inspect_gridtype(lats[::-1] if self.flip_lat else lats)
+        self.shape = (len(lats), len(lons))
+        self.truncation = truncation
+        self._spharmt = Spharmt(
+            len(lons), len(lats), rsphere=rsphere, gridtype=gridtype, legfunc="stored"
+        )
+
+    def decompose(self, u, v):
+        """
+        Split stacked horizontal vector fields into divergent and rotational parts.
+
+        Parameters
+        ----------
+        u, v: numpy.ndarray
+            Arrays of shape (lat, lon, ...) with latitudes in the original order.
+
+        Returns
+        -------
+        u_div, v_div, u_rot, v_rot: numpy.ndarray
+            Components of the same shape as the input.
+        """
+        extra_shape = u.shape[2:]
+        ugrid = u.reshape(*self.shape, -1)
+        vgrid = v.reshape(*self.shape, -1)
+        if self.flip_lat:
+            ugrid, vgrid = ugrid[::-1], vgrid[::-1]
+        vrtspec, divspec = self._spharmt.getvrtdivspec(
+            ugrid, vgrid, ntrunc=self.truncation
+        )
+        zeros = np.zeros_like(vrtspec)
+        out = [
+            *self._spharmt.getuv(zeros, divspec),
+            *self._spharmt.getuv(vrtspec, zeros),
+        ]
+        if self.flip_lat:
+            out = [arr[::-1] for arr in out]
+        return tuple(arr.reshape(*self.shape, *extra_shape) for arr in out)
+
+    def divergence(self, u, v):
+        """
+        Calculate the divergence of stacked horizontal vector fields.
+
+        Parameters
+        ----------
+        u, v: numpy.ndarray
+            Arrays of shape (lat, lon, ...) with latitudes in the original order.
+
+        Returns
+        -------
+        numpy.ndarray
+            Divergence [units of the input per m] of the same shape as the input.
+        """
+        extra_shape = u.shape[2:]
+        ugrid = u.reshape(*self.shape, -1)
+        vgrid = v.reshape(*self.shape, -1)
+        if self.flip_lat:
+            ugrid, vgrid = ugrid[::-1], vgrid[::-1]
+        _, divspec = self._spharmt.getvrtdivspec(ugrid, vgrid, ntrunc=self.truncation)
+        out = self._spharmt.spectogrd(divspec)
+        if self.flip_lat:
+            out = out[::-1]
+        return out.reshape(*self.shape, *extra_shape)
+
+
+def get_helmholtz_transform(cube, const, truncation=None, model=um):
+    """
+    Get the Helmholtz transform for the grid of a cube from the process-wide cache.
+
+    Parameters
+    ----------
+    cube: iris.cube.Cube
+        Cube with latitude and longitude coordinates.
+    const: aeolus.const.const.ConstContainer
+        Planetary constants.
+    truncation: int, optional
+        Truncation for the spherical harmonic computation.
+    model: aeolus.model.Model, optional
+        Model class with relevant coordinate names.
+
+    Returns
+    -------
+    HelmholtzTransform
+        Transform shared by all calculations on the same grid.
+    """
+    lats = cube.coord(model.y).points
+    lons = cube.coord(model.x).points
+    rsphere = float(const.radius.data)
+    key = _transform_key(lats, lons, rsphere, truncation)
+    if key not in _TRANSFORM_CACHE:
+        _TRANSFORM_CACHE[key] = HelmholtzTransform(
+            lats, lons, rsphere, truncation=truncation
+        )
+    return _TRANSFORM_CACHE[key]
+
+
+def _to_lat_lon_first(cube, model=um):
+    """Data of a cube with latitude and longitude as the leading dimensions."""
+    (y_dim,) = cube.coord_dims(model.y)
+    (x_dim,) = cube.coord_dims(model.x)
+    data = np.asarray(cube.data, dtype="float64")
+    return np.moveaxis(data, (y_dim, x_dim), (0, 1)), (y_dim, x_dim)
+
+
+def wind_rot_div_batch(winds, const=None, truncation=None, opt="separate", model=um):
+    """
+    Split many horizontal wind fields into divergent and rotational parts.
+
+    All fields on the same grid, e.g. all levels, times and simulations,
+    are decomposed as one stacked array, and the spherical harmonic
+    transform of each grid is set up only once per process.
+
+    Parameters
+    ----------
+    winds: dict
+        Tuples of cubes of the eastward and northward wind, and optionally
+        of a weight, e.g. air density. Weighted winds are decomposed,
+        and the components are divided by the weight.
+    const: aeolus.const.const.ConstContainer, optional
+        If not given, constants are retrieved from the attributes of the wind cubes.
+    truncation: int, optional
+        Truncation for the spherical harmonic computation.
+    opt: str, optional
+        How to calculate the rotational component:
+        "separate" - from the spherical harmonic transform;
+        "residual" - as the difference between the total and divergent winds.
+    model: aeolus.model.Model, optional
+        Model class with relevant coordinate names.
+
+    Returns
+    -------
+    dict
+        For every key of `winds`, a dictionary of cubes in the same form as
+        the output of `aeolus.calc.wind_rot_div()`: the input winds ("u_total"),
+        divergent ("u_div") and rotational ("u_rot") components and
+        the zonal mean ("u_rot_zm") and eddy ("u_rot_eddy") rotational components.
+    """
+    if opt not in ["separate", "residual"]:
+        raise ValueError(f"Unknown {opt=}")
+    # Stack the fields on the same grid, keeping the sizes to split them afterwards
+    groups = {}
+    for key, (u, v, *weight) in winds.items():
+        _const = const or u.attributes["planet_conf"]
+        transform = get_helmholtz_transform(
+            u, _const, truncation=truncation, model=model
+        )
+        u_data, dims = _to_lat_lon_first(u, model=model)
+        v_data, _ = _to_lat_lon_first(v, model=model)
+        if weight:
+            w_data, _ = _to_lat_lon_first(weight[0], model=model)
+            u_data, v_data = u_data * w_data, v_data * w_data
+        else:
+            w_data = 1.0
+        groups.setdefault(id(transform), (transform, []))[1].append(
+            (key, u_data, v_data, w_data, dims)
+        )
+
+    results = {}
+    for transform, items in groups.values():
+        extra_shapes = [u_data.shape[2:] for _, u_data, *_ in items]
+        sizes = [int(np.prod(shape)) for shape in extra_shapes]
+        u_stack, v_stack = [
+            np.concatenate(
+                [item[i].reshape(*transform.shape, -1) for item in items], axis=-1
+            )
+            for i in (1, 2)
+        ]
+        cmpnts = transform.decompose(u_stack, v_stack)
+        offsets = np.cumsum([0, *sizes])
+        for (key, _, _, w_data, dims), shape, i0, i1 in zip(
+            items, extra_shapes, offsets[:-1], offsets[1:]
+        ):
+            u, v = winds[key][:2]
+            u_div, v_div, u_rot, v_rot = [
+                np.moveaxis(
+                    arr[..., i0:i1].reshape(*transform.shape, *shape) / w_data,
+                    (0, 1),
+                    dims,
+                )
+                for arr in cmpnts
+            ]
+            out = {"u_total": u, "v_total": v}
+            for cmpnt, tot, div, rot in (
+                ("u", u, u_div, u_rot),
+                ("v", v, v_div, v_rot),
+            ):
+                out[f"{cmpnt}_div"] = tot.copy(data=div.astype(tot.dtype))
+                out[f"{cmpnt}_div"].rename(f"irrotational_{tot.name()}")
+                if opt == "residual":
+                    rot = tot.data - out[f"{cmpnt}_div"].data
+                out[f"{cmpnt}_rot"] = tot.copy(data=rot.astype(tot.dtype))
+                out[f"{cmpnt}_rot"].rename(f"non_divergent_{tot.name()}")
+                # Zonal mean and zonal deviation of the rotational component
+                rot = out[f"{cmpnt}_rot"].data
+                rot_zm = np.broadcast_to(
+                    rot.mean(axis=dims[1], keepdims=True), rot.shape
+                )
+                out[f"{cmpnt}_rot_zm"] = tot.copy(data=rot_zm.copy())
+                out[f"{cmpnt}_rot_zm"].rename(
+                    f"zonal_mean_of_non_divergent_{tot.name()}"
+                )
+                out[f"{cmpnt}_rot_eddy"] = tot.copy(data=rot - rot_zm)
+                out[f"{cmpnt}_rot_eddy"].rename(
+                    f"zonal_deviation_of_non_divergent_{tot.name()}"
+                )
+            results[key] = out
+    return results
+
+
+def _stack_cubes(cubes, name="flux_index"):
+    """Join cubes of the same shape along a new leading dimension."""
+    # Use the metadata of the first cube so that the cubes can be merged
+    tmpl = cubes[0]
+    cl = iris.cube.CubeList()
+    for i, cube in enumerate(cubes):
+        if cube.units != tmpl.units:
+            cube = cube.copy()
+            cube.convert_units(tmpl.units)
+        cube = tmpl.copy(data=cube.core_data())
+        cube.add_aux_coord(AuxCoord(i, long_name=name))
+        cl.append(cube)
+    return cl.merge_cube()
+
+
+def flux_div_h_int_v_batch(
+    scalars,
+    wind_cmpnts,
+    rho=None,
+    wind_keys=("total", "div", "rot"),
+    const=None,
+    truncation=None,
+    div_opt="finite_diff",
+    model=um,
+):
+    """
+    Vertical integrals of the horizontal flux divergence of many scalars and winds.
+
+    Fluxes of all scalars by all wind components are stacked along a new
+    dimension, and the divergence, vertical integral and meridional mean
+    are calculated once for the whole stack. The weighted winds are calculated
+    once and shared between the scalars.
+
+    Parameters
+    ----------
+    scalars: dict
+        Cubes of scalars, e.g. components of the moist static energy.
+    wind_cmpnts: dict
+        Wind components, e.g. the output of `wind_rot_div_batch()`
+        for one simulation.
+    rho: iris.cube.Cube, optional
+        Air density. If given, fluxes are multiplied by it before
+        the divergence is calculated.
+    wind_keys: tuple of str, optional
+        Wind components to use, e.g. "div" for "u_div" and "v_div".
+    const: aeolus.const.const.ConstContainer, optional
+        If not given, constants are retrieved from the attributes of the scalar cubes.
+        Only used if `div_opt="spectral"`.
+    truncation: int, optional
+        Truncation for the spherical harmonic computation.
+    div_opt: str, optional
+        Method to calculate the divergence: "finite_diff" or "spectral".
+    model: aeolus.model.Model, optional
+        Model class with relevant coordinate names.
+
+    Returns
+    -------
+    dict
+        For every key of `scalars`, a dictionary of meridional means of the vertically
+        integrated flux divergence keyed by `wind_keys`.
+    """
+    if div_opt not in ["finite_diff", "spectral"]:
+        raise ValueError(f"Unknown {div_opt=}")
+    # Weighted wind components shared by all scalars
+    winds = {}
+    for wind_key in wind_keys:
+        u, v = wind_cmpnts[f"u_{wind_key}"], wind_cmpnts[f"v_{wind_key}"]
+        if rho is not None:
+            u, v = u * rho, v * rho
+        winds[wind_key] = (u, v)
+    keys = [(key, wind_key) for key in scalars for wind_key in wind_keys]
+    flux_x = _stack_cubes([winds[wind_key][0] * scalars[key] for key, wind_key in keys])
+    flux_y = _stack_cubes([winds[wind_key][1] * scalars[key] for key, wind_key in keys])
+
+    if div_opt == "spectral":
+        _const = const or next(iter(scalars.values())).attributes["planet_conf"]
+        transform = get_helmholtz_transform(
+            flux_x, _const, truncation=truncation, model=model
+        )
+        fx_data, dims = _to_lat_lon_first(flux_x, model=model)
+        fy_data, _ = _to_lat_lon_first(flux_y, model=model)
+        hdiv = flux_y.copy(
+            data=np.moveaxis(transform.divergence(fx_data, fy_data), (0, 1), dims)
+        )
+        hdiv.units = flux_y.units / Unit("m")
+    elif div_opt == "finite_diff":
+        hdiv = div_h(flux_x, flux_y, model=model)
+        hdiv.convert_units(flux_y.units / Unit("m"))
+    out = meridional_mean(integrate(hdiv, model.z), model=model)
+
+    results = {key: {} for key in scalars}
+    for (key, wind_key), cube in zip(keys, out.slices_over("flux_index")):
+        cube.remove_coord("flux_index")
+        results[key][wind_key] = cube
+    return results
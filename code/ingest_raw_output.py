@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Convert raw UM output to consolidated netCDF files."""
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import os
+from pathlib import Path
+import re
+from time import time
+
+import iris
+from iris.exceptions import CoordinateNotFoundError
+from iris.fileformats.netcdf import Saver
+import iris.util
+import numpy as np
+from tqdm import tqdm
+
+from aeolus.model import um
+
+from commons import GLM_FILE_REGEX, GLM_RUNID, GLM_SUITE_ID, OPT_LABELS, VAR_PACK_MAIN
+from pouch.log import create_logger
+import mypaths
+
+
+SCRIPT = Path(__file__).name
+
+# Index of the stream letter in the file name, e.g. "b" in "umglaa.pb000000120_00"
+STREAM_POS = len(GLM_RUNID) + 2
+
+
+def parse_args(args=None):
+    """Argument parser."""
+    ap = argparse.ArgumentParser(
+        SCRIPT,
+        description=__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        epilog=f"""Usage:
+./{SCRIPT} --opt_labels base sens-t280k -w 16
+""",
+    )
+    ap.add_argument(
+        "--opt_labels",
+        nargs="+",
+        default=[*OPT_LABELS.keys()],
+        help="Experiment labels",
+        choices=[*OPT_LABELS.keys()],
+    )
+    ap.add_argument(
+        "--suite_label",
+        type=str,
+        default="grcs",
+        help="Suite label",
+    )
+    ap.add_argument(
+        "--top_label",
+        type=str,
+        default=None,
+        help="Label of the output directory and file prefix"
+        f" (default: {GLM_SUITE_ID}_startswap_<suite_label>)",
+    )
+    ap.add_argument(
+        "--planet",
+        type=str,
+        default="hab1",
+        help="Planet configuration",
+    )
+    ap.add_argument(
+        "--inpdir",
+        type=Path,
+        default=None,
+        help="Directory with raw output of all experiments"
+        " (default: <top_label> in the standalone suites directory)",
+    )
+    ap.add_argument(
+        "--timestamps",
+        nargs=2,
+        type=int,
+        default=None,
+        metavar=("FIRST", "LAST"),
+        help="Range of file timestamps to process (inclusive)",
+    )
+    ap.add_argument(
+        "-c",
+        "--time_chunk",
+        type=int,
+        default=1,
+        help="Number of time steps per netCDF chunk in the output files",
+    )
+    ap.add_argument(
+        "--clean",
+        action="store_true",
+        default=False,
+        help="Remove intermediate files after consolidation",
+    )
+    ap.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of worker processes",
+    )
+    return ap.parse_args(args)
+
+
+def find_raw_files(inpdir, timestamps=None):
+    """
+    Find raw UM output files and group them by their timestamp.
+
+    Parameters
+    ----------
+    inpdir: pathlib.Path
+        Directory with the raw output files of one experiment.
+    timestamps: tuple of int, optional
+        Range of timestamps to include (inclusive).
+
+    Returns
+    -------
+    dict
+        Lists of file paths of all output streams, sorted by timestamp.
+    """
+    regex = re.compile(GLM_FILE_REGEX)
+    groups = {}
+    for path in inpdir.glob(f"{GLM_RUNID}*"):
+        match = regex.fullmatch(path.name)
+        if match is None:
+            continue
+        timestamp = int(match.group("timestamp"))
+        if timestamps is not None and not (timestamps[0] <= timestamp <= timestamps[1]):
+            continue
+        groups.setdefault(timestamp, []).append(path)
+    return {
+        timestamp: sorted(groups[timestamp], key=lambda path: path.name[STREAM_POS])
+        for timestamp in sorted(groups)
+    }
+
+
+def _selected(cube, names):
+    """Check if the cube is one of the selected variables, by name or STASH code."""
+    return cube.name() in names or str(cube.attributes.get("STASH", "")) in names
+
+
+def _promote_time(cube):
+    """Make time a dimension of the cube, so that it can be concatenated."""
+    try:
+        t_coord = cube.coord(um.t)
+    except CoordinateNotFoundError:
+        return cube
+    if cube.coord_dims(t_coord):
+        return cube
+    cube = iris.util.new_axis(cube, t_coord)
+    # The forecast period varies with time too, so it goes along the new dimension
+    if cube.coords(um.fcst_prd, dimensions=()):
+        coord = cube.coord(um.fcst_prd)
+        cube.remove_coord(coord)
+        cube.add_aux_coord(coord, 0)
+    return cube
+
+
+def _part_path(partdir, timestamp):
+    """Path to the intermediate file of one timestamp."""
+    return partdir / f"{GLM_RUNID}_{timestamp:06d}.nc"
+
+
+def read_raw(paths, names):
+    """
+    Read selected variables from raw output files.
+
+    Parameters
+    ----------
+    paths: list of pathlib.Path
+        Raw output files.
+    names: set of str
+        Names or STASH codes of the variables.
+
+    Returns
+    -------
+    iris.cube.CubeList
+        Cubes with time as a dimension.
+    """
+    cl = iris.load(
+        [str(path) for path in paths],
+        iris.Constraint(cube_func=lambda cube: _selected(cube, names)),
+    )
+    return iris.cube.CubeList([_promote_time(cube) for cube in cl])
+
+
+def ingest_one(paths, part_path):
+    """
+    Read selected variables from raw files of one timestamp.
+
+    Parameters
+    ----------
+    paths: list of pathlib.Path
+        Raw output files of all streams sharing the same timestamp.
+    part_path: pathlib.Path
+        Path to the intermediate netCDF file. If it is newer than all the raw
+        files, it is not recreated.
+
+    Returns
+    -------
+    part_path: pathlib.Path
+        Path to the intermediate netCDF file.
+    missing: list of str
+        Selected variables not found in the raw files.
+    """
+    names = set(VAR_PACK_MAIN["single_level"] + VAR_PACK_MAIN["multi_level"])
+    if part_path.exists() and part_path.stat().st_mtime_ns > max(
+        path.stat().st_mtime_ns for path in paths
+    ):
+        cl = iris.load(str(part_path))
+    else:
+        cl = read_raw(paths, names)
+        # Keep the .nc suffix for iris to recognise the format
+        tmp_path = part_path.with_suffix(".tmp.nc")
+        iris.save(cl, str(tmp_path))
+        tmp_path.replace(part_path)
+    found = {cube.name() for cube in cl} | {
+        str(cube.attributes.get("STASH", "")) for cube in cl
+    }
+    return part_path, sorted(names - found)
+
+
+def _day_range(cubelist):
+    """Range of days covered by the cubes, from their forecast period in hours."""
+    fcst_prd = np.concatenate(
+        [
+            cube.coord(um.fcst_prd).points
+            for cube in cubelist
+            if cube.coords(um.fcst_prd)
+        ]
+    )
+    return int(fcst_prd.min() // 24), int(fcst_prd.max() // 24)
+
+
+def consolidate(part_paths, names):
+    """
+    Concatenate selected variables from intermediate files along time.
+
+    Parameters
+    ----------
+    part_paths: list of pathlib.Path
+        Intermediate netCDF files, sorted by time.
+    names: list of str
+        Names of the variables to include.
+
+    Returns
+    -------
+    iris.cube.CubeList
+        Concatenated cubes with lazy data.
+    """
+    names = set(names)
+    return iris.load(
+        [str(path) for path in part_paths],
+        iris.Constraint(cube_func=lambda cube: _selected(cube, names)),
+    ).concatenate()
+
+
+def save_chunked(cubelist, fname, time_chunk=1, **gl_attrs):
+    """
+    Save cubes to a compressed netCDF file chunked along time.
+
+    Cubes are written one by one, and their lazy data are streamed to the file,
+    so that the whole time series is not held in memory.
+
+    Parameters
+    ----------
+    cubelist: iris.cube.CubeList
+        Cubes to save.
+    fname: pathlib.Path
+        Path to the output file.
+    time_chunk: int, optional
+        Number of time steps per netCDF chunk.
+    **gl_attrs: dict, optional
+        Global attributes of the output file.
+    """
+    tmp_path = fname.with_suffix(".nc.tmp")
+    with Saver(str(tmp_path), "NETCDF4") as saver:
+        for cube in cubelist:
+            chunksizes = [*cube.shape]
+            t_dims = cube.coord_dims(um.t) if cube.coords(um.t) else ()
+            if t_dims:
+                chunksizes[t_dims[0]] = min(time_chunk, cube.shape[t_dims[0]])
+            saver.write(
+                cube,
+                unlimited_dimensions=[um.t],
+                chunksizes=chunksizes,
+                zlib=True,
+                complevel=1,
+            )
+        saver.update_global_attributes(gl_attrs)
+    tmp_path.replace(fname)
+
+
+def main(args=None):
+    """Main entry point."""
+    t0 = time()
+    L = create_logger(Path(__file__))
+    # Parse command-line arguments
+    args = parse_args(args)
+    top_label = args.top_label or f"{GLM_SUITE_ID}_startswap_{args.suite_label}"
+    inpdir = args.inpdir or mypaths.sadir / top_label
+    outdir = mypaths.sadir / top_label
+
+    n_failed = 0
+    for opt_label in args.opt_labels:
+        sim_label = f"{args.suite_label}_{opt_label}"
+        raw_files = find_raw_files(inpdir / opt_label, timestamps=args.timestamps)
+        if not raw_files:
+            L.warning(f"No raw files for {opt_label=} in {inpdir / opt_label}")
+            continue
+        partdir = outdir / f"{top_label}_{opt_label}_parts"
+        partdir.mkdir(parents=True, exist_ok=True)
+        L.info(
+            f"Reading {len(raw_files)} timestamp(s) of {opt_label}"
+            f" using {args.workers} worker(s)"
+        )
+        part_paths = {}
+        missing = set()
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = {
+                executor.submit(
+                    ingest_one, paths, _part_path(partdir, timestamp)
+                ): timestamp
+                for timestamp, paths in raw_files.items()
+            }
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                timestamp = futures[future]
+                try:
+                    part_path, part_missing = future.result()
+                except Exception as e:
+                    L.error(f"Failed for {opt_label=}, {timestamp=}: {e!r}")
+                    n_failed += 1
+                else:
+                    part_paths[timestamp] = part_path
+                    missing.update(part_missing)
+        if missing:
+            L.warning(f"Not found in the raw files of {opt_label}: {sorted(missing)}")
+        if len(part_paths) < len(raw_files):
+            L.warning(f"Not consolidating {opt_label} because some timestamps failed")
+            continue
+
+        part_paths = [part_paths[timestamp] for timestamp in sorted(part_paths)]
+        gl_attrs = {"name": sim_label, "planet": args.planet, "processed": "False"}
+        for group, names in VAR_PACK_MAIN.items():
+            cl = consolidate(
+                part_paths, [name for name in names if name not in missing]
+            )
+            day_first, day_last = _day_range(cl)
+            fname = (
+                outdir
+                / f"{top_label}_{opt_label}_days{day_first}_{day_last}_{group}.nc"
+            )
+            save_chunked(cl, fname, time_chunk=args.time_chunk, **gl_attrs)
+            L.success(f"Saved to {fname}")
+        if args.clean:
+            for part_path in part_paths:
+                part_path.unlink()
+            partdir.rmdir()
+    if n_failed:
+        L.warning(f"{n_failed} timestamp(s) failed")
+    L.info(f"Execution time: {time() - t0:.1f}s")
+    return n_failed
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,62 +1,405 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """Interpolate UM output to pressure levels."""
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+import json
+import os
+from pathlib import Path
+from time import time
+
+import iris
+from iris.exceptions import CoordinateNotFoundError
+import netCDF4
 import numpy as np
 from tqdm import tqdm
 
 from aeolus.const import add_planet_conf_to_cubes, init_const
-from aeolus.coord import interp_cubelist_from_height_to_pressure_levels
 from aeolus.io import load_data, save_cubelist
 from aeolus.model import um
 
-from commons import GLM_SUITE_ID  # , OPT_LABELS, SUITE_LABELS
+from commons import GLM_SUITE_ID, OPT_LABELS
 from pouch.clim_diag import calc_derived_cubes
+from pouch.log import create_logger
+import vert_interp
+from vert_interp import interp_cubelist_to_pressure_levels
 import mypaths
 
 
+SCRIPT = Path(__file__).name
+
 P_LEVELS = np.arange(950, 0, -50) * 1e2
 
-time_prof = "mean_days6000_9950"
-planet = "hab1"
-suite_label = "grcs"
+VRBLS = [um.u, um.v, um.w, um.dens, um.temp, um.ghgt, um.sh, um.pres]
 
-top_label = f"{GLM_SUITE_ID}_startswap_{suite_label}"
-const = init_const(planet, directory=mypaths.constdir)
-procdir = mypaths.sadir / top_label
-for opt_label in tqdm(["base"], leave=False):
-    # sim_label = f"{suite_label}_{opt_label}"
-    sim_label = f"{suite_label}_{opt_label}"
-    # if sim_label in ["grcs_sens-noradcld"]:
-    #     time_prof = "mean_days2000_2200"
-    # else:
-    #     time_prof = "mean_days2000_2950"
-    cl = load_data(
-        files=procdir / f"{top_label}_{opt_label}_{time_prof}.nc",
+
+def parse_args(args=None):
+    """Argument parser."""
+    ap = argparse.ArgumentParser(
+        SCRIPT,
+        description=__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        epilog=f"""Usage:
+./{SCRIPT} --opt_labels base sens-t280k --time_profs mean_days6000_9950 -w 4
+""",
+    )
+    ap.add_argument(
+        "--opt_labels",
+        nargs="+",
+        default=[*OPT_LABELS.keys()],
+        help="Experiment labels",
+        choices=[*OPT_LABELS.keys()],
+    )
+    ap.add_argument(
+        "--time_profs",
+        nargs="+",
+        default=["mean_days6000_9950"],
+        help="Time profiles of the input files",
+    )
+    ap.add_argument(
+        "--suite_label",
+        type=str,
+        default="grcs",
+        help="Suite label",
     )
+    ap.add_argument(
+        "--top_label",
+        type=str,
+        default=None,
+        help="Label of the input directory and file prefix"
+        f" (default: {GLM_SUITE_ID}_startswap_<suite_label>)",
+    )
+    ap.add_argument(
+        "--planet",
+        type=str,
+        default="hab1",
+        help="Planet configuration",
+    )
+    ap.add_argument(
+        "-c",
+        "--time_chunk",
+        type=int,
+        default=None,
+        help="Number of time steps interpolated at once. If not given,"
+        " all time steps are processed at once",
+    )
+    ap.add_argument(
+        "--force",
+        action="store_true",
+        default=False,
+        help="Recreate the output files even if they are up to date",
+    )
+    ap.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of worker processes",
+    )
+    return ap.parse_args(args)
+
+
+def _time_dim(cube):
+    """Index of the time dimension of a cube or None if time is not a dimension."""
+    try:
+        dims = cube.coord_dims(um.t)
+    except CoordinateNotFoundError:
+        return None
+    return dims[0] if dims else None
+
+
+def _time_slice(cubelist, start, stop):
+    """Select a range of time indices from all cubes that have a time dimension."""
+    out = iris.cube.CubeList()
+    for cube in cubelist:
+        t_dim = _time_dim(cube)
+        if t_dim is None:
+            out.append(cube)
+        else:
+            keys = [slice(None)] * cube.ndim
+            keys[t_dim] = slice(start, stop)
+            out.append(cube[tuple(keys)])
+    return out
+
+
+def _interpolate(cl, const):
+    """Derive the required fields and interpolate them to pressure levels."""
     add_planet_conf_to_cubes(cl, const)
     # Derive additional fields
     calc_derived_cubes(cl, const=const, model=um)
-    # Use the cube list to initialise an AtmoSim object
-    cl_p = interp_cubelist_from_height_to_pressure_levels(
-        cl.extract(
-            [
-                um.u,
-                um.v,
-                um.w,
-                um.dens,
-                um.temp,
-                um.ghgt,
-                um.sh,
-                um.pres,
-            ]
-        ),
-        levels=P_LEVELS,
-    )
+    return interp_cubelist_to_pressure_levels(cl.extract(VRBLS), levels=P_LEVELS)
+
+
+def _save_first_chunk(cl_p, fname, **gl_attrs):
+    """Save cubes to a new netCDF file with an unlimited time dimension."""
+    for cube in cl_p:
+        cube.attributes.update(gl_attrs)
+        # The constants container cannot be saved to netCDF
+        cube.attributes.pop("planet_conf", None)
+        cube.var_name = cube.var_name or cube.name()
+        t_dim = _time_dim(cube)
+        if t_dim is not None:
+            # Fix the names of time-dependent variables to find them when appending
+            for coord in cube.coords(dimensions=t_dim):
+                coord.var_name = coord.var_name or coord.name()
+    iris.save(cl_p, str(fname), unlimited_dimensions=[um.t])
+
+
+def _append_chunk(cl_p, fname):
+    """Append cubes to the time dimension of an existing netCDF file."""
+    with netCDF4.Dataset(fname, "a") as ds:
+        t_name = cl_p[0].coord(um.t).var_name or um.t
+        t_start = ds.dimensions[t_name].size
+        written = set()
+        for cube in cl_p:
+            t_dim = _time_dim(cube)
+            if t_dim is None:
+                continue
+            items = [(cube.var_name or cube.name(), cube.data, t_dim)]
+            for coord in cube.coords(dimensions=t_dim):
+                var_name = coord.var_name or coord.name()
+                items.append((var_name, coord.points, 0))
+                if coord.has_bounds():
+                    items.append((ds[var_name].bounds, coord.bounds, 0))
+            for var_name, data, dim in items:
+                if var_name in written:
+                    continue
+                keys = [slice(None)] * data.ndim
+                keys[dim] = slice(t_start, t_start + data.shape[dim])
+                ds[var_name][tuple(keys)] = data
+                written.add(var_name)
+
+
+def _file_hash(path, block_size=2**24):
+    """SHA-1 hash of the file contents."""
+    sha = hashlib.sha1()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _code_version():
+    """SHA-1 hash of the code that produces the output files."""
+    sha = hashlib.sha1()
+    for path in sorted([__file__, vert_interp.__file__]):
+        sha.update(Path(path).read_bytes())
+    return sha.hexdigest()
+
+
+def _time_points_hash(points):
+    """SHA-1 hash of time coordinate points."""
+    return hashlib.sha1(np.ascontiguousarray(points, dtype="float64")).hexdigest()
+
+
+def _time_slice_hash(cubelist, index):
+    """SHA-1 hash of the data of all time-dependent cubes at one time index."""
+    sha = hashlib.sha1()
+    cubes = _time_slice(cubelist, index, index + 1)
+    for cube in sorted(cubes, key=lambda cube: cube.name()):
+        if _time_dim(cube) is None:
+            continue
+        sha.update(cube.name().encode())
+        sha.update(np.ascontiguousarray(np.ma.getdata(cube.data)).tobytes())
+    return sha.hexdigest()
+
+
+def _manifest_path(fname):
+    """Path to the manifest describing how an output file was made."""
+    return fname.with_suffix(".json")
+
+
+def _read_manifest(fname):
+    """Read the manifest of an output file if both exist."""
+    path = _manifest_path(fname)
+    if not (fname.exists() and path.exists()):
+        return None
+    with path.open("r") as fp:
+        return json.load(fp)
+
+
+def _write_manifest(fname, manifest):
+    """Write the manifest of an output file, replacing the old one atomically."""
+    path = _manifest_path(fname)
+    tmp_path = path.with_suffix(".json.tmp")
+    with tmp_path.open("w") as fp:
+        json.dump(manifest, fp, indent=2)
+    tmp_path.replace(path)
+
+
+def interpolate_one(
+    opt_label,
+    time_prof,
+    top_label,
+    suite_label,
+    planet,
+    time_chunk=None,
+    force=False,
+):
+    """
+    Interpolate one file of processed UM output to pressure levels.
+
+    The output file is accompanied by a manifest recording the state of the input
+    file, the pressure levels and the code version. If none of them has changed,
+    the output is left as it is. If the input file has only gained new time steps,
+    and the data of the last old time step are unchanged, only the new ones
+    are interpolated and appended to the output file.
+
+    Parameters
+    ----------
+    opt_label: str
+        Experiment label.
+    time_prof: str
+        Time profile of the input file.
+    top_label: str
+        Label of the input directory and file prefix.
+    suite_label: str
+        Suite label.
+    planet: str
+        Planet configuration.
+    time_chunk: int, optional
+        Number of time steps interpolated at once. If the input data have
+        a time dimension, the output file is written chunk by chunk, so that
+        only one chunk is held in memory. By default, all time steps at once.
+    force: bool, optional
+        Recreate the output file even if it is up to date.
+
+    Returns
+    -------
+    fname: pathlib.Path
+        Path to the output file.
+    status: str
+        What was done: "created", "appended" or "skipped".
+    """
+    procdir = mypaths.sadir / top_label
+    sim_label = f"{suite_label}_{opt_label}"
+    inp_fname = procdir / f"{top_label}_{opt_label}_{time_prof}.nc"
+    fname = procdir / f"{top_label}_{opt_label}_{time_prof}_plev.nc"
+
+    stat = inp_fname.stat()
+    manifest = {
+        "input": str(inp_fname),
+        "input_size": stat.st_size,
+        "input_mtime_ns": stat.st_mtime_ns,
+        "input_sha1": None,
+        "levels": P_LEVELS.tolist(),
+        "variables": [*VRBLS],
+        "code_version": _code_version(),
+        "appendable": False,
+        "n_times": None,
+        "time_sha1": None,
+        "last_time_sha1": None,
+    }
+    old = None if force else _read_manifest(fname)
+    if old is not None and any(
+        old[key] != manifest[key] for key in ("levels", "variables", "code_version")
+    ):
+        old = None
+    if old is not None and all(
+        old[key] == manifest[key] for key in ("input_size", "input_mtime_ns")
+    ):
+        return fname, "skipped"
+    # The input file has been touched, so compare its contents
+    manifest["input_sha1"] = _file_hash(inp_fname)
+    if old is not None and old["input_sha1"] == manifest["input_sha1"]:
+        old.update(input_size=stat.st_size, input_mtime_ns=stat.st_mtime_ns)
+        _write_manifest(fname, old)
+        return fname, "skipped"
+    # Invalidate the manifest until the output file is complete
+    _manifest_path(fname).unlink(missing_ok=True)
+
+    const = init_const(planet, directory=mypaths.constdir)
+    cl = load_data(files=inp_fname)
     gl_attrs = {
         "name": sim_label,
         "planet": planet,
         "timestep": cl[0].attributes["timestep"],
         "processed": "True",
     }
-    fname = procdir / f"{top_label}_{opt_label}_{time_prof}_plev.nc"
-    save_cubelist(cl_p, fname, **gl_attrs)
+    t_dims = [_time_dim(cube) for cube in cl]
+    if all(t_dim is None for t_dim in t_dims):
+        cl_p = _interpolate(cl, const)
+        save_cubelist(cl_p, fname, **gl_attrs)
+        _write_manifest(fname, manifest)
+        return fname, "created"
+
+    t_points = next(
+        cube.coord(um.t).points for cube, t_dim in zip(cl, t_dims) if t_dim is not None
+    )
+    nt = len(t_points)
+    manifest["n_times"] = nt
+    manifest["time_sha1"] = _time_points_hash(t_points)
+    manifest["last_time_sha1"] = _time_slice_hash(cl, nt - 1)
+    # Append only if the old output covers an unchanged initial part of the input:
+    # the same time points and the same data at the last of them
+    t_start = 0
+    if (
+        old is not None
+        and old["appendable"]
+        and old["n_times"] < nt
+        and old["time_sha1"] == _time_points_hash(t_points[: old["n_times"]])
+        and old.get("last_time_sha1") == _time_slice_hash(cl, old["n_times"] - 1)
+    ):
+        t_start = old["n_times"]
+    time_chunk = time_chunk or nt - t_start
+    for start in range(t_start, nt, time_chunk):
+        cl_p = _interpolate(_time_slice(cl, start, start + time_chunk), const)
+        if start == 0:
+            _save_first_chunk(cl_p, fname, **gl_attrs)
+        else:
+            _append_chunk(cl_p, fname)
+    manifest["appendable"] = True
+    _write_manifest(fname, manifest)
+    return fname, "appended" if t_start > 0 else "created"
+
+
+def main(args=None):
+    """Main entry point."""
+    t0 = time()
+    L = create_logger(Path(__file__))
+    # Parse command-line arguments
+    args = parse_args(args)
+    top_label = args.top_label or f"{GLM_SUITE_ID}_startswap_{args.suite_label}"
+
+    tasks = [
+        (opt_label, time_prof)
+        for opt_label in args.opt_labels
+        for time_prof in args.time_profs
+    ]
+    L.info(f"Interpolating {len(tasks)} file(s) using {args.workers} worker(s)")
+    failed = []
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            executor.submit(
+                interpolate_one,
+                opt_label,
+                time_prof,
+                top_label,
+                args.suite_label,
+                args.planet,
+                time_chunk=args.time_chunk,
+                force=args.force,
+            ): (opt_label, time_prof)
+            for (opt_label, time_prof) in tasks
+        }
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            opt_label, time_prof = futures[future]
+            try:
+                fname, status = future.result()
+            except Exception as e:
+                L.error(f"Failed for {opt_label=}, {time_prof=}: {e!r}")
+                failed.append((opt_label, time_prof))
+            else:
+                if status == "skipped":
+                    L.info(f"Up to date: {fname}")
+                else:
+                    L.success(f"Saved to {fname} ({status})")
+    if failed:
+        L.warning(f"{len(failed)} of {len(tasks)} task(s) failed: {failed}")
+    L.info(f"Execution time: {time() - t0:.1f}s")
+    return len(failed)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""Loading processed model output shared between notebooks and scripts."""
+from functools import lru_cache
+import hashlib
+import warnings
+
+import iris
+
+from aeolus.const import add_planet_conf_to_cubes, init_const
+from aeolus.core import AtmoSim
+from aeolus.io import load_data, save_cubelist
+from aeolus.model import um
+
+from commons import GLM_SUITE_ID, SIM_LABELS
+from derived import LazyCubeList, attach_derived
+from regions import regional_cubes, regional_means
+from pouch.clim_diag import calc_derived_cubes
+import mypaths
+
+__all__ = (
+    "input_file",
+    "load_cubes",
+    "load_regional_cubes",
+    "load_regional_means",
+    "load_run",
+    "mean_time_prof",
+)
+
+# Increment to invalidate the on-disk cache of derived fields
+DERIVED_CACHE_VERSION = 1
+
+# Default time profiles of the spin-up output
+SPINUP_TIME_PROF = "mean_days0_499"
+
+# Experiments run for longer than the others
+LONG_RUNS = ["base", "sens-llcs_all_rain", "sens-startswap"]
+
+
+def mean_time_prof(sim_label):
+    """Time profile of the time-mean output of the given experiment."""
+    if sim_label in LONG_RUNS:
+        return "mean_days6000_9950"
+    elif sim_label == "sens-noradcld":
+        return "mean_days2000_2200"
+    else:
+        return "mean_days2000_2950"
+
+
+def _planet(sim_label):
+    return SIM_LABELS.get(sim_label, SIM_LABELS["base"])["planet"]
+
+
+def input_file(sim_label, time_prof=None, kind="mean", vert_coord="z"):
+    """
+    Path to a file of processed model output.
+
+    Parameters
+    ----------
+    sim_label: str
+        Experiment label.
+    time_prof: str, optional
+        Time profile. By default, `mean_time_prof()` for the "mean" output
+        and `SPINUP_TIME_PROF` for the "spinup" output.
+    kind: str, optional
+        Kind of output: "mean" or "spinup".
+    vert_coord: str, optional
+        Vertical coordinate: "z" for model levels or "p" for pressure levels.
+
+    Returns
+    -------
+    pathlib.Path
+        Path to the file.
+    """
+    if time_prof is None:
+        time_prof = mean_time_prof(sim_label) if kind == "mean" else SPINUP_TIME_PROF
+    suffix = "_plev" if vert_coord == "p" else ""
+    return (
+        mypaths.sadir
+        / f"{GLM_SUITE_ID}_{kind}"
+        / f"{GLM_SUITE_ID}_{sim_label}_{time_prof}{suffix}.nc"
+    )
+
+
+def _derived_cache_path(fname, planet):
+    """Path to the cached derived fields, keyed by the state of the input file."""
+    stat = fname.stat()
+    sha = hashlib.sha1(
+        f"{fname}:{stat.st_size}:{stat.st_mtime_ns}:{planet}:{DERIVED_CACHE_VERSION}".encode()
+    )
+    return mypaths.cachedir / "derived" / f"{fname.stem}__{sha.hexdigest()[:16]}.nc"
+
+
+def _load_derived(fname, planet):
+    """Load a file, derive additional fields and save them to the on-disk cache."""
+    const = init_const(planet, directory=mypaths.constdir)
+    cache_path = _derived_cache_path(fname, planet)
+    if cache_path.exists():
+        cl = load_data(files=cache_path)
+        add_planet_conf_to_cubes(cl, const)
+        return cl
+    cl = load_data(files=fname)
+    add_planet_conf_to_cubes(cl, const)
+    # Derive additional fields
+    calc_derived_cubes(cl, const=const, model=um)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # Keep the .nc suffix for iris to recognise the format
+    tmp_path = cache_path.with_suffix(".tmp.nc")
+    try:
+        # The planet_conf attribute cannot be saved and is re-attached on load
+        save_cubelist(cl, tmp_path)
+        tmp_path.replace(cache_path)
+    except Exception as e:
+        tmp_path.unlink(missing_ok=True)
+        warnings.warn(f"Derived fields of {fname} are not cached: {e!r}")
+    return cl
+
+
+@lru_cache(maxsize=32)
+def load_cubes(sim_label, time_prof=None, kind="mean", vert_coord="z", derive="lazy"):
+    """
+    Load a cube list of processed model output.
+
+    Results are memoised in the current process. Derived fields are also cached
+    on disk, so they are calculated once per version of the input file:
+    all of them at once with eager derivation, or each of them the first time
+    it is extracted with lazy derivation. The returned cube list is shared
+    between callers and should not be modified.
+
+    Parameters
+    ----------
+    sim_label: str
+        Experiment label.
+    time_prof: str, optional
+        Time profile, see `input_file()`.
+    kind: str, optional
+        Kind of output: "mean" or "spinup".
+    vert_coord: str, optional
+        Vertical coordinate: "z" for model levels or "p" for pressure levels.
+    derive: bool or str, optional
+        How to derive additional fields on model levels. If "lazy", return
+        a `derived.LazyCubeList` calculating the registered ones when first extracted.
+        If True, use `pouch.clim_diag.calc_derived_cubes()` for all of them
+        at once. If False, do not derive them.
+
+    Returns
+    -------
+    iris.cube.CubeList
+        Cube list.
+    """
+    fname = input_file(sim_label, time_prof=time_prof, kind=kind, vert_coord=vert_coord)
+    planet = _planet(sim_label)
+    if vert_coord != "z":
+        return load_data(files=fname)
+    if derive is True:
+        return _load_derived(fname, planet)
+    const = init_const(planet, directory=mypaths.constdir)
+    cl = load_data(files=fname)
+    if derive == "lazy":
+        cache_dir = _derived_cache_path(fname, planet).with_suffix("")
+        cl = LazyCubeList(cl, const=const, model=um, cache_dir=cache_dir)
+    add_planet_conf_to_cubes(cl, const)
+    return cl
+
+
+@lru_cache(maxsize=32)
+def load_run(
+    sim_label, time_prof=None, kind="mean", vert_coord="z", derive="lazy", cls=AtmoSim
+):
+    """
+    Load processed model output into an `AtmoSim`-like object.
+
+    Results are memoised in the current process, so that notebooks
+    and scripts can share objects and their cached properties. The returned object
+    is shared between callers, so its fields should not be replaced; methods
+    that calculate budgets with other inputs, e.g. `compute_lazy()`
+    or `stream_periods()`, work on copies.
+
+    Parameters
+    ----------
+    sim_label: str
+        Experiment label.
+    time_prof: str, optional
+        Time profile, see `input_file()`.
+    kind: str, optional
+        Kind of output: "mean" or "spinup".
+    vert_coord: str, optional
+        Vertical coordinate: "z" for model levels or "p" for pressure levels.
+        It is also passed to `cls`, so runs on model levels are created with
+        `vert_coord="z"` and have the height coordinate in `the_run.coord`.
+    derive: bool or str, optional
+        How to derive additional fields, see `load_cubes()`. If "lazy",
+        registered fields missing from the file, e.g. `the_run.dens`,
+        are derived when first accessed.
+    cls: type, optional
+        Subclass of `aeolus.core.AtmoSim`, e.g. a budget class.
+
+    Returns
+    -------
+    aeolus.core.AtmoSim
+        Instance of `cls`.
+    """
+    cl = load_cubes(
+        sim_label, time_prof=time_prof, kind=kind, vert_coord=vert_coord, derive=derive
+    )
+    # Create the object from a plain list, so that the derived fields are not
+    # calculated when `AtmoSim` looks up its fields, and attach laziness afterwards
+    the_run = cls(
+        iris.cube.CubeList(cl),
+        name=sim_label,
+        planet=_planet(sim_label),
+        const_dir=mypaths.constdir,
+        timestep=cl[0].attributes["timestep"],
+        model=um,
+        vert_coord=vert_coord,
+    )
+    if isinstance(cl, LazyCubeList):
+        the_run._cubes = cl
+        attach_derived(the_run)
+    return the_run
+
+
+def load_regional_means(sim_label, names, regions, time_profs, kind="mean"):
+    """
+    Load area-weighted means over regions, reading only their data from disk.
+
+    Each variable is read from the first of the files that contains it,
+    so that variables spread over several files, e.g. the radiative diagnostics
+    and the main output, can be loaded together.
+
+    Parameters
+    ----------
+    sim_label: str
+        Experiment label.
+    names: list of str
+        Names of variables, see `regions.regional_means()`.
+    regions: aeolus.region.Region or list of aeolus.region.Region
+        Region or several non-overlapping regions averaged together.
+    time_profs: list of str
+        Time profiles of the files to look for the variables in, see `input_file()`.
+    kind: str, optional
+        Kind of output: "mean" or "spinup".
+
+    Returns
+    -------
+    iris.cube.CubeList
+        Regional means in the order of `names`.
+    """
+    fnames = [
+        input_file(sim_label, time_prof=time_prof, kind=kind)
+        for time_prof in time_profs
+    ]
+    return regional_means(fnames, names, regions, model=um)
+
+
+def load_regional_cubes(sim_label, names, regions, time_profs, kind="mean"):
+    """
+    Load the parts of variables within regions, reading only their data from disk.
+
+    Each variable is read from the first of the files that contains it, as in
+    `load_regional_means()`. Registered derived fields, e.g. air density, are
+    calculated from the regional cubes when first extracted.
+
+    Parameters
+    ----------
+    sim_label: str
+        Experiment label.
+    names: list of str
+        Names of variables, see `regions.regional_cubes()`.
+    regions: aeolus.region.Region or list of aeolus.region.Region
+        Region or several regions.
+    time_profs: list of str
+        Time profiles of the files to look for the variables in, see `input_file()`.
+    kind: str, optional
+        Kind of output: "mean" or "spinup".
+
+    Returns
+    -------
+    list of derived.LazyCubeList
+        Cubes within each region, in the order of `names`.
+    """
+    fnames = [
+        input_file(sim_label, time_prof=time_prof, kind=kind)
+        for time_prof in time_profs
+    ]
+    const = init_const(_planet(sim_label), directory=mypaths.constdir)
+    out = []
+    for cl in regional_cubes(fnames, names, regions, model=um):
+        cl = LazyCubeList(cl, const=const, model=um)
+        add_planet_conf_to_cubes(cl, const)
+        out.append(cl)
+    return out
@@ -12,6 +12,8 @@ datadir = topdir.parent.parent / "modelling" / "um" / "results"
 
 sadir = datadir / "sa"  # standalone suites directory
 
+cachedir = datadir / "cache"  # cached intermediate results
+
 constdir = topdir / "code" / "const"
 
 # Plotting output
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""Partial time reductions that can be merged into means and variances."""
+import iris
+from iris.coords import CellMethod
+import numpy as np
+
+from aeolus.model import um
+
+from budget_utils import collapsed_template, load_time_chunk
+
+__all__ = ("PartialStats", "merge_all")
+
+
+def _stat_key(cube):
+    """Key of a variable: its name, STASH code and cell methods."""
+    return (
+        cube.name(),
+        str(cube.attributes.get("STASH", "")),
+        tuple(str(cell_method) for cell_method in cube.cell_methods),
+    )
+
+
+def _merge_collapsed_coord(coord_a, coord_b):
+    """Collapsed coordinate spanning the bounds of two collapsed coordinates."""
+    lower = min(coord_a.bounds.min(), coord_b.bounds.min())
+    upper = max(coord_a.bounds.max(), coord_b.bounds.max())
+    return coord_a.copy(points=[0.5 * (lower + upper)], bounds=[[lower, upper]])
+
+
+class PartialStats:
+    """
+    Partial reduction of time series: number of samples, sum and sum of squares.
+
+    The sum of squares is stored relative to the partial mean, and records are
+    merged using the pairwise update of Chan et al. (1979), which is associative
+    and numerically stable. Hence records of separate files can be computed
+    in parallel and combined into a mean and variance over any set of them.
+    Cubes without a time dimension are ignored. Variables are identified by
+    their name, STASH code and cell methods, so that e.g. the same STASH item
+    with different cell methods is kept separately.
+    """
+
+    def __init__(self, stats=None, days=None):
+        """
+        Instantiate a `PartialStats` object.
+
+        Parameters
+        ----------
+        stats: dict, optional
+            Mapping of variable keys (name, STASH code, cell methods) to tuples of
+            (template cube, number of samples, sum, sum of squared deviations
+            from the mean).
+        days: tuple of int, optional
+            First and last day of the time series.
+        """
+        self.stats = stats or {}
+        self.days = days
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(days={self.days}, vrbls={[*self.stats]})"
+
+    @classmethod
+    def from_cubes(cls, cubelist, days=None, t_coord=um.t, day_coord=um.fcst_prd):
+        """
+        Reduce cubes along the time dimension.
+
+        Parameters
+        ----------
+        cubelist: iris.cube.CubeList
+            Input cubes.
+        days: tuple of int, optional
+            First and last day (inclusive) of the time steps to reduce.
+            By default, all time steps are used.
+        t_coord: str, optional
+            Name of the time coordinate.
+        day_coord: str, optional
+            Name of the coordinate used to find the days, in hours.
+
+        Returns
+        -------
+        PartialStats
+            Partial reduction of the input.
+
+        Raises
+        ------
+        ValueError
+            If several cubes have the same name, STASH code and cell methods.
+        """
+        stats = {}
+        hours = []
+        for cube in cubelist:
+            if not cube.coords(t_coord) or not cube.coord_dims(t_coord):
+                continue
+            (t_dim,) = cube.coord_dims(t_coord)
+            if days is not None:
+                # Time steps are ordered, so the ones within the days are contiguous
+                day = cube.coord(day_coord).points // 24
+                idx = np.nonzero((day >= days[0]) & (day <= days[1]))[0]
+                if idx.size == 0:
+                    continue
+                keys = [slice(None)] * cube.ndim
+                keys[t_dim] = slice(int(idx[0]), int(idx[-1]) + 1)
+                cube = cube[tuple(keys)]
+            key = _stat_key(cube)
+            if key in stats:
+                raise ValueError(f"Duplicate variable {key} in the input cubes")
+            data = load_time_chunk(cube, t_dim, 0, None)
+            count = data.shape[t_dim]
+            total = data.sum(axis=t_dim)
+            m2 = ((data - np.expand_dims(total / count, t_dim)) ** 2).sum(axis=t_dim)
+            stats[key] = (collapsed_template(cube, t_coord), count, total, m2)
+            if cube.coords(day_coord):
+                hours.append(cube.coord(day_coord).points)
+        days = None
+        if hours:
+            hours = np.concatenate(hours)
+            days = (int(hours.min() // 24), int(hours.max() // 24))
+        return cls(stats, days)
+
+    def merge(self, other):
+        """
+        Combine two partial reductions.
+
+        Variables present in only one of them are passed through.
+
+        Parameters
+        ----------
+        other: PartialStats
+            Another partial reduction.
+
+        Returns
+        -------
+        PartialStats
+            Combined partial reduction.
+        """
+        stats = {**self.stats}
+        for name, (tmpl_b, n_b, total_b, m2_b) in other.stats.items():
+            if name not in stats:
+                stats[name] = (tmpl_b, n_b, total_b, m2_b)
+                continue
+            tmpl_a, n_a, total_a, m2_a = stats[name]
+            count = n_a + n_b
+            delta = total_b / n_b - total_a / n_a
+            m2 = m2_a + m2_b + delta**2 * (n_a * n_b / count)
+            tmpl = tmpl_a.copy()
+            for coord in tmpl_a.coords(dimensions=()):
+                if coord.has_bounds() and tmpl_b.coords(coord.name()):
+                    tmpl.replace_coord(
+                        _merge_collapsed_coord(coord, tmpl_b.coord(coord.name()))
+                    )
+            stats[name] = (tmpl, count, total_a + total_b, m2)
+        if self.days is None or other.days is None:
+            days = self.days or other.days
+        else:
+            days = (min(self.days[0], other.days[0]), max(self.days[1], other.days[1]))
+        return self.__class__(stats, days)
+
+    __add__ = merge
+
+    def mean_cubes(self):
+        """Time means of all variables."""
+        cl = iris.cube.CubeList()
+        for tmpl, count, total, _ in self.stats.values():
+            cube = tmpl.copy(data=(total / count).astype(tmpl.dtype))
+            cube.add_cell_method(CellMethod("mean", coords=um.t))
+            cl.append(cube)
+        return cl
+
+    def variance_cubes(self, ddof=1):
+        """
+        Temporal variances of all variables.
+
+        Parameters
+        ----------
+        ddof: int, optional
+            Delta degrees of freedom.
+
+        Returns
+        -------
+        iris.cube.CubeList
+            Variances named "variance_of_<name>".
+        """
+        cl = iris.cube.CubeList()
+        for tmpl, count, _, m2 in self.stats.values():
+            cube = tmpl.copy(data=(m2 / max(count - ddof, 1)).astype(tmpl.dtype))
+            cube.rename(f"variance_of_{tmpl.name()}")
+            cube.units = tmpl.units**2
+            cube.add_cell_method(CellMethod("variance", coords=um.t))
+            cl.append(cube)
+        return cl
+
+    def save(self, fname):
+        """
+        Save the partial reduction to a netCDF file.
+
+        Parameters
+        ----------
+        fname: pathlib.Path
+            Path to the file.
+        """
+        cl = iris.cube.CubeList()
+        for tmpl, count, total, m2 in self.stats.values():
+            for stat, data in (("sum", total), ("m2", m2)):
+                cube = tmpl.copy(data=data)
+                cube.attributes.update(partial_stat=stat, partial_count=count)
+                cl.append(cube)
+        for cube in cl:
+            cube.attributes["partial_days"] = np.array(self.days or (-1, -1))
+        # Keep the .nc suffix for iris to recognise the format
+        tmp_path = fname.with_suffix(".tmp.nc")
+        iris.save(cl, str(tmp_path))
+        tmp_path.replace(fname)
+
+    @classmethod
+    def load(cls, fname):
+        """
+        Load a partial reduction from a netCDF file.
+
+        Parameters
+        ----------
+        fname: pathlib.Path
+            Path to the file.
+
+        Returns
+        -------
+        PartialStats
+            Partial reduction.
+        """
+        parts = {}
+        days = None
+        for cube in iris.load(str(fname)):
+            attrs = cube.attributes
+            stat = attrs.pop("partial_stat")
+            count = int(attrs.pop("partial_count"))
+            days = tuple(int(day) for day in attrs.pop("partial_days"))
+            part = parts.setdefault(_stat_key(cube), {"count": count})
+            if stat in part:
+                raise ValueError(f"Duplicate variable {_stat_key(cube)} in {fname}")
+            part[stat] = cube
+        stats = {}
+        for key, part in parts.items():
+            tmpl = part["sum"]
+            stats[key] = (
+                tmpl,
+                part["count"],
+                np.asarray(tmpl.data, dtype="float64"),
+                np.asarray(part["m2"].data, dtype="float64"),
+            )
+        return cls(stats, None if days == (-1, -1) else days)
+
+
+def merge_all(records):
+    """
+    Merge partial reductions one by one.
+
+    Parameters
+    ----------
+    records: iterable of PartialStats
+        Partial reductions. A generator can be given to keep
+        only two of them in memory at a time.
+
+    Returns
+    -------
+    PartialStats
+        Combined partial reduction.
+    """
+    records = iter(records)
+    try:
+        result = next(records)
+    except StopIteration:
+        raise ValueError("No partial reductions to merge")
+    for record in records:
+        result = result.merge(record)
+    return result
@@ -0,0 +1,485 @@
+# -*- coding: utf-8 -*-
+"""Regional subsets of model output found by index arithmetic."""
+from collections import OrderedDict
+import hashlib
+import operator
+
+import iris
+import iris.analysis
+from iris._constraints import ConstraintCombination
+from iris.util import broadcast_to_shape
+import numpy as np
+
+from aeolus.model import um
+
+__all__ = (
+    "CompiledConstraint",
+    "area_mean",
+    "lon_lat_slices",
+    "regional_cubes",
+    "regional_means",
+)
+
+# Process-wide cache of index keys and area weights, keyed by the identity
+# of the constraint object and the hash of the coordinates it depends on
+_CACHE = OrderedDict()
+_CACHE_SIZE = 256
+
+# No match of a constraint is cached as well, so it needs a distinct marker
+_NO_MATCH = object()
+
+
+def _coords_hash(cube, names):
+    """Calculate a hash of the given coordinates of a cube and their dimensions."""
+    sha = hashlib.sha1(repr(cube.ndim).encode())
+    for name in names:
+        coords = cube.coords(name)
+        if not coords:
+            sha.update(f"{name} missing".encode())
+            continue
+        (coord,) = coords
+        sha.update(f"{name} [{coord.units}] {cube.coord_dims(coord)}".encode())
+        sha.update(np.ascontiguousarray(coord.points).tobytes())
+        if coord.has_bounds():
+            sha.update(np.ascontiguousarray(coord.bounds).tobytes())
+    return sha.hexdigest()
+
+
+def _cache_get(key):
+    """Get an item from the cache, marking it as recently used."""
+    value = _CACHE[key]
+    _CACHE.move_to_end(key)
+    return value
+
+
+def _cache_put(key, value):
+    """Put an item to the cache, dropping the least recently used one if it is full."""
+    _CACHE[key] = value
+    if len(_CACHE) > _CACHE_SIZE:
+        _CACHE.popitem(last=False)
+
+
+def _cell_weights(coord, lat=False):
+    """Relative widths of grid cells in radians, or in sine of latitude."""
+    if coord.has_bounds():
+        bounds = np.deg2rad(coord.bounds)
+        if lat:
+            bounds = np.sin(bounds)
+        return np.abs(np.diff(bounds, axis=-1)).ravel()
+    if lat:
+        return np.cos(np.deg2rad(coord.points))
+    return np.ones(coord.shape)
+
+
+def _coord_names(constraint):
+    """Names of the coordinates a constraint refers to."""
+    if isinstance(constraint, CompiledConstraint):
+        return _coord_names(constraint.constraint)
+    if isinstance(constraint, ConstraintCombination):
+        return _coord_names(constraint.lhs) | _coord_names(constraint.rhs)
+    return set(constraint._coord_values)
+
+
+def _is_coord_constraint(constraint):
+    """Check if a constraint depends only on coordinates."""
+    if isinstance(constraint, CompiledConstraint):
+        return True
+    if isinstance(constraint, ConstraintCombination):
+        return _is_coord_constraint(constraint.lhs) and _is_coord_constraint(
+            constraint.rhs
+        )
+    return (
+        type(constraint) is iris.Constraint
+        and constraint._name is None
+        and constraint._cube_func is None
+    )
+
+
+class CompiledConstraint(iris.Constraint):
+    """
+    Coordinate constraint evaluated once per grid.
+
+    The first time the constraint is applied to a cube, the functions it consists
+    of are evaluated for the coordinate points and the matching indices are stored.
+    The same indices are then used for all cubes with identical coordinates,
+    so that the extraction is just indexing. The cache is keyed by the identity
+    of the constraint object, which it keeps alive, and the hash of the coordinates
+    it refers to, so e.g. all time slices of a field share the indices.
+    Combining it with another coordinate constraint using `&` gives
+    a `CompiledConstraint` too, which is created once per pair of constraints.
+    Combinations with constraints on names or cubes are left to iris.
+    """
+
+    def __init__(self, constraint, model=um):
+        """
+        Instantiate a `CompiledConstraint` object.
+
+        Parameters
+        ----------
+        constraint: iris.Constraint
+            Constraint on coordinates.
+        model: aeolus.model.Model, optional
+            Model class with relevant coordinate names.
+        """
+        if not _is_coord_constraint(constraint):
+            raise ValueError(f"{constraint!r} does not depend only on coordinates")
+        super().__init__()
+        self.constraint = constraint
+        self.model = model
+        self._coord_names = tuple(sorted(_coord_names(constraint)))
+        self._combined = {}
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.constraint!r})"
+
+    def __and__(self, other):
+        if not _is_coord_constraint(other):
+            return ConstraintCombination(self, other, operator.__and__)
+        # Reuse the combination, so that its cache entries are reused as well;
+        # the other constraint is stored with it, so its id stays unique
+        if id(other) not in self._combined:
+            rhs = other.constraint if isinstance(other, CompiledConstraint) else other
+            self._combined[id(other)] = (
+                other,
+                self.__class__(self.constraint & rhs, model=self.model),
+            )
+        return self._combined[id(other)][1]
+
+    def _CIM_extract(self, cube):
+        # Used by iris when this constraint is combined with a plain constraint
+        return self.constraint._CIM_extract(cube)
+
+    def index_keys(self, cube):
+        """
+        Indices of the cube matching the constraint.
+
+        Parameters
+        ----------
+        cube: iris.cube.Cube
+            Input cube.
+
+        Returns
+        -------
+        tuple or None
+            Keys for indexing the cube, or None if nothing matches.
+        """
+        key = (id(self.constraint), _coords_hash(cube, self._coord_names))
+        try:
+            _, keys = _cache_get(key)
+        except KeyError:
+            keys = self.constraint._CIM_extract(cube).as_slice()
+            keys = _NO_MATCH if keys is None else keys
+            # Store the constraint too, so that its id is not reused while cached
+            _cache_put(key, (self.constraint, keys))
+        return None if keys is _NO_MATCH else keys
+
+    def extract(self, cube):
+        """
+        Extract the constrained part of a cube.
+
+        Parameters
+        ----------
+        cube: iris.cube.Cube
+            Input cube.
+
+        Returns
+        -------
+        iris.cube.Cube or None
+            Subset of the cube, or None if nothing matches.
+        """
+        keys = self.index_keys(cube)
+        if keys is None:
+            return None
+        return cube[keys]
+
+    def area_weights(self, cube):
+        """
+        Normalised horizontal area weights of the constrained part of a cube.
+
+        Parameters
+        ----------
+        cube: iris.cube.Cube
+            Input cube.
+
+        Returns
+        -------
+        numpy.ndarray
+            Weights of the shape of the subset of the cube, summing to 1
+            over the horizontal dimensions.
+        """
+        sub = self.extract(cube)
+        if sub is None:
+            raise ValueError(f"{self!r} does not match {cube.name()}")
+        # Only the horizontal weights are cached and broadcast to the shape of each subset
+        key = (
+            "area_weights",
+            id(self.constraint),
+            _coords_hash(sub, (self.model.y, self.model.x)),
+        )
+        try:
+            _, (weights, dims) = _cache_get(key)
+        except KeyError:
+            y_coord = sub.coord(self.model.y)
+            x_coord = sub.coord(self.model.x)
+            weights = np.outer(_cell_weights(y_coord, lat=True), _cell_weights(x_coord))
+            dims = (*sub.coord_dims(y_coord), *sub.coord_dims(x_coord))
+            weights = (weights / weights.sum()).reshape(
+                [sub.shape[dim] for dim in dims]
+            )
+            _cache_put(key, (self.constraint, (weights, dims)))
+        return broadcast_to_shape(weights, sub.shape, dims)
+
+    def spatial_mean(self, cube):
+        """
+        Area-weighted mean over the constrained region.
+
+        Parameters
+        ----------
+        cube: iris.cube.Cube
+            Input cube.
+
+        Returns
+        -------
+        iris.cube.Cube
+            Mean over the horizontal dimensions of the region.
+        """
+        sub = self.extract(cube)
+        weights = self.area_weights(cube)
+        coords = [name for name in (self.model.y, self.model.x) if sub.coord_dims(name)]
+        return sub.collapsed(coords, iris.analysis.MEAN, weights=weights)
+
+
+def lon_lat_slices(lons, lats, region):
+    """
+    Find index slices of a grid covering a region.
+
+    Longitudes are compared modulo 360 degrees, so the region and the grid can use
+    different conventions (e.g. -180...180 and 0...360). A region crossing the edge
+    of the grid is split into two slices instead of rolling the data.
+
+    Parameters
+    ----------
+    lons: numpy.ndarray
+        Longitudes of the grid, increasing monotonically.
+    lats: numpy.ndarray
+        Latitudes of the grid, monotonic.
+    region: aeolus.region.Region
+        Region. Its western boundary can be to the east of the eastern boundary,
+        which means that it wraps around the dateline.
+
+    Returns
+    -------
+    lon_slices: list of slice
+        One or two slices of longitude indices, in the order from west to east.
+    lat_slice: slice
+        Slice of latitude indices.
+    """
+    bounds = region.bounds
+    lat_idx = np.nonzero((lats >= bounds.south) & (lats <= bounds.north))[0]
+    if lat_idx.size == 0:
+        raise ValueError(f"No latitudes within {region}")
+    lat_slice = slice(int(lat_idx[0]), int(lat_idx[-1]) + 1)
+
+    # Distances eastward from the first grid point
+    rel = (lons - lons[0]) % 360
+    west = (bounds.west - lons[0]) % 360
+    east = (bounds.east - lons[0]) % 360
+    if bounds.west != bounds.east and west == east:
+        # Full circle
+        return [slice(0, lons.size)], lat_slice
+    if west <= east:
+        lon_idx = np.nonzero((rel >= west) & (rel <= east))[0]
+        lon_slices = (
+            [slice(int(lon_idx[0]), int(lon_idx[-1]) + 1)] if lon_idx.size else []
+        )
+    else:
+        west_idx = np.nonzero(rel >= west)[0]
+        east_idx = np.nonzero(rel <= east)[0]
+        lon_slices = []
+        if west_idx.size:
+            lon_slices.append(slice(int(west_idx[0]), lons.size))
+        if east_idx.size:
+            lon_slices.append(slice(0, int(east_idx[-1]) + 1))
+    if not lon_slices:
+        raise ValueError(f"No longitudes within {region}")
+    return lon_slices, lat_slice
+
+
+def _matches(cube, name):
+    """Check if a cube has the given standard name, long name, variable name or STASH."""
+    return name in (
+        cube.name(),
+        cube.standard_name,
+        cube.long_name,
+        cube.var_name,
+        str(cube.attributes.get("STASH", "")),
+    )
+
+
+def _load_lazy(fnames, names):
+    """Load cubes without reading their data, each from the first file that contains it."""
+    if not isinstance(fnames, (list, tuple)):
+        fnames = [fnames]
+    cubes = {}
+    for fname in fnames:
+        remaining = [name for name in names if name not in cubes]
+        if not remaining:
+            break
+        cl = iris.load(
+            str(fname),
+            iris.Constraint(
+                cube_func=lambda cube: any(_matches(cube, name) for name in remaining)
+            ),
+        )
+        for name in remaining:
+            found = [cube for cube in cl if _matches(cube, name)]
+            if len(found) > 1:
+                raise ValueError(f"Several cubes match {name} in {fname}")
+            if found:
+                cubes[name] = found[0]
+    missing = [name for name in names if name not in cubes]
+    if missing:
+        raise KeyError(f"{missing} not found in {[str(fname) for fname in fnames]}")
+    return [cubes[name] for name in names]
+
+
+def _region_subset(cube, region, model=um):
+    """Slice the part of a lazy cube within a region."""
+    lon_slices, lat_slice = lon_lat_slices(
+        cube.coord(model.x).points, cube.coord(model.y).points, region
+    )
+    (y_dim,) = cube.coord_dims(model.y)
+    (x_dim,) = cube.coord_dims(model.x)
+    parts = []
+    for lon_slice in lon_slices:
+        keys = [slice(None)] * cube.ndim
+        keys[y_dim], keys[x_dim] = lat_slice, lon_slice
+        parts.append(cube[tuple(keys)])
+    if len(parts) == 1:
+        return parts[0]
+    # The region crosses the edge of the grid, so the longitudes of its eastern
+    # part are continued beyond 360 degrees to keep them monotonic
+    lon = parts[1].coord(model.x)
+    parts[1].replace_coord(
+        lon.copy(
+            points=lon.points + 360,
+            bounds=lon.bounds + 360 if lon.has_bounds() else None,
+        )
+    )
+    return iris.cube.CubeList(parts).concatenate_cube()
+
+
+def regional_cubes(fname, names, regions, model=um):
+    """
+    Load the parts of variables within regions without reading the rest from disk.
+
+    The cubes are loaded lazily and sliced to the regions, so only the hyperslabs
+    covering the regions are read when their data are used.
+
+    Parameters
+    ----------
+    fname: pathlib.Path or list of pathlib.Path
+        Path to a netCDF file or several files. Each variable is read from the first
+        file that contains it.
+    names: list of str
+        Names of variables (standard names, long names, variable names or STASH codes).
+    regions: aeolus.region.Region or list of aeolus.region.Region
+        Region or several regions.
+    model: aeolus.model.Model, optional
+        Model class with relevant coordinate names.
+
+    Returns
+    -------
+    list of iris.cube.CubeList
+        Cubes within each region, in the order of `names`.
+    """
+    if not isinstance(regions, (list, tuple)):
+        regions = [regions]
+    cubes = _load_lazy(fname, names)
+    return [
+        iris.cube.CubeList(
+            [_region_subset(cube, region, model=model) for cube in cubes]
+        )
+        for region in regions
+    ]
+
+
+def area_mean(cubes, model=um):
+    """
+    Calculate an area-weighted mean over several non-overlapping parts of the grid.
+
+    Masked and NaN values are left out of the mean.
+
+    Parameters
+    ----------
+    cubes: list of iris.cube.Cube
+        Parts of a variable, e.g. from `regional_cubes()`.
+    model: aeolus.model.Model, optional
+        Model class with relevant coordinate names.
+
+    Returns
+    -------
+    iris.cube.Cube
+        Mean with all dimensions but latitude and longitude.
+    """
+    total = weight_sum = 0
+    for cube in cubes:
+        (y_dim,) = cube.coord_dims(model.y)
+        (x_dim,) = cube.coord_dims(model.x)
+        weights = broadcast_to_shape(
+            np.outer(
+                _cell_weights(cube.coord(model.y), lat=True),
+                _cell_weights(cube.coord(model.x)),
+            ),
+            cube.shape,
+            (y_dim, x_dim),
+        )
+        data = np.ma.filled(cube.data.astype("float64"), np.nan)
+        valid = ~np.isnan(data)
+        total = total + np.where(valid, data * weights, 0).sum(axis=(y_dim, x_dim))
+        weight_sum = weight_sum + (valid * weights).sum(axis=(y_dim, x_dim))
+    keys = [slice(None)] * cubes[0].ndim
+    keys[y_dim] = keys[x_dim] = 0
+    mean = cubes[0][tuple(keys)]
+    mean.remove_coord(model.y)
+    mean.remove_coord(model.x)
+    with np.errstate(invalid="ignore"):
+        mean.data = (total / weight_sum).astype(cubes[0].dtype)
+    return mean
+
+
+def regional_means(fname, names, regions, model=um):
+    """
+    Calculate area-weighted means over regions, reading only their data from disk.
+
+    Only the hyperslabs covering the regions are read, so the amount of I/O
+    is proportional to the size of the regions rather than the globe.
+
+    Parameters
+    ----------
+    fname: pathlib.Path or list of pathlib.Path
+        Path to a netCDF file or several files. Each variable is read from the first
+        file that contains it.
+    names: list of str
+        Names of variables (standard names, long names, variable names or STASH codes).
+    regions: aeolus.region.Region or list of aeolus.region.Region
+        Region or several non-overlapping regions averaged together.
+    model: aeolus.model.Model, optional
+        Model class with relevant coordinate names.
+
+    Returns
+    -------
+    iris.cube.CubeList
+        Regional means with all dimensions but latitude and longitude,
+        e.g. one value per time step.
+    """
+    if not isinstance(regions, (list, tuple)):
+        regions = [regions]
+    subsets = regional_cubes(fname, names, regions, model=model)
+    cl = iris.cube.CubeList()
+    for i, name in enumerate(names):
+        cube = area_mean([subset[i] for subset in subsets], model=model)
+        cube.rename(name)
+        cube.attributes["region"] = ",".join(region.name for region in regions)
+        cl.append(cube)
+    return cl
@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+"""Batched calculation of transmission spectra with cached spectral data."""
+from collections import namedtuple
+from functools import lru_cache
+import hashlib
+
+import iris
+from iris.coords import AuxCoord
+import numpy as np
+
+from aeolus.model import um
+
+from regions import lon_lat_slices
+
+__all__ = ("SpectralData", "TransmissionEngine", "read_spectral_file")
+
+SpectralData = namedtuple(
+    "SpectralData",
+    [
+        "band_index",
+        "lower_wavelength_limit",
+        "upper_wavelength_limit",
+        "normalized_stellar_flux",
+    ],
+)
+
+# Names of the pseudo-level coordinate of spectral bands in the UM output
+PSEUDO_NAMES = ["pseudo", "pseudo_level", "spectral_band_index"]
+
+
+def _read_block(lines, block_type):
+    """Parse numeric rows of a block of a SOCRATES spectral file."""
+    header = f"*BLOCK: TYPE = {block_type:>4d}"
+    rows = []
+    in_block = False
+    for line in lines:
+        if line.startswith(header):
+            in_block = True
+        elif in_block:
+            if line.startswith("*END"):
+                break
+            words = line.split()
+            if words and words[0].isnumeric():
+                rows.append([float(word) for word in words])
+    return np.array(rows, dtype="float64")
+
+
+@lru_cache(maxsize=8)
+def _parse_spectral_file(path, mtime_ns):
+    with open(path, "r") as fp:
+        lines = fp.readlines()
+    bands = _read_block(lines, 1)
+    flux = _read_block(lines, 2)
+    # Put the stellar flux in the order of the bands
+    flux_by_band = dict(zip(flux[:, 0].astype(int), flux[:, 1]))
+    band_index = bands[:, 0].astype(int)
+    return SpectralData(
+        band_index=band_index,
+        lower_wavelength_limit=bands[:, 1],
+        upper_wavelength_limit=bands[:, 2],
+        normalized_stellar_flux=np.array([flux_by_band[i] for i in band_index]),
+    )
+
+
+def read_spectral_file(spectral_file):
+    """
+    Read spectral bands and the normalised stellar flux from a SOCRATES spectral file.
+
+    Both blocks are read in one pass, and the result is cached in memory
+    until the file is modified.
+
+    Parameters
+    ----------
+    spectral_file: pathlib.Path
+        Path to the location of a SOCRATES spectral file.
+
+    Returns
+    -------
+    SpectralData
+        Arrays of band indices, wavelength limits [m] and normalised stellar flux [1].
+    """
+    return _parse_spectral_file(str(spectral_file), spectral_file.stat().st_mtime_ns)
+
+
+def _as_float(value, units):
+    """Convert a number or a scalar cube to a float in the given units."""
+    if isinstance(value, iris.cube.Cube):
+        value = value.copy()
+        value.convert_units(units)
+        value = value.data
+    return float(value)
+
+
+class TransmissionEngine:
+    """
+    Calculator of transmission spectra from the UM transmitted flux diagnostics.
+
+    The spectral file is parsed once, and the stellar flux and the squared
+    ratio of the planetary top-of-atmosphere radius to the stellar radius
+    are precomputed. The grid layout (positions of the horizontal and spectral
+    dimensions and the output template) is found once per grid and reused.
+    Transmitted flux cubes of the same shape, e.g. cloudy, clear-sky and dry
+    diagnostics, are processed together as one array.
+
+    See `aeolus.synthobs.calc_transmission_spectrum()` for the formula.
+    """
+
+    def __init__(
+        self,
+        spectral_file,
+        stellar_constant_at_1_au,
+        stellar_radius,
+        planet_top_of_atmosphere,
+        model=um,
+    ):
+        """
+        Instantiate a `TransmissionEngine` object.
+
+        Parameters
+        ----------
+        spectral_file: pathlib.Path
+            Path to the location of a SOCRATES spectral file.
+        stellar_constant_at_1_au: float or iris.cube.Cube
+            Stellar constant at 1 AU [W m-2].
+        stellar_radius: float or iris.cube.Cube
+            Stellar radius [m].
+        planet_top_of_atmosphere: float or iris.cube.Cube
+            The extent of the planetary atmosphere [m].
+        model: aeolus.model.Model, optional
+            Model class with relevant coordinate names.
+        """
+        self.model = model
+        self.spectral = read_spectral_file(spectral_file)
+        self.stellar_flux = self.spectral.normalized_stellar_flux * _as_float(
+            stellar_constant_at_1_au, "W m-2"
+        )
+        self.toa_ratio_sq = (
+            _as_float(planet_top_of_atmosphere, "m") / _as_float(stellar_radius, "m")
+        ) ** 2
+        self.band_centres = 0.5 * (
+            self.spectral.lower_wavelength_limit + self.spectral.upper_wavelength_limit
+        )
+        self._layouts = {}
+        self._limb_masks_cache = {}
+
+    def _layout(self, cube):
+        """Positions of dimensions and the output template for the grid of a cube."""
+        sha = hashlib.sha1(repr(cube.shape).encode())
+        for coord in cube.dim_coords:
+            sha.update(coord.name().encode())
+            sha.update(np.ascontiguousarray(coord.points).tobytes())
+        key = sha.hexdigest()
+        if key in self._layouts:
+            return self._layouts[key]
+
+        band_coord = next(
+            coord for coord in cube.dim_coords if coord.name().lower() in PSEUDO_NAMES
+        )
+        (band_dim,) = cube.coord_dims(band_coord)
+        h_dims = tuple(
+            dim
+            for name in (self.model.y, self.model.x)
+            if cube.coords(name)
+            for dim in cube.coord_dims(name)
+        )
+        # Output template: the cube without horizontal dimensions
+        keys = [slice(None)] * cube.ndim
+        for dim in h_dims:
+            keys[dim] = 0
+        tmpl = cube[tuple(keys)]
+        for name in (self.model.y, self.model.x):
+            if tmpl.coords(name):
+                tmpl.remove_coord(name)
+        tmpl.coord(band_coord.name()).rename("spectral_band_index")
+        out_band_dim = band_dim - sum(dim < band_dim for dim in h_dims)
+        # Positions of the bands of the cube in the spectral file data
+        pos = {idx: i for i, idx in enumerate(self.spectral.band_index)}
+        band_pos = np.array([pos[int(idx)] for idx in band_coord.points])
+        tmpl.add_aux_coord(
+            AuxCoord(
+                self.band_centres[band_pos],
+                long_name="spectral_band_centres",
+                units="m",
+            ),
+            out_band_dim,
+        )
+        tmpl.rename("ratio_of_effective_planetary_radius_to_stellar_radius")
+        tmpl.units = "1"
+        layout = (h_dims, out_band_dim, band_pos, tmpl)
+        self._layouts[key] = layout
+        return layout
+
+    def _from_template(self, tmpl, cube, data):
+        """Output cube on the grid of the template with scalar coords and attributes of a cube."""
+        # The template is shared by all cubes on the same grid, so the metadata
+        # that can differ between them, e.g. a scalar time coordinate, is taken from the cube
+        out = tmpl.copy(data=data)
+        for coord in tmpl.coords(dimensions=()):
+            out.remove_coord(coord)
+        for coord in cube.coords(dimensions=()):
+            if coord.name() not in (self.model.y, self.model.x):
+                out.add_aux_coord(coord.copy())
+        out.attributes = cube.attributes.copy()
+        return out
+
+    def flux_sum(self, cube):
+        """
+        Sum of the transmitted flux over the horizontal dimensions.
+
+        Parameters
+        ----------
+        cube: iris.cube.Cube
+            Transmitted flux on spectral bands and optionally latitudes and longitudes.
+
+        Returns
+        -------
+        numpy.ndarray
+            Summed flux with the dimensions of the output spectrum.
+        """
+        h_dims = self._layout(cube)[0]
+        data = np.asarray(cube.data, dtype="float64")
+        return data.sum(axis=h_dims) if h_dims else data
+
+    def ratio_from_sums(self, sums, band_dim, band_pos):
+        """
+        Ratio of the effective planetary radius to the stellar radius.
+
+        Parameters
+        ----------
+        sums: numpy.ndarray
+            Flux summed over the horizontal dimensions. Can have extra leading
+            dimensions for a batch of diagnostics.
+        band_dim: int
+            Index of the spectral band dimension counting from the end.
+        band_pos: numpy.ndarray
+            Positions of the bands in the spectral file data.
+
+        Returns
+        -------
+        numpy.ndarray
+            Array of the same shape as `sums`.
+        """
+        shape = [1] * sums.ndim
+        shape[band_dim] = -1
+        flux_ratio = sums / self.stellar_flux[band_pos].reshape(shape)
+        return np.sqrt(np.clip(self.toa_ratio_sq - flux_ratio, 0.0, None))
+
+    def calc_spectra(self, trans_fluxes):
+        """
+        Calculate transmission spectra for many transmitted flux diagnostics.
+
+        Parameters
+        ----------
+        trans_fluxes: dict
+            Cubes of the transmitted flux [W m-2] on spectral bands and optionally
+            latitudes and longitudes, e.g. for cloudy, clear-sky and dry conditions.
+
+        Returns
+        -------
+        dict
+            Cubes of the ratio of the effective planetary radius to the stellar radius,
+            with the same keys. Spectral band centres [m] are attached
+            as an auxiliary coordinate.
+        """
+        results = {}
+        for keys in self._group_by_grid(trans_fluxes):
+            _, band_dim, band_pos, tmpl = self._layout(trans_fluxes[keys[0]])
+            sums = np.stack([self.flux_sum(trans_fluxes[key]) for key in keys])
+            ratio = self.ratio_from_sums(sums, band_dim - tmpl.ndim, band_pos)
+            for key, data in zip(keys, ratio):
+                results[key] = self._from_template(tmpl, trans_fluxes[key], data)
+        return results
+
+    def _group_by_grid(self, trans_fluxes):
+        """Group keys of diagnostics on the same grid to process them as one array."""
+        groups = {}
+        for key, cube in trans_fluxes.items():
+            groups.setdefault(id(self._layout(cube)), []).append(key)
+        return groups.values()
+
+    def _limb_masks(self, cube, limbs):
+        """Masks of columns of the full ring and the given limbs, of shape (y, x, limb)."""
+        # Key on the bounds, so that limbs with the same names but different regions
+        # get their own masks
+        key = (
+            id(self._layout(cube)),
+            tuple(
+                (k, r.bounds.west, r.bounds.east, r.bounds.south, r.bounds.north)
+                for k, r in limbs.items()
+            ),
+        )
+        if key not in self._limb_masks_cache:
+            lons = cube.coord(self.model.x).points
+            lats = cube.coord(self.model.y).points
+            masks = np.zeros((lats.size, lons.size, len(limbs) + 1))
+            masks[..., 0] = 1
+            for i, region in enumerate(limbs.values(), start=1):
+                lon_slices, lat_slice = lon_lat_slices(lons, lats, region)
+                for lon_slice in lon_slices:
+                    masks[lat_slice, lon_slice, i] = 1
+            self._limb_masks_cache[key] = masks
+        return self._limb_masks_cache[key]
+
+    def calc_limb_spectra(self, trans_fluxes, limbs, diff=None):
+        """
+        Calculate spectra of the full ring and separate limbs in one pass.
+
+        The transmitted flux of each diagnostic is read once and reduced
+        to the sums over all columns and over the columns of every limb together,
+        so the cost barely depends on the number of limbs.
+
+        Parameters
+        ----------
+        trans_fluxes: dict
+            Cubes of the transmitted flux [W m-2] on spectral bands, latitudes
+            and longitudes, e.g. for cloudy, clear-sky and dry conditions.
+        limbs: dict
+            Regions of the limbs, e.g. `{"east_term": Region(0, 180, -90, 90)}`.
+        diff: tuple of str, optional
+            Keys of two limbs. If given, the difference of their transit depths,
+            i.e. squared radius ratios, is added to the results as "diff".
+
+        Returns
+        -------
+        dict
+            For every key of `trans_fluxes`, a dictionary of cubes of the ratio
+            of the effective planetary radius to the stellar radius for the full ring
+            ("full") and each limb, and optionally the difference ("diff").
+        """
+        names = ["full", *limbs]
+        results = {}
+        for keys in self._group_by_grid(trans_fluxes):
+            cube = trans_fluxes[keys[0]]
+            _, band_dim, band_pos, tmpl = self._layout(cube)
+            y_dim, x_dim = (
+                cube.coord_dims(self.model.y)[0],
+                cube.coord_dims(self.model.x)[0],
+            )
+            masks = self._limb_masks(cube, limbs)
+            # Sums over the columns of every limb, with the limb as the leading dimension
+            sums = np.stack(
+                [
+                    np.moveaxis(
+                        np.tensordot(
+                            np.asarray(trans_fluxes[key].data, dtype="float64"),
+                            masks,
+                            axes=([y_dim, x_dim], [0, 1]),
+                        ),
+                        -1,
+                        0,
+                    )
+                    for key in keys
+                ],
+                axis=1,
+            )
+            ratio = self.ratio_from_sums(sums, band_dim - tmpl.ndim, band_pos)
+            for i, key in enumerate(keys):
+                results[key] = {
+                    name: self._from_template(tmpl, trans_fluxes[key], ratio[j, i])
+                    for j, name in enumerate(names)
+                }
+                if diff is not None:
+                    j_a, j_b = names.index(diff[0]), names.index(diff[1])
+                    depth_diff = self._from_template(
+                        tmpl, trans_fluxes[key], ratio[j_a, i] ** 2 - ratio[j_b, i] ** 2
+                    )
+                    depth_diff.rename("transit_depth_difference")
+                    results[key]["diff"] = depth_diff
+        return results
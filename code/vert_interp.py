@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""Interpolation of many variables to pressure levels using one set of weights."""
+import iris
+from iris.coords import DimCoord
+import numpy as np
+
+from aeolus.model import um
+
+__all__ = ("PressureLevelInterpolator", "interp_cubelist_to_pressure_levels")
+
+
+class PressureLevelInterpolator:
+    """
+    Interpolator from model height levels to pressure levels.
+
+    The bracketing model levels and the weights, linear in log-pressure, are found
+    once per column of the pressure field and then applied to all variables
+    defined on the same grid in a single gather.
+    Pressure levels outside the column range are filled with NaN.
+    """
+
+    def __init__(self, pressure, levels, model=um):
+        """
+        Instantiate a `PressureLevelInterpolator` object.
+
+        Parameters
+        ----------
+        pressure: iris.cube.Cube
+            Air pressure on model height levels.
+        levels: array-like
+            Target pressure levels in the units of `pressure`.
+        model: aeolus.model.Model, optional
+            Model class with relevant coordinate names.
+        """
+        self.model = model
+        self.pressure = pressure
+        self.levels = np.asarray(levels, dtype="float64")
+        self.shape = pressure.shape
+        self.z_dim = pressure.coord_dims(model.z)[0]
+        self._calc_weights()
+
+    def _to_columns(self, arr):
+        """Reshape an array to (columns, levels)."""
+        arr = np.moveaxis(arr, self.z_dim, -1)
+        return arr.reshape(-1, arr.shape[-1])
+
+    def _calc_weights(self):
+        pres = np.asarray(self.pressure.data, dtype="float64")
+        log_p = np.log(self._to_columns(pres))
+        log_lev = np.log(self.levels)
+        nz = log_p.shape[-1]
+        # Pressure decreases upwards, so the number of model levels with a higher
+        # pressure than the target level gives the index of the upper bracketing level.
+        # Loop over the target levels to keep temporary arrays as small as the input.
+        n_below = np.empty((log_p.shape[0], log_lev.size), dtype="int64")
+        for i, lev in enumerate(log_lev):
+            n_below[:, i] = np.count_nonzero(log_p > lev, axis=1)
+        # A target level equal to the lowest model level has no model level below it,
+        # but it is within the column and gets the value at that level
+        valid = ((n_below > 0) | (log_p[:, :1] == log_lev)) & (n_below < nz)
+        self._idx_lo = np.clip(n_below - 1, 0, nz - 2)
+        self._idx_hi = self._idx_lo + 1
+        p_lo = np.take_along_axis(log_p, self._idx_lo, axis=-1)
+        p_hi = np.take_along_axis(log_p, self._idx_hi, axis=-1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self._weight = np.where(valid, (p_lo - log_lev) / (p_lo - p_hi), np.nan)
+
+    def _make_cube(self, cube, data):
+        """Create a cube on pressure levels using the metadata of the input cube."""
+        out = iris.cube.Cube(data, **cube.metadata._asdict())
+        lev_coord = DimCoord(self.levels, units=self.pressure.units)
+        lev_coord.rename(self.model.pres)
+        for coord in cube.dim_coords:
+            (dim,) = cube.coord_dims(coord)
+            if dim == self.z_dim:
+                out.add_dim_coord(lev_coord, dim)
+            else:
+                out.add_dim_coord(coord.copy(), dim)
+        for coord in cube.aux_coords:
+            dims = cube.coord_dims(coord)
+            if self.z_dim not in dims:
+                out.add_aux_coord(coord.copy(), dims)
+        return out
+
+    def interpolate_cubes(self, cubes):
+        """
+        Interpolate several cubes to pressure levels.
+
+        Parameters
+        ----------
+        cubes: list of iris.cube.Cube
+            Cubes with the same shape as the pressure field.
+
+        Returns
+        -------
+        iris.cube.CubeList
+            Cubes on pressure levels.
+        """
+        for cube in cubes:
+            if cube.shape != self.shape:
+                raise ValueError(
+                    f"Shape of {cube.name()} {cube.shape} is different"
+                    f" from the shape of pressure {self.shape}"
+                )
+        # Stack all variables into one array of shape (variables, columns, levels)
+        stacked = np.stack(
+            [self._to_columns(np.asarray(cube.data, dtype="float64")) for cube in cubes]
+        )
+        f_lo = np.take_along_axis(stacked, self._idx_lo[np.newaxis], axis=-1)
+        f_hi = np.take_along_axis(stacked, self._idx_hi[np.newaxis], axis=-1)
+        result = f_lo + self._weight[np.newaxis] * (f_hi - f_lo)
+        # Restore the original dimension order with the vertical axis replaced
+        out_shape = [*self.shape]
+        del out_shape[self.z_dim]
+        out_shape.append(self.levels.size)
+        cl_out = iris.cube.CubeList()
+        for cube, data in zip(cubes, result):
+            data = np.moveaxis(data.reshape(out_shape), -1, self.z_dim)
+            data = data.astype(np.result_type(cube.dtype, np.float32))
+            cl_out.append(self._make_cube(cube, data))
+        return cl_out
+
+
+def interp_cubelist_to_pressure_levels(cubelist, levels, model=um):
+    """
+    Interpolate all cubes in a cube list to pressure levels using the same weights.
+
+    Parameters
+    ----------
+    cubelist: iris.cube.CubeList
+        List of cubes on model height levels, including air pressure.
+    levels: array-like
+        Target pressure levels in the units of the air pressure cube.
+    model: aeolus.model.Model, optional
+        Model class with relevant variable names.
+
+    Returns
+    -------
+    iris.cube.CubeList
+        Cubes on pressure levels. The air pressure itself is not included,
+        because it becomes the vertical coordinate.
+    """
+    pres = cubelist.extract_cube(model.pres)
+    interpolator = PressureLevelInterpolator(pres, levels, model=model)
+    return interpolator.interpolate_cubes(
+        [cube for cube in cubelist if cube.name() != pres.name()]
+    )
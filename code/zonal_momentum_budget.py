@@ -2,20 +2,53 @@
 """Calculations of zonal momentum budget."""
 from cached_property import cached_property
 import iris
-from iris.analysis.maths import apply_ufunc, divide
+from iris.analysis.maths import divide
+from iris.exceptions import CoordinateNotFoundError
 import numpy as np
 
 from aeolus.calc import deriv, zonal_mean
-from aeolus.coord import coord_to_cube
 from aeolus.core import AtmoSim
 from aeolus.meta import update_metadata
 from aeolus.plot import tex2cf_units
 
 from pouch.clim_diag import d_dphi
 
+from budget_utils import (
+    as_lazy,
+    collapsed_template,
+    compute_cubes,
+    load_time_chunk,
+    uncached_copy,
+)
+from geometry import get_grid_geometry
+
 __all__ = ("ZonalMomBudgetFluxForm",)
 
 
+def _zonal_mean_kernel(u, v, w, rho, x_dim):
+    """
+    Calculate zonal means and eddy covariances needed for the budget terms.
+
+    Works on plain arrays and reuses a single work array for the mass fluxes,
+    so that only two temporary arrays of the input size are allocated.
+    """
+    nx = u.shape[x_dim]
+    u_zm = u.mean(axis=x_dim, keepdims=True)
+    u_prime = np.moveaxis(u - u_zm, x_dim, -1)
+    out = {"u_zm": np.squeeze(u_zm, axis=x_dim)}
+    work = np.empty_like(u)
+    for cmpnt, wind, term in [("v", v, "horiz"), ("w", w, "vert")]:
+        np.multiply(rho, wind, out=work)
+        rho_wind_zm = work.mean(axis=x_dim, keepdims=True)
+        work -= rho_wind_zm
+        out[f"rho_{cmpnt}_zm"] = np.squeeze(rho_wind_zm, axis=x_dim)
+        # Zonal mean of the product without a temporary array
+        out[f"cov_eddy_{term}"] = (
+            np.einsum("...i,...i->...", np.moveaxis(work, x_dim, -1), u_prime) / nx
+        )
+    return out
+
+
 class ZonalMomBudgetFluxForm(AtmoSim):
     """
     Class to calculate terms of the zonal momentum budget.
@@ -35,50 +68,40 @@ class ZonalMomBudgetFluxForm(AtmoSim):
     ]
     tex_units = "$kg$ $m^{-2}$ $s^{-2}$"
     _units = tex2cf_units(tex_units)
+    # Zonal mean quantities that each term is calculated from
+    _term_reductions = {
+        "mean_horiz": ["rho_v_zm", "u_zm"],
+        "mean_vert": ["rho_w_zm", "u_zm"],
+        "eddy_horiz": ["cov_eddy_horiz"],
+        "eddy_vert": ["cov_eddy_vert"],
+        "coriolis_horiz": ["rho_v_zm"],
+        "coriolis_vert": ["rho_w_zm"],
+    }
+
+    @cached_property
+    def geometry(self):
+        """Geometric factors of the grid, shared between runs on the same grid."""
+        return get_grid_geometry(self._cubes, self.const, model=self.model)
 
     @cached_property
-    @update_metadata(name="planet_radius", units="m")
     def radius(self):
-        return (
-            coord_to_cube(
-                self._cubes.extract(self.dim_constr.relax.z)[0],
-                self.model.z,
-                broadcast=False,
-            )
-            + self.const.radius
-        )
+        return self.geometry.radius
 
     @cached_property
-    @update_metadata(name="cos(lat)", units="1")
     def lat_cos(self):
-        lat_cube = coord_to_cube(
-            self._cubes.extract(self.dim_constr.relax.y)[0],
-            self.model.y,
-            broadcast=False,
-        )
-        lat_cos_cube = apply_ufunc(np.cos, apply_ufunc(np.deg2rad, lat_cube))
-        return lat_cos_cube
+        return self.geometry.lat_cos
 
     @cached_property
-    @update_metadata(name="cos(lat)**2", units="1")
     def lat_cos_sq(self):
-        return self.lat_cos ** 2
+        return self.geometry.lat_cos_sq
 
     @cached_property
-    @update_metadata(name="sin(lat)", units="1")
     def lat_sin(self):
-        lat_cube = coord_to_cube(
-            self._cubes.extract(self.dim_constr.relax.y)[0],
-            self.model.y,
-            broadcast=False,
-        )
-        lat_sin_cube = apply_ufunc(np.sin, apply_ufunc(np.deg2rad, lat_cube))
-        return lat_sin_cube
+        return self.geometry.lat_sin
 
     @cached_property
-    @update_metadata(name="sin(lat)**2", units="1")
     def lat_sin_sq(self):
-        return self.lat_sin ** 2
+        return self.geometry.lat_sin_sq
 
     @cached_property
     @update_metadata(units="m s-2")
@@ -124,15 +147,39 @@ class ZonalMomBudgetFluxForm(AtmoSim):
     def w_prime(self):
         return self.w - self.w_zm
 
+    @cached_property
+    def rho_v(self):
+        return self.dens * self.v
+
+    @cached_property
+    def rho_w(self):
+        return self.dens * self.w
+
     @cached_property
     def rho_v_zm(self):
-        rho_v = self.dens * self.v
-        return zonal_mean(rho_v)
+        return zonal_mean(self.rho_v)
 
     @cached_property
     def rho_w_zm(self):
-        rho_w = self.dens * self.w
-        return zonal_mean(rho_w)
+        return zonal_mean(self.rho_w)
+
+    @cached_property
+    def rho_v_prime(self):
+        return self.rho_v - self.rho_v_zm
+
+    @cached_property
+    def rho_w_prime(self):
+        return self.rho_w - self.rho_w_zm
+
+    @cached_property
+    def cov_eddy_horiz(self):
+        """Zonal mean covariance of the horizontal eddy components."""
+        return zonal_mean(self.rho_v_prime * self.u_prime)
+
+    @cached_property
+    def cov_eddy_vert(self):
+        """Zonal mean covariance of the vertical eddy components."""
+        return zonal_mean(self.rho_w_prime * self.u_prime)
 
     @cached_property
     def temp_zm(self):
@@ -173,12 +220,12 @@ class ZonalMomBudgetFluxForm(AtmoSim):
         },
     )
     def mean_vert(self):
-        deriv_arg = self.rho_w_zm * self.u_zm * self.radius ** 3
+        deriv_arg = self.rho_w_zm * self.u_zm * self.geometry.radius_pow(3)
         numerator = -1 * deriv(deriv_arg, self.model.z)
         numerator.coord(self.model.z).bounds = deriv_arg.coord(
             self.model.z
         ).bounds.copy()
-        return divide(numerator, self.radius ** 3)
+        return divide(numerator, self.geometry.radius_pow(3))
 
     @cached_property
     @update_metadata(
@@ -217,9 +264,7 @@ class ZonalMomBudgetFluxForm(AtmoSim):
         },
     )
     def eddy_horiz(self):
-        rho_v = self.dens * self.v
-        rho_v_prime = rho_v - self.rho_v_zm
-        deriv_arg = zonal_mean(rho_v_prime * self.u_prime) * self.lat_cos_sq
+        deriv_arg = self.cov_eddy_horiz * self.lat_cos_sq
         numerator = -1 * d_dphi(deriv_arg)
         denominator = self.lat_cos_sq
         numerator.coord(self.model.y).points = denominator.coord(
@@ -243,11 +288,116 @@ class ZonalMomBudgetFluxForm(AtmoSim):
         },
     )
     def eddy_vert(self):
-        rho_w = self.dens * self.w
-        rho_w_prime = rho_w - self.rho_w_zm
-        deriv_arg = zonal_mean(rho_w_prime * self.u_prime) * (self.radius ** 3)
+        deriv_arg = self.cov_eddy_vert * self.geometry.radius_pow(3)
         numerator = -1 * deriv(deriv_arg, self.model.z)
         numerator.coord(self.model.z).bounds = deriv_arg.coord(
             self.model.z
         ).bounds.copy()
-        return divide(numerator, self.radius ** 3)
+        return divide(numerator, self.geometry.radius_pow(3))
+
+    def compute_lazy(self, terms=None, chunks=None):
+        """
+        Calculate the requested budget terms from a single dask graph.
+
+        The input fields are kept as dask arrays, so all the zonal mean quantities
+        needed for the requested terms are built lazily, with shared intermediates
+        (e.g. `rho_v` or `u_prime`) appearing in the graph only once.
+        The graph is then evaluated by a single call to `dask.compute()`.
+
+        Parameters
+        ----------
+        terms: list of str, optional
+            Names of the terms to calculate. By default, `term_labels` are used.
+        chunks: int or tuple or str, optional
+            Chunks of the input dask arrays. See `budget_utils.as_lazy()`.
+
+        Returns
+        -------
+        dict
+            Dictionary of cubes of the budget terms.
+        """
+        if terms is None:
+            terms = self.term_labels
+        # Work on a copy, so that the lazy fields and the quantities built from them
+        # do not replace the fields and cached properties of this object
+        budget = uncached_copy(self)
+        for key in ["u", "v", "w", "dens"]:
+            budget.__dict__[key] = as_lazy(self[key], chunks=chunks)
+        reductions = []
+        for term in terms:
+            for key in self._term_reductions[term]:
+                if key not in reductions:
+                    reductions.append(key)
+        results = {term: budget[term] for term in terms}
+        compute_cubes([budget[key] for key in reductions] + [*results.values()])
+        return results
+
+    def compute_fused(self, terms=None, chunk_size=None):
+        """
+        Calculate the requested budget terms using a fused NumPy kernel.
+
+        All the zonal means and eddy covariances needed for the terms are calculated
+        in one vectorised pass over plain arrays, optionally in chunks along the time
+        dimension, and then wrapped into cubes. The results are stored in the cache of
+        the corresponding properties, from which the terms are calculated.
+
+        Parameters
+        ----------
+        terms: list of str, optional
+            Names of the terms to calculate. By default, `term_labels` are used.
+        chunk_size: int, optional
+            Number of time slices held in memory at once. By default, all data are used.
+
+        Returns
+        -------
+        dict
+            Dictionary of cubes of the budget terms.
+        """
+        if terms is None:
+            terms = self.term_labels
+        x_dim = self.u.coord_dims(self.model.x)[0]
+        try:
+            (t_dim,) = self.u.coord_dims(self.model.t)
+            nt = self.u.shape[t_dim]
+        except (CoordinateNotFoundError, ValueError):
+            t_dim, nt = None, 1
+        if t_dim is None or chunk_size is None:
+            chunk_size = nt
+        # Time dimension in the arrays with the zonal dimension removed
+        t_dim_zm = None if t_dim is None else t_dim - int(x_dim < t_dim)
+
+        chunks = []
+        for start in range(0, nt, chunk_size):
+            stop = min(start + chunk_size, nt)
+            chunks.append(
+                _zonal_mean_kernel(
+                    *[
+                        load_time_chunk(cube, t_dim, start, stop)
+                        for cube in [self.u, self.v, self.w, self.dens]
+                    ],
+                    x_dim,
+                )
+            )
+        if len(chunks) == 1:
+            arrays = chunks[0]
+        else:
+            arrays = {
+                key: np.concatenate([chunk[key] for chunk in chunks], axis=t_dim_zm)
+                for key in chunks[0]
+            }
+
+        # Wrap the results into cubes
+        tmpl = collapsed_template(self.u, self.model.x)
+        units = {
+            "u_zm": self.u.units,
+            "rho_v_zm": self.dens.units * self.v.units,
+            "rho_w_zm": self.dens.units * self.w.units,
+            "cov_eddy_horiz": self.dens.units * self.v.units * self.u.units,
+            "cov_eddy_vert": self.dens.units * self.w.units * self.u.units,
+        }
+        for key, arr in arrays.items():
+            cube = tmpl.copy(data=arr)
+            cube.rename(key)
+            cube.units = units[key]
+            self.__dict__[key] = cube
+        return {term: self[term] for term in terms}